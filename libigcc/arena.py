@@ -0,0 +1,93 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# session_alloc: buffers that outlive the program.
+#
+# Every line builds and runs the program again from the top, so data
+# that takes a while to load or compute is loaded or computed again on
+# every line.  session_alloc( name, size ) maps the file name in the
+# session's arena directory, creating it if it isn't there (or is the
+# wrong size), and session_created says which happened, so the work is
+# done once:
+#
+#     double *a = session_alloc( "a", n * sizeof *a );
+#     if( session_created ) for( ... ) a[i] = expensive( i );
+#
+# The runtime is only put into programs that mention session_alloc.
+# ITCC_ARENA_DIR, if set, is used instead of the session's directory, so
+# buffers can be kept between sessions too.
+
+import os
+
+directory_env = "ITCC_ARENA_DIR"
+
+runtime = """
+#include <stdio.h>
+#include <stdlib.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+static int session_created;
+static void *session_alloc( const char *name, size_t size ){
+    char path[4096];
+    const char *dir = getenv( "ITCC_ARENA_DIR" );
+    struct stat st;
+    void *p;
+    int fd;
+    snprintf( path, sizeof path, "%s/%s", dir ? dir : "$directory", name );
+    fd = open( path, O_RDWR | O_CREAT, 0600 );
+    if( fd < 0 ) return NULL;
+    session_created = fstat( fd, &st ) != 0 || (size_t)st.st_size != size;
+    if( session_created && ( ftruncate( fd, 0 ) != 0
+            || ftruncate( fd, (off_t)size ) != 0 ) ){
+        close( fd );
+        return NULL;
+    }
+    p = mmap( NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0 );
+    close( fd );
+    return p == MAP_FAILED ? NULL : p;
+}
+"""
+
+def directory( runner ):
+    ret = os.environ.get( directory_env ) or runner.workspace.file( "arena" )
+    os.makedirs( ret, exist_ok = True )
+    return ret
+
+def get_runtime( runner ):
+    """The runtime, if the program uses it."""
+    if not any( "session_alloc" in a.inp for a in runner.get_user_input() ):
+        return ""
+    return runtime.replace( "$directory", directory( runner ) )
+
+def describe( runner ):
+    names = sorted( os.listdir( directory( runner ) ) )
+    if not names:
+        return "[No buffers. Make one with session_alloc( name, size ).]"
+    return "\n".join( "%s  %d bytes" % ( name, os.path.getsize(
+        os.path.join( directory( runner ), name ) ) ) for name in names )
+
+def free( runner, name ):
+    path = os.path.join( directory( runner ), name )
+    if name != os.path.basename( name ) or not os.path.isfile( path ):
+        return False
+    os.remove( path )
+    return True
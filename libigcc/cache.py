@@ -0,0 +1,178 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# Compiled programs, keyed by compiler command and source.
+#
+# Undo, redo and retyping a line often rebuild a program we have already
+# built.  The cache keeps the last few executables (and compile errors)
+# so those come back without running the compiler.  Executables are hard
+# linked in and out of the cache directory, which is why the output file
+# is always removed before a real compile: a compiler that rewrote it in
+# place would corrupt the cached copy.  Programs built into memory files
+# (see memexec) are kept open instead and run straight from the cache.
+
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+class Entry:
+
+    def __init__( self, filename, error, memfile = None ):
+        self.filename = filename
+        self.error = error
+        self.memfile = memfile
+
+    def run_path( self, exefilename ):
+        if self.memfile is not None:
+            return self.memfile.path
+        return exefilename
+
+    def close( self ):
+        if self.memfile is not None:
+            self.memfile.close()
+        elif self.filename is not None and os.path.isfile( self.filename ):
+            os.remove( self.filename )
+
+class ArtifactCache:
+
+    def __init__( self, directory = None, max_entries = 32 ):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        # keys somebody is building right now (see speculate)
+        self.pending = {}
+
+    def key( self, command, source ):
+        h = hashlib.sha256()
+        h.update( "\0".join( command ).encode() )
+        h.update( b"\0\0" )
+        h.update( source.encode( "utf-8" ) )
+        return h.hexdigest()
+
+    def get_directory( self ):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp( prefix = "itcc-cache-" )
+        else:
+            os.makedirs( self.directory, exist_ok = True )
+        return self.directory
+
+    def fetch( self, key, exefilename ):
+        """Put the cached program for key at exefilename and return its
+        Entry, or return None if we have not built it before."""
+        with self.lock:
+            return self.fetch_locked( key, exefilename )
+
+    def fetch_locked( self, key, exefilename ):
+        entry = self.entries.get( key )
+        if entry is None or ( entry.filename is not None
+                and not os.path.isfile( entry.filename ) ):
+            self.entries.pop( key, None )
+            self.misses += 1
+            return None
+        self.entries.move_to_end( key )
+        self.hits += 1
+        if entry.filename is not None:
+            place( entry.filename, exefilename )
+        return entry
+
+    def store( self, key, exefilename, error, memfile = None ):
+        with self.lock:
+            self.store_locked( key, exefilename, error, memfile )
+
+    def store_locked( self, key, exefilename, error, memfile ):
+        if error is not None:
+            if memfile is not None:
+                memfile.close()
+            entry = Entry( None, error )
+        elif memfile is not None:
+            entry = Entry( None, None, memfile )
+        elif os.path.isfile( exefilename ):
+            filename = os.path.join( self.get_directory(), key )
+            place( exefilename, filename )
+            entry = Entry( filename, None )
+        else:
+            return
+        self.entries[key] = entry
+        self.entries.move_to_end( key )
+        while len( self.entries ) > self.max_entries:
+            old_key, old = self.entries.popitem( last = False )
+            old.close()
+
+    def reserve( self, key ):
+        """Claim key for a background build.  False if it is already
+        built or being built."""
+        with self.lock:
+            if key in self.entries or key in self.pending:
+                return False
+            self.pending[key] = threading.Event()
+            return True
+
+    def release( self, key ):
+        with self.lock:
+            event = self.pending.pop( key, None )
+        if event is not None:
+            event.set()
+
+    def wait( self, key ):
+        """If key is being built in the background, wait for it rather
+        than building it twice."""
+        with self.lock:
+            event = self.pending.get( key )
+        if event is not None:
+            event.wait()
+
+    def path( self, key ):
+        """Where the program cached under key can be read, or None."""
+        with self.lock:
+            entry = self.entries.get( key )
+            if entry is None or entry.error is not None:
+                return None
+            return entry.run_path( entry.filename )
+
+    def __contains__( self, key ):
+        with self.lock:
+            return key in self.entries
+
+    def clear( self ):
+        with self.lock:
+            for entry in self.entries.values():
+                entry.close()
+            self.entries.clear()
+        if self.directory is not None:
+            shutil.rmtree( self.directory, ignore_errors = True )
+
+def place( src, dst ):
+    if os.path.lexists( dst ):
+        os.remove( dst )
+    try:
+        os.link( src, dst )
+    except OSError:
+        shutil.copy2( src, dst )
+
+def remove( filename ):
+    """Unlink a compiler's output file before it is rebuilt."""
+    if os.path.lexists( filename ):
+        os.remove( filename )
@@ -0,0 +1,319 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# igcc --clang-repl: keep one clang-repl process and send it only the new
+# lines, instead of building and running the whole program with g++.
+#
+# clang-repl reads one line at a time, so a block typed over several
+# lines is held back until its brackets close and then sent as one line.
+# After each block we send a declaration whose initialiser prints a
+# sentinel line to stdout and stderr; reading up to the sentinels
+# separates one input's output from the next.
+#
+# clang-repl can't forget what it has run.  So after each block the
+# process forks (see checkpoint_runtime): the parent carries on and the
+# child waits, as a snapshot of the session at that point.  When the
+# session goes back - undo, then a new line - the snapshot from before
+# the first line that changed is woken and the old process killed, so
+# nothing before it runs again.  Snapshots are bounded by a memory
+# budget; with none left far enough back, or after a crash or .load, a
+# fresh clang-repl replays the session quietly.  A fork only copies the
+# thread that called it, so this relies on clang-repl compiling on the
+# main thread, which it does by default.  Snapshots wait in sessions of
+# their own, so they watch a pipe from us and exit when it closes: our
+# dying, however that happens, takes them with us.
+
+import os
+import re
+import select
+import shutil
+import signal
+import subprocess
+import time
+import uuid
+
+from . import jobs
+from . import probes
+from . import workspace
+
+name = "clang-repl"
+prompt_text = b"clang-repl> "
+diagnostic_re = re.compile(
+    rb"(?m)^(input_line_\d+:\d+:\d+: error:|error: Parsing failed)" )
+checkpoint_re = re.compile( rb"itcc-checkpoint (-?\d+)\n" )
+
+# clang-repl reads a line at a time, so this is one line.  A snapshot
+# waits for SIGUSR1, and gives up when $fd, a pipe whose other end only
+# we hold, says we have gone.
+checkpoint_runtime = ( "static int itcc_checkpoint(){ fflush( stdout ); "
+    "fflush( stderr ); pid_t pid = fork(); if( pid != 0 ){ "
+    "printf( \"itcc-checkpoint %d\\n\", (int)pid ); fflush( stdout ); "
+    "return 0; } signal( SIGHUP, SIG_IGN ); sigset_t s; sigemptyset( &s ); "
+    "sigaddset( &s, SIGUSR1 ); sigprocmask( SIG_BLOCK, &s, 0 ); "
+    "struct timespec t = { 1, 0 }; struct pollfd p = { $fd, POLLIN, 0 }; "
+    "while( sigtimedwait( &s, 0, &t ) != SIGUSR1 ) "
+    "if( poll( &p, 1, 0 ) != 0 ) _exit( 0 ); "
+    "sigprocmask( SIG_UNBLOCK, &s, 0 ); return 1; }" )
+
+def available():
+    return shutil.which( name ) is not None
+
+def get_command( options, extra_options ):
+    ret = [ name, "--Xcc=-std=c++17", "--Xcc=-w" ]
+    for directory in workspace.absolute( options.INCLUDE ) or ():
+        ret.append( "--Xcc=-I" + directory )
+    for option in extra_options:
+        ret.append( "--Xcc=" + option )
+    return ret
+
+def get_prelude( session_args ):
+    """What the g++ boilerplate would have given the user's lines."""
+    argv = ", ".join( '(char *)"%s"' % arg.replace( "\\", "\\\\" )
+        .replace( '"', '\\"' ) for arg in [ "igcc" ] + list( session_args ) )
+    return [ "#include <cstdio>", "using namespace std;",
+        "int argc = %d;" % ( len( session_args ) + 1 ),
+        "char *argv[] = { %s, nullptr };" % argv ]
+
+def groups( inputs ):
+    """Split inputs into ( inputs, line ) blocks that are complete on
+    their own; a block still open at the end is left out."""
+    ret = []
+    block = []
+    codes = []
+    depth = 0
+    for user_input in inputs:
+        depth, code = probes.scan_line( user_input.inp, depth )
+        block.append( user_input )
+        codes.append( code.strip() if not code.lstrip().startswith( "#" )
+            else user_input.inp.strip() )
+        if depth == 0:
+            ret.append( ( block, " ".join( codes ) ) )
+            block = []
+            codes = []
+    return ret
+
+def pid_alive( pid ):
+    try:
+        os.kill( pid, 0 )
+        with open( "/proc/%d/stat" % pid ) as f:
+            return f.read().rsplit( ")", 1 )[1].split()[0] != "Z"
+    except ( OSError, IndexError ):
+        return False
+
+def rss_mb( pid ):
+    try:
+        with open( "/proc/%d/status" % pid ) as f:
+            for line in f:
+                if line.startswith( "VmRSS:" ):
+                    return int( line.split()[1] ) / 1024
+    except ( OSError, ValueError ):
+        pass
+    return None
+
+def kill( pid ):
+    try:
+        os.kill( pid, signal.SIGKILL )
+    except OSError:
+        pass
+
+class Repl:
+
+    def __init__( self, command, prelude, checkpoint_mb = 0 ):
+        self.command = command
+        self.prelude = prelude
+        self.checkpoint_mb = checkpoint_mb
+        self.process = None
+        self.lifeline = None
+        # the clang-repl we are talking to: process, or a woken snapshot
+        self.pid = None
+        self.fed = []
+        # len( fed ) at a block boundary -> the snapshot waiting there
+        self.snapshots = {}
+        self.count = 0
+        self.resumed = 0
+        self.sentinel = uuid.uuid4().hex
+
+    def alive( self ):
+        if self.process is None:
+            return False
+        if self.pid == self.process.pid:
+            return self.process.poll() is None
+        return pid_alive( self.pid )
+
+    def restart( self ):
+        self.close()
+        # snapshots outlive clang-repl, but not us (see checkpoint_runtime)
+        lifeline, self.lifeline = os.pipe()
+        self.process = subprocess.Popen( self.command,
+            stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE, bufsize = 0, start_new_session = True,
+            pass_fds = ( lifeline, ) )
+        os.close( lifeline )
+        self.pid = self.process.pid
+        self.fed = []
+        prelude = list( self.prelude )
+        if self.checkpoint_mb > 0:
+            prelude += [ "#include <unistd.h>", "#include <csignal>",
+                "#include <poll.h>",
+                checkpoint_runtime.replace( "$fd", str( lifeline ) ) ]
+        for line in prelude:
+            self.send( line )
+        self.checkpoint()
+
+    def close( self ):
+        for pid in self.snapshots.values():
+            kill( pid )
+        self.snapshots = {}
+        if self.process is not None:
+            kill( self.pid )
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process = None
+        if self.lifeline is not None:
+            os.close( self.lifeline )
+            self.lifeline = None
+
+    def checkpoint( self ):
+        """Leave a snapshot of the session as it is now."""
+        if self.checkpoint_mb <= 0 or not self.alive():
+            return
+        out, err = self.send( "int itcc_checkpoint_%d = itcc_checkpoint();"
+            % self.count )
+        match = checkpoint_re.search( out )
+        if match is None or int( match.group( 1 ) ) <= 0:
+            return
+        position = len( self.fed )
+        if position in self.snapshots:
+            kill( self.snapshots[position] )
+        self.snapshots[position] = int( match.group( 1 ) )
+        # a snapshot costs at most what the session had when it was taken
+        size = rss_mb( self.pid ) or self.checkpoint_mb
+        keep = max( 1, int( self.checkpoint_mb // size ) )
+        for position in sorted( self.snapshots )[ : -keep ]:
+            kill( self.snapshots.pop( position ) )
+
+    def resume( self, position ):
+        """Go back to the snapshot taken at position, in place of the
+        process we have been talking to (which may have crashed)."""
+        kill( self.pid )
+        if self.pid == self.process.pid:
+            self.process.wait()
+        for later in [ p for p in self.snapshots if p >= position ]:
+            pid = self.snapshots.pop( later )
+            if later == position:
+                self.pid = pid
+            else:
+                kill( pid )
+        os.kill( self.pid, signal.SIGUSR1 )
+        self.fed = self.fed[ : position ]
+        self.resumed += 1
+        # whatever the snapshot had read ahead comes out before this
+        self.send( None )
+        self.checkpoint()
+
+    def catch_up( self, inputs ):
+        """Bring clang-repl up to date with inputs.  Returns the new
+        stdout, the new stderr and the compile error (or None)."""
+        same = 0
+        while ( same < len( self.fed ) and same < len( inputs )
+                and self.fed[same] is inputs[same] ):
+            same += 1
+        if not self.alive() or same < len( self.fed ):
+            back = [ p for p in self.snapshots if p <= same
+                and pid_alive( self.snapshots[p] ) ]
+            if back:
+                self.resume( max( back ) )
+            if not back or not self.alive():
+                self.restart()
+        stdout, stderr, error = b"", b"", None
+        position = 0
+        for block, line in groups( inputs ):
+            position += len( block )
+            if position <= len( self.fed ):
+                continue
+            out, err = self.send( line )
+            self.fed += block
+            if len( self.fed ) > same:
+                stdout += out
+                if diagnostic_re.search( err ):
+                    error = err
+                else:
+                    stderr += err
+            # else we are replaying what was run before, and seen already
+            if not self.alive():
+                error = ( error or b"" ) + ( b"clang-repl stopped running: "
+                    b"%s\n" % line.encode() )
+                break
+            self.checkpoint()
+        return stdout, stderr, error
+
+    def send( self, line ):
+        """Run one line and return what it printed.  None just waits
+        for clang-repl to be ready."""
+        if not self.alive():
+            return b"", b""
+        # a killed job takes clang-repl with it; we start another next time
+        job = getattr( jobs.local, "job", None )
+        if job is not None and self.process not in job.processes:
+            job.adopt( self.process )
+        self.count += 1
+        mark = ( "%s-%d" % ( self.sentinel, self.count ) ).encode()
+        check = ( 'int itcc_sentinel_%d = ( printf( "\\n%s\\n" ), '
+            'fflush( stdout ), fprintf( stderr, "\\n%s\\n" ), '
+            'fflush( stderr ), 0 );' % ( self.count, mark.decode(),
+            mark.decode() ) )
+        text = check + "\n" if line is None else line + "\n" + check + "\n"
+        try:
+            self.process.stdin.write( text.encode() )
+        except OSError:
+            return b"", b""
+        return self.read_until( b"\n" + mark + b"\n" )
+
+    def read_until( self, end ):
+        buffers = { self.process.stdout.fileno() : b"",
+            self.process.stderr.fileno() : b"" }
+        waiting = set( buffers )
+        closed = False
+        while waiting:
+            # snapshots hold the pipes open too, so a crash isn't always
+            # an end of file; look in on the process now and then
+            ready, _, _ = select.select( list( waiting ), [], [], 0.1 )
+            if not ready and not self.alive():
+                break
+            for fd in ready:
+                data = os.read( fd, 65536 )
+                if not data:
+                    waiting.discard( fd )
+                    closed = True
+                    continue
+                buffers[fd] += data
+                if end in buffers[fd]:
+                    waiting.discard( fd )
+        # a dying process closes its pipes a moment before it is gone
+        deadline = time.monotonic() + 1
+        while closed and self.alive() and time.monotonic() < deadline:
+            time.sleep( 0.01 )
+        if self.pid == self.process.pid and not self.alive():
+            self.process.wait()
+        out, err = ( buffers[self.process.stdout.fileno()],
+            buffers[self.process.stderr.fileno()] )
+        return ( out.split( end )[0].replace( prompt_text, b"" ),
+            err.split( end )[0].replace( prompt_text, b"" ) )
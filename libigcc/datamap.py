@@ -0,0 +1,287 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# .data name path [type]: a file as an array, mapped when the program
+# starts instead of read and parsed by the user's code on every line.
+#
+# Raw files are mapped as they are.  A .csv file is converted once to a
+# binary file of the type asked for, holding its numeric columns row by
+# row, and that is kept in ~/.cache/itcc/data until the CSV changes.
+# Each backend gets declarations in its own language: name and name_len
+# in C and C++, a slice in rust and zig, and name_cols in all of them.
+
+import array
+import collections
+import csv
+import hashlib
+import os
+import re
+
+from . import workspace
+
+# our name : C type, array typecode
+types = {
+    "u8" : ( "uint8_t", "B" ),
+    "i8" : ( "int8_t", "b" ),
+    "u16" : ( "uint16_t", "H" ),
+    "i16" : ( "int16_t", "h" ),
+    "u32" : ( "uint32_t", "I" ),
+    "i32" : ( "int32_t", "i" ),
+    "u64" : ( "uint64_t", "Q" ),
+    "i64" : ( "int64_t", "q" ),
+    "f32" : ( "float", "f" ),
+    "f64" : ( "double", "d" ),
+}
+
+name_re = re.compile( r"^[A-Za-z_][A-Za-z0-9_]*$" )
+
+c_runtime = """
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+static const void *itcc_map( const char *path, size_t *size ){
+    struct stat st;
+    void *p;
+    int fd = open( path, O_RDONLY );
+    if( fd < 0 || fstat( fd, &st ) != 0 ){
+        fprintf( stderr, "can't map %s\\n", path );
+        exit( 1 );
+    }
+    *size = (size_t)st.st_size;
+    p = *size ? mmap( NULL, *size, PROT_READ, MAP_PRIVATE, fd, 0 ) : NULL;
+    close( fd );
+    if( p == MAP_FAILED ){
+        fprintf( stderr, "can't map %s\\n", path );
+        exit( 1 );
+    }
+    return p;
+}
+"""
+
+c_declaration = """static const $ctype *$name;
+static size_t $name_len;
+enum { $name_cols = $cols };
+__attribute__((constructor)) static void itcc_map_$name( void ){
+    size_t size;
+    $name = (const $ctype *)itcc_map( "$path", &size );
+    $name_len = size / sizeof *$name;
+}
+"""
+
+rust_runtime = """
+#[allow(dead_code)]
+fn itcc_map<T>(path: &str) -> &'static [T] {
+    use std::os::unix::io::AsRawFd;
+    extern "C" {
+        fn mmap(addr: *mut u8, len: usize, prot: i32, flags: i32, fd: i32,
+            offset: i64) -> *mut u8;
+    }
+    let file = std::fs::File::open(path).expect(path);
+    let size = file.metadata().expect(path).len() as usize;
+    let n = size / std::mem::size_of::<T>();
+    if n == 0 {
+        return &[];
+    }
+    // PROT_READ, MAP_PRIVATE
+    let p = unsafe { mmap(std::ptr::null_mut(), size, 1, 2, file.as_raw_fd(), 0) };
+    if p as isize == -1 {
+        panic!("can't map {}", path);
+    }
+    unsafe { std::slice::from_raw_parts(p as *const T, n) }
+}
+"""
+
+rust_declaration = """    #[allow(unused_variables)]
+    let $name: &'static [$type] = itcc_map::<$type>("$path");
+    #[allow(unused_variables)]
+    let $name_cols: usize = $cols;
+"""
+
+zig_runtime = """
+fn itcc_map(comptime T: type, path: []const u8) []const T {
+    const file = std.fs.openFileAbsolute(path, .{}) catch @panic("can't open data file");
+    defer file.close();
+    const size = file.getEndPos() catch @panic("can't size data file");
+    if (size < @sizeOf(T)) return &[_]T{};
+    const bytes = std.os.mmap(null, size, std.os.PROT.READ, std.os.MAP.PRIVATE,
+        file.handle, 0) catch @panic("can't map data file");
+    return @as([*]const T, @ptrCast(@alignCast(bytes.ptr)))[0 .. size / @sizeOf(T)];
+}
+"""
+
+zig_declaration = """var $name: []const $type = &[_]$type{};
+const $name_cols: usize = $cols;
+"""
+
+zig_assignment = """    $name = itcc_map($type, "$path");
+"""
+
+class Mapping:
+
+    def __init__( self, source, path, typ, cols ):
+        self.source = source
+        self.path = path
+        self.typ = typ
+        self.cols = cols
+
+    def fill( self, template ):
+        return ( template.replace( "$name_len", self.name + "_len" )
+            .replace( "$name_cols", self.name + "_cols" )
+            .replace( "$name", self.name )
+            .replace( "$ctype", types[self.typ][0] )
+            .replace( "$type", self.typ )
+            .replace( "$cols", str( self.cols ) )
+            .replace( "$path", self.path.replace( "\\", "\\\\" )
+                .replace( '"', '\\"' ) ) )
+
+class DataMaps:
+
+    def __init__( self ):
+        self.maps = collections.OrderedDict()
+
+    def __len__( self ):
+        return len( self.maps )
+
+    def add( self, name, path, typ = "u8" ):
+        """Raises ValueError for a bad name, type or CSV, OSError if the
+        file can't be read."""
+        if not name_re.match( name ):
+            raise ValueError( "'%s' is not a name" % name )
+        if typ not in types:
+            raise ValueError( "type must be one of " + ", ".join( types ) )
+        source = os.path.abspath( os.path.expanduser( path ) )
+        if source.lower().endswith( ".csv" ):
+            path, cols = convert_csv( source, typ )
+        else:
+            os.stat( source )
+            path, cols = source, 1
+        mapping = Mapping( source, path, typ, cols )
+        mapping.name = name
+        self.maps.pop( name, None )
+        self.maps[name] = mapping
+        return mapping
+
+    def dump( self ):
+        """What .save keeps: the name, file and type of each mapping."""
+        return [ [ name, m.source, m.typ ] for name, m in self.maps.items() ]
+
+    def remove( self, name ):
+        return self.maps.pop( name, None ) is not None
+
+    def describe( self ):
+        if not self.maps:
+            return "[No data. Map a file with .data name path [type].]"
+        return "\n".join( "%s = %s (%s%s)" % ( name, m.source, m.typ,
+            ", %d columns" % m.cols if m.path != m.source else "" )
+            for name, m in self.maps.items() )
+
+    def c_source( self ):
+        if not self.maps:
+            return ""
+        return c_runtime + "".join( m.fill( c_declaration )
+            for m in self.maps.values() )
+
+    def rust_source( self ):
+        """The helper for the includes section, and the lets for main."""
+        if not self.maps:
+            return "", ""
+        return rust_runtime, "".join( m.fill( rust_declaration )
+            for m in self.maps.values() )
+
+    def zig_source( self ):
+        """The declarations, and the assignments for the top of main."""
+        if not self.maps:
+            return "", ""
+        return ( zig_runtime + "".join( m.fill( zig_declaration )
+            for m in self.maps.values() ), "".join( m.fill( zig_assignment )
+            for m in self.maps.values() ) )
+
+def parse( arg ):
+    """name, path and type from what followed .data.  The path may have
+    spaces in it, and may be quoted."""
+    words = arg.split( None, 1 )
+    if len( words ) < 2:
+        raise ValueError( "say .data name path [type]" )
+    name, path = words
+    typ = "u8"
+    words = path.rsplit( None, 1 )
+    if len( words ) == 2 and words[1] in types:
+        path, typ = words
+    if len( path ) >= 2 and path[0] == path[-1] and path[0] in "\"'":
+        path = path[1:-1]
+    return name, path, typ
+
+def number( text, typ ):
+    if typ in ( "f32", "f64" ):
+        return float( text )
+    return int( float( text ) )
+
+def convert_csv( source, typ ):
+    """The numeric columns of a CSV file as a binary file of typ, made
+    once and kept until the CSV changes.  Returns its path and the
+    number of columns."""
+    st = os.stat( source )
+    h = hashlib.sha256( ( "%s\0%d\0%d\0%s" % ( source, st.st_mtime_ns,
+        st.st_size, typ ) ).encode() ).hexdigest()[:24]
+    directory = workspace.user_cache( "data" )
+    path = os.path.join( directory, h + "." + typ )
+    cols_path = path + ".cols"
+    if os.path.isfile( path ) and os.path.isfile( cols_path ):
+        with open( cols_path ) as f:
+            return path, int( f.read() )
+
+    columns = None
+    tmp = "%s.%d.tmp" % ( path, os.getpid() )
+    with open( source, newline = "" ) as f, open( tmp, "wb" ) as out:
+        for row_num, row in enumerate( csv.reader( f ), 1 ):
+            if not row:
+                continue
+            if columns is None:
+                # the first row that has numbers decides which columns do;
+                # a header before it is skipped
+                columns = []
+                for i, field in enumerate( row ):
+                    try:
+                        number( field, typ )
+                        columns.append( i )
+                    except ValueError:
+                        pass
+                if not columns:
+                    columns = None
+                    continue
+            values = array.array( types[typ][1] )
+            try:
+                values.extend( number( row[i], typ ) for i in columns )
+            except ( ValueError, IndexError, OverflowError ):
+                os.remove( tmp )
+                raise ValueError( "row %d of %s doesn't fit" % ( row_num,
+                    source ) )
+            values.tofile( out )
+    if columns is None:
+        os.remove( tmp )
+        raise ValueError( "no numeric columns in " + source )
+    os.replace( tmp, path )
+    with open( cols_path, "w" ) as f:
+        f.write( str( len( columns ) ) )
+    return path, len( columns )
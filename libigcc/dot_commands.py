@@ -17,8 +17,13 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301, USA.
 
+from . import arena
 from . import source_code
 from . import copying
+from . import rusage
+from . import session
+from . import probes
+from . import datamap
 import subprocess
 
 docs_url = 'https://www.open-std.org/jtc1/sc22/wg14/www/docs/n1570.pdf'
@@ -32,10 +37,48 @@ def highlight( code ):
     stdout, stderr = print_proc.communicate(code.encode())
     print(stdout.decode("utf-8").strip())
 
+def dot_add( runner, path ):
+    try:
+        runner.units.add( path )
+    except ( OSError, ValueError ) as e:
+        print("[Could not add '%s': %s.]" % ( path, e ))
+        return False, False
+    print("[Added '%s'.]" % path)
+    # build it now, so that any errors show up straight away
+    return False, True
+
+def dot_arena( runner, arg ):
+    if not arg.startswith( "-" ):
+        print(arena.describe( runner ))
+    elif arena.free( runner, arg[1:] ):
+        print("[Freed '%s'.]" % arg[1:])
+    else:
+        print("[No buffer '%s'.]" % arg[1:])
+    return False, False
+
 def dot_c( runner ):
     print(copying.copying)
     return False, False
 
+def dot_data( runner, arg ):
+    if not arg:
+        print(runner.data_maps.describe())
+        return False, False
+    if arg.startswith( "-" ):
+        if runner.data_maps.remove( arg[1:] ):
+            print("[Removed '%s'.]" % arg[1:])
+            return False, True
+        print("[No data '%s'.]" % arg[1:])
+        return False, False
+    try:
+        name, path, typ = datamap.parse( arg )
+        mapping = runner.data_maps.add( name, path, typ )
+    except ( OSError, ValueError ) as e:
+        print("[Could not map '%s': %s.]" % ( arg.split()[0], e ))
+        return False, False
+    print("[Mapped '%s' as %s.]" % ( name, mapping.typ ))
+    return False, True
+
 def dot_e( runner ):
     if runner is not None and hasattr(runner.compile_error, "decode"):
         print(runner.compile_error.decode().strip('\n'))
@@ -61,11 +104,25 @@ def dot_g( runner ):
     run_process.wait()
     return False, False
 
+def dot_load( runner, name ):
+    try:
+        ready = session.load( runner, name )
+    except ( OSError, ValueError, KeyError ) as e:
+        print("[Could not load '%s': %s.]" % ( name, e ))
+        return False, False
+    # without its program we have to rebuild to know what is printed
+    runner.resync = not ready and runner.input_num > 0
+    print("[Loaded '%s', %d lines.]" % ( name, runner.input_num ))
+    return False, False
+
 def dot_q( runner ):
     raise IGCCQuitException()
 
 def dot_l( runner ):
-    highlight("%s\n\n    %s" % ( runner.get_user_includes_string().strip(), runner.get_user_commands_string().strip() ))
+    commands = runner.get_user_commands_string()
+    if runner.options.time_statements:
+        commands = probes.get_annotated_commands_string( runner )
+    highlight("%s\n\n    %s" % ( runner.get_user_includes_string().strip(), commands.strip() ))
     return False, False
 
 def dot_L( runner ):
@@ -81,6 +138,35 @@ def dot_r( runner ):
         print("[Nothing to redo.]")
         return False, False
 
+def dot_save( runner, name ):
+    try:
+        session.save( runner, name )
+    except ( OSError, ValueError ) as e:
+        print("[Could not save '%s': %s.]" % ( name, e ))
+        return False, False
+    print("[Saved '%s'.]" % name)
+    return False, False
+
+def dot_stats( runner ):
+    print(rusage.format_usage( "compile", runner.compile_usage ))
+    print(rusage.format_usage( "run", runner.run_usage ))
+    print("cache: %d hits, %d misses" % ( runner.cache.hits,
+        runner.cache.misses ))
+    return False, False
+
+def dot_jobs( runner ):
+    print(runner.jobs.describe())
+    return False, False
+
+def dot_kill( runner ):
+    if runner.jobs.kill() is None:
+        print("[No jobs running.]")
+    return False, False
+
+def dot_t( runner ):
+    print(rusage.format_timings( runner ))
+    return False, False
+
 def dot_u( runner ):
     undone_line = runner.undo()
     if undone_line is not None:
@@ -100,16 +186,25 @@ def dot_w( runner ):
     return False, False
 
 dot_commands = {
+    ".add file" : ( "Compile file separately and link it in", None ),
+    ".arena [-name]" : ( "List session_alloc buffers, or free one", None ),
     ".c" : ( "Show copying information", dot_c ),
+    ".data name path [type]" : ( "Map a file in as an array", None ),
     ".e" : ( "Show the last compile errors/warnings", dot_e ),
     ".f" : ( "Function or top-level declaration", dot_f ),
     ".g" : ( "Get list of c libraries to show man pages about", dot_g ),
     ".h" : ( "Show this help message", None ),
     ".q" : ( "Quit", dot_q ),
+    ".jobs" : ( "Show the compile or run still going", dot_jobs ),
+    ".kill" : ( "Stop the compile or run still going", dot_kill ),
     ".l" : ( "List the code you have entered", dot_l ),
     ".L" : ( "List the C code fed to the compiler", dot_L ),
     ".m [lib]" : ( "Show man page about [cmd or lib]", None ),
+    ".load name" : ( "Load a saved session", None ),
     ".r" : ( "Redo undone command", dot_r ),
+    ".save name" : ( "Save this session", None ),
+    ".stats" : ( "Show resource usage of the last compile and run", dot_stats ),
+    ".t" : ( "Show how long the last compile and run took", dot_t ),
     ".u" : ( "Undo previous command", dot_u ),
     ".v" : ( "View Online Documentation", dot_v ),
     ".w" : ( "Show warranty information", dot_w ),
@@ -126,6 +221,16 @@ def dot_h( runner ):
 def process( inp, runner ):
     if inp == ".h":
         return dot_h( runner )
+    elif inp == ".data" or inp[:6] == ".data ":
+        return dot_data( runner, inp[6:].strip() )
+    elif inp == ".arena" or inp[:7] == ".arena ":
+        return dot_arena( runner, inp[7:].strip() )
+    elif inp[:5] == ".add ":
+        return dot_add( runner, inp[5:].strip() )
+    elif inp[:6] == ".save ":
+        return dot_save( runner, inp[6:].strip() )
+    elif inp[:6] == ".load ":
+        return dot_load( runner, inp[6:].strip() )
     elif inp[:3] == ".m ":
         view = f"man {inp[3:]}|highlight -S c -O xterm256 -"
         run_process = subprocess.Popen(view, shell=True)
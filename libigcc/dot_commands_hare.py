@@ -19,6 +19,8 @@
 
 from . import source_code_hare as source_code
 from . import copying
+from . import rusage
+from . import session
 import subprocess
 
 docs_url = 'https://harelang.org/tutorial'
@@ -61,6 +63,17 @@ def dot_g( runner ):
     run_process.wait()
     return False, False
 
+def dot_load( runner, name ):
+    try:
+        ready = session.load( runner, name )
+    except ( OSError, ValueError, KeyError ) as e:
+        print("[Could not load '%s': %s.]" % ( name, e ))
+        return False, False
+    # without its program we have to rebuild to know what is printed
+    runner.resync = not ready and runner.input_num > 0
+    print("[Loaded '%s', %d lines.]" % ( name, runner.input_num ))
+    return False, False
+
 def dot_q( runner ):
     raise IGCCQuitException()
 
@@ -81,6 +94,35 @@ def dot_r( runner ):
         print("[Nothing to redo.]")
         return False, False
 
+def dot_save( runner, name ):
+    try:
+        session.save( runner, name )
+    except ( OSError, ValueError ) as e:
+        print("[Could not save '%s': %s.]" % ( name, e ))
+        return False, False
+    print("[Saved '%s'.]" % name)
+    return False, False
+
+def dot_stats( runner ):
+    print(rusage.format_usage( "compile", runner.compile_usage ))
+    print(rusage.format_usage( "run", runner.run_usage ))
+    print("cache: %d hits, %d misses" % ( runner.cache.hits,
+        runner.cache.misses ))
+    return False, False
+
+def dot_jobs( runner ):
+    print(runner.jobs.describe())
+    return False, False
+
+def dot_kill( runner ):
+    if runner.jobs.kill() is None:
+        print("[No jobs running.]")
+    return False, False
+
+def dot_t( runner ):
+    print(rusage.format_timings( runner ))
+    return False, False
+
 def dot_u( runner ):
     undone_line = runner.undo()
     if undone_line is not None:
@@ -108,10 +150,16 @@ dot_commands = {
     ".h [lib]" : ( "Show help about hare [lib]", None ),
     ".s" : ( "Show list of lib names to use", None ),
     ".q" : ( "Quit", dot_q ),
+    ".jobs" : ( "Show the compile or run still going", dot_jobs ),
+    ".kill" : ( "Stop the compile or run still going", dot_kill ),
     ".l" : ( "List the code you have entered", dot_l ),
     ".L" : ( "List the whole program as given to the compiler", dot_L ),
     ".m [lib]" : ( "Show man page about [cmd or lib]", None ),
+    ".load name" : ( "Load a saved session", None ),
     ".r" : ( "Redo undone command", dot_r ),
+    ".save name" : ( "Save this session", None ),
+    ".stats" : ( "Show resource usage of the last compile and run", dot_stats ),
+    ".t" : ( "Show how long the last compile and run took", dot_t ),
     ".u" : ( "Undo previous command", dot_u ),
     ".v" : ( "View Online Documentation", dot_v ),
     ".w" : ( "Show warranty information", dot_w ),
@@ -150,6 +198,10 @@ Type '.h time' for help about time.
 Type '.h time::date' for submodule date.
 """)
         return False, False
+    elif inp[:6] == ".save ":
+        return dot_save( runner, inp[6:].strip() )
+    elif inp[:6] == ".load ":
+        return dot_load( runner, inp[6:].strip() )
     elif inp[:3] == ".m ":
         view = f"man {inp[3:]}|highlight -S c -O xterm256 -"
         run_process = subprocess.Popen(view, shell=True)
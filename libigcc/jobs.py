@@ -0,0 +1,264 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# Compile-and-run cycles as jobs that can be killed without losing the
+# session.
+#
+# Every compiler and program we start gets a session (and so a process
+# group) of its own, so the terminal's Ctrl-C reaches only us, and we
+# kill the job's process groups ourselves.  At an interactive prompt a
+# cycle runs in a thread.  If it is done within foreground_wait seconds
+# it looks just like before; otherwise we hand the prompt back, and the
+# job prints its results over the prompt when it finishes.  Typing a new
+# line, undo or redo kills the running job: the next cycle rebuilds
+# everything anyway.  From files, --jsonl and iserver, cycles run inline.
+
+import atexit
+import contextlib
+import io
+import os
+import signal
+import sys
+import threading
+import time
+
+from . import rusage
+
+local = threading.local()
+live = set()
+
+# commands that leave a running job alone; anything else kills it first
+keep_running = ( ".jobs", ".kill", ".stats", ".t", ".e", ".h", ".l", ".L" )
+
+class ThreadLocalFile:
+    """Stands in for sys.stdout and sys.stdin so that print() and input()
+    in a thread reach the place that thread was given."""
+
+    def __init__( self, default ):
+        self.default = default
+        self.local = threading.local()
+
+    def set( self, target ):
+        self.local.target = target
+
+    def target( self ):
+        return getattr( self.local, "target", None ) or self.default
+
+    def write( self, text ):
+        return self.target().write( text )
+
+    def flush( self ):
+        self.target().flush()
+
+    def readline( self, *args ):
+        return self.target().readline( *args )
+
+    def fileno( self ):
+        # input() only uses readline when this is the terminal
+        return self.target().fileno()
+
+class Popen( rusage.Popen ):
+
+    def __init__( self, *args, **kwargs ):
+        kwargs.setdefault( "start_new_session", True )
+        super().__init__( *args, **kwargs )
+        job = getattr( local, "job", None )
+        if job is not None:
+            job.adopt( self )
+
+@contextlib.contextmanager
+def quiet():
+    """Throw away whatever this thread prints."""
+    if isinstance( sys.stdout, ThreadLocalFile ):
+        old = getattr( sys.stdout.local, "target", None )
+        sys.stdout.set( io.StringIO() )
+        try:
+            yield
+        finally:
+            sys.stdout.set( old )
+    else:
+        with contextlib.redirect_stdout( io.StringIO() ):
+            yield
+
+def cancelled():
+    """True if the job running in this thread has been killed, in which
+    case whatever it was about to print or record is stale."""
+    job = getattr( local, "job", None )
+    return job is not None and job.cancelled
+
+class Job:
+
+    def __init__( self, number ):
+        self.number = number
+        self.started = time.monotonic()
+        self.processes = []
+        self.output = io.StringIO()
+        self.cancelled = False
+        self.finished = False
+        self.background = False
+        self.done = threading.Event()
+
+    def adopt( self, process ):
+        self.processes.append( process )
+        if self.cancelled:
+            self.kill()
+
+    def describe( self ):
+        what = "starting"
+        if self.processes:
+            what = str( self.processes[-1].args[0] )
+            # memexec programs run from /proc/<pid>/fd/<n>
+            what = "program" if what.startswith( "/proc/" ) \
+                else os.path.basename( what )
+        return "%d  %s  %.1f s" % ( self.number, what,
+            time.monotonic() - self.started )
+
+    def reap( self ):
+        for p in self.processes:
+            if p.returncode is None:
+                p.wait()
+
+    def kill( self ):
+        self.cancelled = True
+        for p in list( self.processes ):
+            if p.returncode is None:
+                try:
+                    os.killpg( p.pid, signal.SIGKILL )
+                except ( ProcessLookupError, PermissionError ):
+                    pass
+
+class JobControl:
+
+    def __init__( self, prompt = "" ):
+        self.prompt = prompt
+        self.foreground_wait = None
+        self.current = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def running( self ):
+        job = self.current
+        if job is not None and not job.finished:
+            return job
+        return None
+
+    def cancel( self ):
+        """Kill the running job, if any, and wait for it to go away."""
+        job = self.running()
+        if job is not None:
+            job.kill()
+            job.done.wait()
+        return job
+
+    def kill( self ):
+        job = self.cancel()
+        if job is not None:
+            print("[Killed job %d. Type .u to drop the line that started it.]"
+                % job.number)
+        return job
+
+    def run( self, cycle ):
+        self.cancel()
+        self.count += 1
+        job = Job( self.count )
+        self.current = job
+        live.add( job )
+        if self.foreground_wait is None:
+            self.run_inline( job, cycle )
+        else:
+            self.run_thread( job, cycle )
+
+    def run_inline( self, job, cycle ):
+        local.job = job
+        try:
+            cycle()
+        except KeyboardInterrupt:
+            job.kill()
+            job.reap()
+            print("[Interrupted - killed job %d. Type .u to drop the line that "
+                "started it.]" % job.number)
+        finally:
+            local.job = None
+            job.finished = True
+            job.done.set()
+            live.discard( job )
+
+    def run_thread( self, job, cycle ):
+        if not isinstance( sys.stdout, ThreadLocalFile ):
+            sys.stdout = ThreadLocalFile( sys.stdout )
+        thread = threading.Thread( target = self.job_thread,
+            args = ( job, cycle ), daemon = True )
+        thread.start()
+        try:
+            job.done.wait( self.foreground_wait )
+        except KeyboardInterrupt:
+            job.kill()
+            job.done.wait()
+            print("[Interrupted - killed job %d. Type .u to drop the line that "
+                "started it.]" % job.number)
+            return
+        with self.lock:
+            if job.finished:
+                sys.stdout.write( job.output.getvalue() )
+            else:
+                job.background = True
+                print("[Job %d is still running - keep typing, .jobs lists it, "
+                    ".kill stops it.]" % job.number)
+
+    def job_thread( self, job, cycle ):
+        local.job = job
+        sys.stdout.set( job.output )
+        try:
+            cycle()
+        except Exception as e:
+            print(e)
+        finally:
+            sys.stdout.set( None )
+            local.job = None
+            live.discard( job )
+            with self.lock:
+                job.finished = True
+                if job.background and not job.cancelled:
+                    self.report( job )
+            job.done.set()
+
+    def report( self, job ):
+        # print over the prompt, then put the prompt and the half-typed
+        # line back
+        try:
+            import readline
+            line = readline.get_line_buffer()
+        except ImportError:
+            line = ""
+        sys.stdout.write( "\r\033[K[Job %d done.]\n%s%s%s" % ( job.number,
+            job.output.getvalue(), self.prompt, line ) )
+        sys.stdout.flush()
+
+    def describe( self ):
+        job = self.running()
+        if job is None:
+            return "[No jobs running.]"
+        return job.describe()
+
+def kill_all():
+    for job in list( live ):
+        job.kill()
+
+atexit.register( kill_all )
@@ -0,0 +1,133 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# --jsonl: one JSON request per input line, one JSON response per output
+# line, for editors and scripts that don't want to scrape prompts.
+#
+# A request is a JSON string (the line to type) or an object:
+#
+#   {"id": 7, "input": "int a = 5;"}
+#   {"id": 8, "op": "undo"}
+#   {"id": 9, "input": ".f", "lines": ["int twice( int x ) {", "..."]}
+#
+# "lines" answers anything the command reads from stdin, like the body
+# .f asks for.  The response echoes "id" and carries the new stdout and
+# stderr of the program, the compiler diagnostics, whether the program
+# came out of the artifact cache, and how long compiling and running
+# took.  "text" is what the terminal session would have printed.
+
+import io
+import json
+import sys
+from contextlib import redirect_stdout
+
+ops = {
+    "undo" : ".u",
+    "redo" : ".r",
+    "quit" : ".q",
+    }
+
+def decode( data ):
+    if isinstance( data, bytes ):
+        return data.decode( errors = "replace" )
+    return data
+
+def get_timings( runner, compiled, run_usage ):
+    timings = {}
+    if compiled and runner.compile_usage is not None:
+        timings["compile_s"] = round( runner.compile_usage.wall, 6 )
+    if runner.run_usage is not None and runner.run_usage is not run_usage:
+        timings["run_s"] = round( runner.run_usage.wall, 6 )
+    if runner.options.time_statements:
+        timings["statements"] = [ { "input" : a.inp.strip(), "ns" : a.cost }
+            for a in runner.get_user_input() if a.cost is not None ]
+    return timings
+
+def handle( runner, request ):
+    if isinstance( request, str ):
+        request = { "input" : request }
+    elif not isinstance( request, dict ):
+        request = {}
+    inp = request.get( "input" )
+    if inp is None:
+        inp = ops.get( request.get( "op" ) )
+    if not isinstance( inp, str ):
+        return { "id" : request.get( "id" ), "ok" : False,
+            "error" : "request needs an 'input' line or an 'op' of: %s" %
+                ", ".join( ops ) }
+
+    run_usage = runner.run_usage
+    text = io.StringIO()
+    error = None
+    quit = False
+    stdin = sys.stdin
+    sys.stdin = io.StringIO( "".join( line + "\n"
+        for line in request.get( "lines", () ) ) )
+    try:
+        with redirect_stdout( text ):
+            runner.process_line( inp )
+    except Exception as e:
+        # .q raises IGCCQuitException
+        if type( e ).__name__ == "IGCCQuitException":
+            quit = True
+        else:
+            error = str( e )
+    finally:
+        sys.stdin = stdin
+
+    compiled = runner.cache_status is not None
+    diagnostics = None
+    if compiled and runner.compile_error is not None:
+        diagnostics = decode( runner.compile_error )
+    response = {
+        "id" : request.get( "id" ),
+        "input" : inp,
+        "ok" : error is None and diagnostics is None,
+        "stdout" : runner.new_output,
+        "stderr" : runner.new_error,
+        "text" : text.getvalue(),
+        "compiled" : compiled,
+        "diagnostics" : diagnostics,
+        "cache" : runner.cache_status,
+        "timings" : get_timings( runner, compiled, run_usage ),
+        "input_num" : runner.input_num,
+        }
+    if error is not None:
+        response["error"] = error
+    if quit:
+        response["quit"] = True
+    return response
+
+def serve( runner, session_args, infile = None, outfile = None ):
+    infile = infile or runner.inputfile or sys.stdin
+    outfile = outfile or sys.stdout
+    runner.start( session_args )
+    for line in infile:
+        if not line.strip():
+            continue
+        try:
+            response = handle( runner, json.loads( line ) )
+        except json.JSONDecodeError as e:
+            response = { "id" : None, "ok" : False,
+                "error" : "bad request: %s" % e }
+        outfile.write( json.dumps( response ) + "\n" )
+        outfile.flush()
+        if response.get( "quit" ):
+            break
@@ -0,0 +1,237 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+
+# Pick the quickest way to link igcc's and irust's programs.
+#
+# Every line relinks the program, and the system ld is slow at it.  If
+# mold, lld or gold are installed and the compiler can drive them, we
+# time a small program with each and keep the fastest.  Then we try it
+# linked statically and dynamically: dynamic links are quicker, static
+# programs start quicker, and since every cycle links once and runs once
+# it is the sum that counts.  That is measured in the background while
+# the first session with a new toolchain uses the compiler's defaults,
+# and the answer is kept in ~/.cache/itcc per compiler binary for the
+# sessions after it.  The sample links no libraries, though, and some only
+# come shared: igcc links dynamically when the session links libraries
+# of its own, or when a static link fails.
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from . import workspace
+
+linkers = {
+    "gcc" : ( "mold", "lld", "gold" ),
+    # rustc warns that gold is buggy with rust
+    "rustc" : ( "mold", "lld" ),
+    }
+trials = 3
+# bump to throw away answers measured by older code
+version = 2
+
+samples = {
+    "gcc" : ( [ "-x", "c++" ], "#include <cstdio>\n"
+        "int main(){ puts( \"hi\" ); return 0; }\n" ),
+    "rustc" : ( [], "fn main(){ println!(\"hi\"); }\n" ),
+    }
+
+chosen = {}
+lock = threading.Lock()
+
+class Strategy:
+
+    def __init__( self, style, linker = None, static = None, measured = False ):
+        self.style = style
+        self.linker = linker
+        # None: whatever the compiler does by default
+        self.static = static
+        self.measured = measured
+
+    def args( self ):
+        ret = []
+        if self.style == "gcc":
+            if self.linker is not None:
+                ret.append( "-fuse-ld=" + self.linker )
+            if self.static:
+                ret.append( "-static" )
+        else:
+            if self.linker is not None:
+                ret += [ "-C", "link-arg=-fuse-ld=" + self.linker ]
+            if self.static is False:
+                ret += [ "-C", "prefer-dynamic" ]
+                libdir = rust_libdir()
+                if libdir is not None:
+                    ret += [ "-C", "link-arg=-Wl,-rpath," + libdir ]
+        return ret
+
+    def dynamic( self ):
+        """This strategy, but linking dynamically."""
+        return Strategy( self.style, self.linker, False, self.measured )
+
+    def __str__( self ):
+        linkage = { None : "default", True : "static", False : "dynamic" }
+        return "%s, %s linking%s" % ( self.linker or "system linker",
+            linkage[self.static], " (measured)" if self.measured else "" )
+
+def link_failed( compile_error ):
+    # from collect2, whichever linker gcc drove
+    return isinstance( compile_error, bytes ) and b"ld returned" in compile_error
+
+def rust_libdir():
+    # where libstd-*.so is
+    try:
+        libdir = subprocess.run( [ "rustc", "--print", "target-libdir" ],
+            capture_output = True, text = True ).stdout.strip()
+    except OSError:
+        return None
+    return libdir or None
+
+def cache_file():
+    return os.path.join( workspace.user_cache(), "linker.json" )
+
+def toolchain( compiler ):
+    # rustc is often a rustup proxy, so ask it what it really is
+    path = shutil.which( compiler )
+    if path is None:
+        return None
+    try:
+        version = subprocess.run( [ path, "--version" ], capture_output = True,
+            text = True ).stdout.split( "\n" )[0]
+    except OSError:
+        version = ""
+    return "%s %d %s" % ( os.path.realpath( path ), os.stat( path ).st_mtime_ns,
+        version )
+
+def choose( style, compiler, setting = "auto" ):
+    """The Strategy to link with.  setting is "auto" to measure (or look
+    up) the best one, "default" to leave the compiler alone, or the name
+    of a linker to use."""
+    if setting == "default":
+        return Strategy( style )
+    if setting != "auto":
+        return Strategy( style, setting )
+    with lock:
+        if ( style, compiler ) not in chosen:
+            key = "%s %s %d" % ( style, toolchain( compiler ), version )
+            strategy = lookup( key )
+            if strategy is None:
+                # measuring takes a dozen builds, too long to keep the
+                # user from their prompt
+                sys.stderr.write( "[Timing the linkers in the background;"
+                    " the fastest will be used once that is done.]\n" )
+                threading.Thread( target = measure_and_save,
+                    args = ( key, style, compiler ), daemon = True ).start()
+                strategy = Strategy( style )
+            chosen[style, compiler] = strategy
+        return chosen[style, compiler]
+
+def lookup( key ):
+    try:
+        with open( cache_file() ) as f:
+            data = json.load( f )[key]
+        return Strategy( data["style"], data["linker"], data["static"], True )
+    except ( OSError, ValueError, KeyError ):
+        return None
+
+def measure_and_save( key, style, compiler ):
+    strategy = measure( style, compiler )
+    filename = cache_file()
+    try:
+        os.makedirs( os.path.dirname( filename ), exist_ok = True )
+        try:
+            with open( filename ) as f:
+                data = json.load( f )
+        except ( OSError, ValueError ):
+            data = {}
+        data[key] = { "style" : strategy.style, "linker" : strategy.linker,
+            "static" : strategy.static }
+        tmpname = "%s.%d" % ( filename, os.getpid() )
+        with open( tmpname, "w" ) as f:
+            json.dump( data, f )
+        os.replace( tmpname, filename )
+    except OSError:
+        pass
+    with lock:
+        # for the sessions that start after this
+        chosen[style, compiler] = strategy
+    return strategy
+
+def measure( style, compiler ):
+    directory = tempfile.mkdtemp( prefix = "itcc-link-" )
+    try:
+        best, best_time = Strategy( style, static = None ), None
+        for linker in ( None, ) + linkers[style]:
+            if linker is not None and shutil.which( "ld." + linker ) is None \
+                    and shutil.which( linker ) is None:
+                continue
+            t = build_time( Strategy( style, linker ), compiler, directory )
+            if t is not None and ( best_time is None or t < best_time ):
+                best, best_time = Strategy( style, linker ), t
+        costs = []
+        for static in ( False, True ):
+            strategy = Strategy( style, best.linker, static )
+            t = build_time( strategy, compiler, directory )
+            r = run_time( directory ) if t is not None else None
+            if r is not None:
+                costs.append( ( t + r, static ) )
+        if costs:
+            best.static = min( costs )[1]
+        best.measured = True
+        return best
+    finally:
+        shutil.rmtree( directory, ignore_errors = True )
+
+def build_time( strategy, compiler, directory ):
+    flags, source = samples[strategy.style]
+    exefilename = os.path.join( directory, "sample" )
+    command = [ compiler ] + flags + [ "-o", exefilename, "-" ] + strategy.args()
+    times = []
+    for i in range( trials ):
+        start = time.monotonic()
+        try:
+            process = subprocess.run( command, input = source.encode(),
+                capture_output = True )
+        except OSError:
+            return None
+        if process.returncode != 0:
+            return None
+        times.append( time.monotonic() - start )
+    return min( times )
+
+def run_time( directory ):
+    times = []
+    for i in range( trials ):
+        start = time.monotonic()
+        try:
+            process = subprocess.run( [ os.path.join( directory, "sample" ) ],
+                capture_output = True )
+        except OSError:
+            return None
+        if process.returncode != 0:
+            return None
+        times.append( time.monotonic() - start )
+    return min( times )
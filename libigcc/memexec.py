@@ -0,0 +1,50 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# Build and run programs in anonymous memory files (Linux memfd).
+#
+# The compiler is told to write to /proc/<our pid>/fd/<n>, which opens
+# our memfd, and the program is run from the same path.  Nothing is ever
+# created, renamed or unlinked on a filesystem.  gcc and tcc write their
+# -o file in place, so this works for them; compilers that write a temp
+# file and rename it over the output (rustc) can't, and are caught by
+# the caller, which goes back to a plain file.
+
+import os
+
+def available():
+    return hasattr( os, "memfd_create" ) and os.path.isdir( "/proc/self/fd" )
+
+class MemFile:
+
+    def __init__( self, name ):
+        self.fd = os.memfd_create( name, os.MFD_CLOEXEC )
+        self.path = "/proc/%d/fd/%d" % ( os.getpid(), self.fd )
+
+    def close( self ):
+        if self.fd is not None:
+            os.close( self.fd )
+            self.fd = None
+
+def output_command( command, exefilename, memfile ):
+    """command, writing to memfile instead of exefilename."""
+    if memfile is None:
+        return command
+    return [ memfile.path if part == exefilename else part for part in command ]
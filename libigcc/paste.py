@@ -0,0 +1,62 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+
+# One compile for a burst of pasted lines.
+#
+# Pasting ten lines used to mean ten compiles, most of them of code that
+# was only half there.  When the terminal has more input waiting the
+# moment we have read a line, or readline hands us several lines at once
+# (bracketed paste), the lines still go into the history one at a time,
+# so .u works on each of them, but the program is built and run once,
+# after the last.  Its output is counted against the burst as a whole;
+# undoing into a burst rebuilds quietly to find out how much of it the
+# remaining lines print.
+
+import select
+import sys
+
+# how long a pasted line may take to follow the one before it
+settle_time = 0.01
+
+def pending( infile = None, timeout = settle_time ):
+    """True if there is more input waiting to be read already."""
+    infile = infile or sys.stdin
+    try:
+        ready, _, _ = select.select( [ infile ], [], [], timeout )
+    except ( OSError, ValueError ):
+        return False
+    return bool( ready )
+
+def split( inp ):
+    """The lines of a bracketed paste, each with its own history entry."""
+    lines = [ line for line in inp.split( "\n" ) if line.strip() ]
+    if len( lines ) < 2:
+        return [ inp ]
+    try:
+        import readline
+        n = readline.get_current_history_length()
+        if n > 0 and readline.get_history_item( n ) == inp:
+            readline.remove_history_item( n - 1 )
+        for line in lines:
+            readline.add_history( line )
+    except ImportError:
+        pass
+    return lines
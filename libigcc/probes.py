@@ -0,0 +1,145 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# Per-statement timing probes.
+#
+# With --time-statements, get_full_source() puts a call to a tiny
+# runtime between the statements of main().  The runtime writes
+# "<statement number> <nanoseconds>" lines to the file descriptor
+# named by $ITCC_TIMING_FD, so the program's own stdout is untouched.
+
+import os
+import tempfile
+
+timing_fd_env = "ITCC_TIMING_FD"
+
+# same value as UserInput.COMMAND in the run modules
+COMMAND = 1
+
+# lines starting with these continue the previous statement
+continuations = ( "else", "while", "catch", ".", ")", ";", "?" )
+# nothing may follow these (zig rejects unreachable code)
+terminators = ( "return", "break", "continue", "unreachable", "goto" )
+# lines ending with these are not finished statements in go
+go_open_ends = ( ",", "(", "{", "[", "+", "-", "*", "/", "&", "|", "=", "." )
+
+def scan_line( line, depth ):
+    """Return the new bracket depth and the line without comments."""
+    code = []
+    quote = None
+    i = 0
+    while i < len( line ):
+        c = line[i]
+        if quote is not None:
+            if c == "\\":
+                i += 1
+            elif c == quote:
+                quote = None
+        elif line.startswith( "//", i ):
+            break
+        elif line.startswith( "/*", i ):
+            end = line.find( "*/", i + 2 )
+            if end < 0:
+                break
+            i = end + 2
+            continue
+        elif c == '"' or c == '`':
+            quote = c
+        elif c == "'":
+            # char literal, not a rust lifetime
+            end = line.find( "'", i + 1 )
+            if 0 < end - i <= 5:
+                code.append( line[i:end + 1] )
+                i = end + 1
+                continue
+        elif c in "({[":
+            depth += 1
+        elif c in ")}]":
+            depth -= 1
+        code.append( c )
+        i += 1
+    return depth, "".join( code ).strip()
+
+def is_boundary( code, next_line, style ):
+    if not code or code.startswith( "#" ):
+        return False
+    if code.split( None, 1 )[0].rstrip( ";" ) in terminators:
+        return False
+    if next_line is not None and next_line.lstrip().startswith( continuations ):
+        return False
+    if style == "go":
+        return not code.endswith( go_open_ends )
+    return code.endswith( ";" ) or code.endswith( "}" )
+
+def get_instrumented_commands_string( runner, probe, style = "c" ):
+    # The probe number is the statement's index in runner.user_input, so
+    # the timings can be stored straight back on the UserInput objects.
+    commands = [ ( num, a.inp ) for num, a in enumerate( runner.get_user_input() )
+        if a.typ == COMMAND ]
+    ret = [ probe.replace( "$n", "-1" ) ]
+    depth = 0
+    for i, ( num, inp ) in enumerate( commands ):
+        ret.append( inp )
+        for line in inp.split( "\n" ):
+            depth, code = scan_line( line, depth )
+        next_line = commands[i + 1][1] if i + 1 < len( commands ) else None
+        if depth == 0 and is_boundary( code, next_line, style ):
+            ret.append( probe.replace( "$n", str( num ) ) )
+    return "\n".join( ret ) + "\n"
+
+def open_timing_file():
+    return tempfile.TemporaryFile( prefix = "itcc-timing" )
+
+def child_env( timing_file ):
+    env = dict( os.environ )
+    env[timing_fd_env] = str( timing_file.fileno() )
+    return env
+
+def read_timings( timing_file ):
+    timings = {}
+    timing_file.seek( 0 )
+    for line in timing_file.read().decode().splitlines():
+        parts = line.split()
+        if len( parts ) == 2 and parts[0].lstrip( "-" ).isdigit():
+            timings[int( parts[0] )] = int( parts[1] )
+    timing_file.close()
+    return timings
+
+def store_timings( runner, timings ):
+    for num, a in enumerate( runner.get_user_input() ):
+        a.cost = timings.get( num )
+
+def format_cost( ns ):
+    if ns >= 1000000000:
+        return "%.2f s" % ( ns / 1e9 )
+    if ns >= 1000000:
+        return "%.2f ms" % ( ns / 1e6 )
+    return "%.1f us" % ( ns / 1e3 )
+
+def get_annotated_commands_string( runner ):
+    ret = []
+    for a in runner.get_user_input():
+        if a.typ != COMMAND:
+            continue
+        if a.cost is None:
+            ret.append( a.inp )
+        else:
+            ret.append( "%s  // %s" % ( a.inp, format_cost( a.cost ) ) )
+    return "\n".join( ret ) + "\n"
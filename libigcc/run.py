@@ -20,13 +20,11 @@
 
 import itertools
 import platform
-import os
-import os.path
 import re
 import readline
 import subprocess
 import sys
-import tempfile
+import time
 from contextlib import redirect_stdout
 from argparse import ArgumentParser
 from colorama import init, Fore, Back
@@ -34,6 +32,21 @@ from colorama import init, Fore, Back
 from . import dot_commands
 from . import source_code
 from . import version
+from . import rusage
+from . import jobs
+from . import speculate
+from . import cache
+from . import jsonl
+from . import workspace
+from . import paste
+from . import session
+from . import units
+from . import linker
+from . import split
+from . import memexec
+from . import probes
+from . import clangrepl
+from . import datamap
 
 # --------------
 
@@ -41,12 +54,22 @@ from . import version
 
 prompt = "g++> "
 compiler_command = ( "g++", "-std=c++17", "-O0", "-x", "c++", "-o", "$outfile", "-",
-    "$include_dirs", "$lib_dirs", "$libs" )
+    "$objects", "$include_dirs", "$lib_dirs", "$libs" )
 
 include_dir_command = ( "-I$cmd", )
 lib_dir_command = ( "-L$cmd", )
 lib_command = ( "-l$cmd", )
 
+# extra source files added with .add, and how their objects are linked
+unit_commands = {
+    ".c" : ( "gcc", "-O0", "-c", "-MMD", "-MF", "$depfile", "-o", "$outfile",
+        "$srcfile", "$include_dirs" ),
+    ".cpp" : ( "g++", "-std=c++17", "-O0", "-c", "-MMD", "-MF", "$depfile",
+        "-o", "$outfile", "$srcfile", "$include_dirs" ),
+    }
+unit_link_prefix = ( "-x", "none" )
+unit_link_command = ( "$outfile", )
+
 #---------------
 
 incl_re = re.compile( r"\s*(#\s*include)\s" )
@@ -72,12 +95,9 @@ def create_read_line_function( inputfile, prompt ):
     else:
         return lambda: read_line_from_file( inputfile, prompt )
 
-def get_temporary_file_name():
+def get_temporary_file_name( ws ):
     suff = ".exe" if platform.system() == 'Windows' else ""
-    outfile = tempfile.NamedTemporaryFile( prefix = 'igcc', suffix = suff )
-    outfilename = outfile.name
-    outfile.close()
-    return outfilename
+    return ws.file( "igcc" + suff )
 
 def append_multiple( single_cmd, cmdlist, ret ):
     if cmdlist is not None:
@@ -86,7 +106,7 @@ def append_multiple( single_cmd, cmdlist, ret ):
                 ret.append(
                     cmd_part.replace( "$cmd" , cmd ) )
 
-def get_compiler_command( options, extra_options, outfilename ):
+def get_compiler_command( options, extra_options, outfilename, objects = () ):
     ret = []
 
     for part in compiler_command:
@@ -98,6 +118,8 @@ def get_compiler_command( options, extra_options, outfilename ):
             append_multiple( lib_dir_command, options.LIBDIR,ret )
         elif part == "$libs":
             append_multiple( lib_command, options.LIB, ret )
+        elif part == "$objects":
+            ret += objects
         else:
             ret.append( part.replace( "$outfile", outfilename ) )
 
@@ -105,13 +127,58 @@ def get_compiler_command( options, extra_options, outfilename ):
 
 
 def run_compile( subs_compiler_command, runner ):
-    compile_process = subprocess.Popen( subs_compiler_command,
-        stdin = subprocess.PIPE, stderr = subprocess.PIPE )
-    source = source_code.get_full_source(runner)
+    source = source_code.get_full_source( runner )
+    plan = runner.split.prepare( runner, source_code, subs_compiler_command )
+    if plan is None:
+        return run_compile_source( subs_compiler_command, runner, source )
+    compile_error = run_compile_source( plan.command, runner, plan.source )
+    if compile_error is None:
+        runner.split.judge( plan, True )
+        # where .save finds the program built for this source
+        runner.built = ( source, runner.cache.key( plan.command, plan.source ) )
+    elif not runner.split.proven( plan ):
+        # the split may be to blame: see if the whole program builds
+        compile_error = run_compile_source( subs_compiler_command, runner,
+            source )
+        if compile_error is None:
+            runner.split.judge( plan, False )
+    return compile_error
+
+def run_compile_source( subs_compiler_command, runner, source ):
     if runner.options.v > 2:
         print(source)
+    key = runner.cache.key( subs_compiler_command, source )
+    runner.cache.wait( key )
+    entry = runner.cache.fetch( key, runner.exefilename )
+    if entry is not None:
+        runner.cache_status = "hit"
+        runner.compile_usage = rusage.Usage( 0.0, None )
+        runner.exe_path = entry.run_path( runner.exefilename )
+        return entry.error
+    runner.cache_status = "miss"
+    memfile = memexec.MemFile( "igcc" ) if runner.use_memfd else None
+    if memfile is None:
+        cache.remove( runner.exefilename )
+    compile_error = compile_source( memexec.output_command(
+        subs_compiler_command, runner.exefilename, memfile ), runner, source )
+    if compile_error is not None and memfile is not None \
+            and memfile.path.encode() in compile_error:
+        # the compiler can't write there; use a file from now on
+        memfile.close()
+        memfile = None
+        runner.use_memfd = False
+        cache.remove( runner.exefilename )
+        compile_error = compile_source( subs_compiler_command, runner, source )
+    runner.cache.store( key, runner.exefilename, compile_error, memfile )
+    runner.exe_path = memfile.path if memfile is not None else runner.exefilename
+    return compile_error
+
+def compile_source( subs_compiler_command, runner, source ):
+    compile_process = jobs.Popen( subs_compiler_command,
+        stdin = subprocess.PIPE, stderr = subprocess.PIPE )
     stdoutdata, stderrdata = compile_process.communicate(
         source.encode('utf-8') )
+    runner.compile_usage = compile_process.usage
 
     if compile_process.returncode == 0:
         return None
@@ -126,10 +193,15 @@ def run_compile( subs_compiler_command, runner ):
         else:
             return "Unknown compile error - compiler did not write any output."
 
-def run_exe( exefilename, extra_args ):
-    run_process = subprocess.Popen([ exefilename, *extra_args],
-        stdout = subprocess.PIPE, stderr = subprocess.PIPE )
-    return run_process.communicate()
+def run_exe( exefilename, extra_args, timing_file = None ):
+    env, pass_fds = None, ()
+    if timing_file is not None:
+        env, pass_fds = probes.child_env( timing_file ), ( timing_file.fileno(), )
+    run_process = jobs.Popen([ exefilename, *extra_args],
+        stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+        env = env, pass_fds = pass_fds )
+    stdoutdata, stderrdata = run_process.communicate()
+    return stdoutdata, stderrdata, run_process.usage
 
 def print_welcome():
     print(f'''igcc $version
@@ -146,6 +218,8 @@ class UserInput:
         self.typ = typ
         self.output_chars = 0
         self.error_chars = 0
+        self.pasted = False
+        self.cost = None
 
     def __str__( self ):
         return "UserInput( '%s', %d, %d, %d )" % (
@@ -163,7 +237,8 @@ class UserInput:
 
 class Runner:
 
-    def __init__( self, options, extra_options, inputfile, exefilename ):
+    def __init__( self, options, extra_options, inputfile, exefilename,
+            workspace = None ):
         self.options = options
         self.extra_options = extra_options
         self.inputfile = inputfile
@@ -173,66 +248,264 @@ class Runner:
         self.compile_error = ""
         self.output_chars_printed = 0
         self.error_chars_printed = 0
+        self.compile_usage = None
+        self.run_usage = None
+        self.workspace = workspace
+        self.exe_path = exefilename
+        self.use_memfd = ( memexec.available() and options is not None
+            and not options.no_memfd )
+        self.cache = cache.ArtifactCache(
+            workspace.file( "cache" ) if workspace is not None else None )
+        self.cache_status = None
+        self.last_cache_status = None
+        self.jobs = jobs.JobControl( prompt )
+        self.data_maps = datamap.DataMaps()
+        self.units = units.Units(
+            workspace.file( "units" ) if workspace is not None else None,
+            unit_commands, unit_link_command, unit_link_prefix )
+        self.split = split.Split(
+            workspace.file( "split" ) if workspace is not None else None )
+        self.built = None
+        self.repl = None
+        self.link_dynamic = False
+        self.reading = False
+        self.last_run = None
+        self.run_skipped = False
+        self.new_output = ""
+        self.new_error = ""
+        self.deferred = False
+        self.resync = False
 
     def do_run( self, session_args ):
         read_line = create_read_line_function( self.inputfile, prompt )
-        subs_compiler_command = get_compiler_command(
-            self.options, self.extra_options, self.exefilename )
-
-        inp = 1
-        while inp is not None:
-            inp = self.inp = read_line()
-            if inp is not None:
-
-                col_inp, run_cmp = (
-                    dot_commands.process( inp, self ) )
-                if col_inp:
-                    if self.input_num < len( self.user_input ):
-                        self.user_input = self.user_input[ : self.input_num ]
-                    if incl_re.match( inp ) or not run_cmp:
-                        typ = UserInput.INCLUDE
-                        self.user_input.append( UserInput( self.inp, typ ) )
-                    else:
-                        typ = UserInput.COMMAND
-                        self.user_input.append( UserInput( "    " + self.inp, typ ) )
-                    self.input_num += 1
-
-                if run_cmp:
-                    # print compiler command
-                    if self.options.v > 1:
-                        print("$ " + ( " ".join( subs_compiler_command ) ))
-                    self.compile_error = run_compile( subs_compiler_command,
-                        self )
-
-                    if self.compile_error is not None:
-                        err = self.compile_error.decode().strip('\n')
-                        if self.options.v > 2:
-                            print(err)
-                        elif (err.find("empty block") < 0
-                          and err.find("end of file") < 0) or self.options.e:
-                            print("[Compile error - type .e to see it.]")
-                    else:
-                        if self.options.v > 0:
-                            print("session_args:", *session_args)
-                        stdoutdata, stderrdata = run_exe( self.exefilename,
-                            session_args )
-
-                        if len( stdoutdata ) > self.output_chars_printed:
-                            new_output = stdoutdata[self.output_chars_printed:]
-                            len_new_output = len( new_output )
-                            print(new_output.decode().strip('\n'))
-                            self.output_chars_printed += len_new_output
-                            self.user_input[ -1 ].output_chars = len_new_output
-
-                        if len( stderrdata ) > self.error_chars_printed:
-                            new_error = stderrdata[self.error_chars_printed:]
-                            len_new_error = len( new_error )
-                            print(new_error.decode().strip('\n'))
-                            self.error_chars_printed += len_new_error
-                            self.user_input[ -1 ].error_chars = len_new_error
+        self.start( session_args )
+        speculator = None
+        interactive = self.inputfile is None and sys.stdin.isatty()
+        if interactive:
+            self.jobs.foreground_wait = self.options.background_after
+            if self.options.speculate and self.repl is None:
+                speculator = speculate.Speculator( self, source_code,
+                    compile_source, incl_re, UserInput )
+                speculator.start()
+
+        if self.options.resume:
+            self.process_line( ".load " + self.options.resume )
+
+        try:
+            inp = 1
+            while inp is not None:
+                try:
+                    self.reading = True
+                    inp = read_line()
+                except KeyboardInterrupt:
+                    # Ctrl-C kills a background job, not the session
+                    print()
+                    self.jobs.kill()
+                    continue
+                finally:
+                    self.reading = False
+                if inp is not None and interactive:
+                    lines = paste.split( inp )
+                    for i, line in enumerate( lines ):
+                        self.process_line( line, defer = i + 1 < len( lines )
+                            or paste.pending() )
+                elif inp is not None:
+                    self.process_line( inp )
+        finally:
+            if speculator is not None:
+                speculator.stop()
+            if interactive:
+                session.autosave( self )
 
         print()
 
+    def start( self, session_args ):
+        self.session_args = session_args
+        self.subs_compiler_command = get_compiler_command(
+            self.options, self.extra_options, self.exefilename,
+            self.units.link_args() )
+        self.link_strategy = linker.choose( "gcc", compiler_command[0],
+            self.options.linker )
+        if self.link_strategy.static and ( self.link_dynamic
+                or self.options.LIB or len( self.units ) > 0
+                or any( o.startswith( "-l" ) for o in self.extra_options ) ):
+            # the libraries may only come shared
+            self.link_strategy = self.link_strategy.dynamic()
+        self.subs_compiler_command += self.link_strategy.args()
+        if self.options.clang_repl and self.repl is None:
+            if not clangrepl.available():
+                print("[clang-repl not found - building with g++.]")
+                self.options.clang_repl = False
+            elif self.options.LIB:
+                print("[clang-repl can't link -l libraries - building with g++.]")
+                self.options.clang_repl = False
+            else:
+                self.repl = clangrepl.Repl( clangrepl.get_command(
+                    self.options, self.extra_options ),
+                    clangrepl.get_prelude( session_args ),
+                    self.options.checkpoint_mb )
+
+    def process_line( self, inp, defer = False ):
+        if inp not in jobs.keep_running:
+            self.jobs.cancel()
+        self.inp = inp
+        if self.cache_status is not None:
+            self.last_cache_status = self.cache_status
+        self.cache_status = None
+        self.new_output = self.new_error = ""
+        col_inp, run_cmp = (
+            dot_commands.process( inp, self ) )
+        if col_inp:
+            if self.input_num < len( self.user_input ):
+                self.user_input = self.user_input[ : self.input_num ]
+            if incl_re.match( inp ) or not run_cmp:
+                typ = UserInput.INCLUDE
+                self.user_input.append( UserInput( self.inp, typ ) )
+            else:
+                typ = UserInput.COMMAND
+                self.user_input.append( UserInput( "    " + self.inp, typ ) )
+            self.input_num += 1
+
+        if self.resync:
+            self.resync = False
+            self.jobs.run( self.resync_cycle )
+        if run_cmp and defer:
+            # more pasted lines are waiting; build once, after the last
+            self.mark_pasted()
+            self.deferred = True
+        elif run_cmp or self.deferred:
+            if self.deferred:
+                self.mark_pasted()
+            self.deferred = False
+            self.jobs.run( self.run_cycle )
+
+    def mark_pasted( self ):
+        if self.input_num > 0:
+            self.user_input[ self.input_num - 1 ].pasted = True
+
+    def run_unchanged( self ):
+        return self.last_run == ( self.get_user_commands_string(),
+            self.output_chars_printed, self.error_chars_printed )
+
+    def run_cycle( self ):
+        if self.repl is not None:
+            if len( self.units ) == 0:
+                return self.repl_cycle()
+            print("[.add needs g++ - leaving clang-repl.]")
+            self.repl.close()
+            self.repl = None
+        # files added with .add first, then the program linked with them
+        self.compile_error = self.units.build( self.options )
+        if self.compile_error is None:
+            if len( self.units ) > 0:
+                self.start( self.session_args )
+            # print compiler command
+            if self.options.v > 1:
+                print("$ " + ( " ".join( self.subs_compiler_command ) ))
+            self.compile_error = run_compile( self.subs_compiler_command,
+                self )
+            if self.link_strategy.static \
+                    and linker.link_failed( self.compile_error ):
+                # something may need a shared library
+                self.link_dynamic = True
+                self.start( self.session_args )
+                self.compile_error = run_compile( self.subs_compiler_command,
+                    self )
+                if self.compile_error is not None:
+                    # it didn't: go on linking statically
+                    self.link_dynamic = False
+                    self.start( self.session_args )
+        if jobs.cancelled():
+            return
+        if self.options.v > 1:
+            print(rusage.format_usage( "compile", self.compile_usage ))
+
+        if self.compile_error is not None:
+            err = self.compile_error.decode().strip('\n')
+            if self.options.v > 2:
+                print(err)
+            elif (err.find("empty block") < 0
+              and err.find("end of file") < 0) or self.options.e:
+                print("[Compile error - type .e to see it.]")
+        elif self.run_unchanged():
+            # main() is as it was when it last ran, and all that printed
+            # has been shown, so running it again would show nothing new
+            self.run_skipped = True
+            if self.options.time_statements:
+                # they were the last run's, and there is no new one
+                probes.store_timings( self, {} )
+        else:
+            self.run_skipped = False
+            if self.options.v > 0:
+                print("session_args:", *self.session_args)
+            timing_file = probes.open_timing_file() \
+                if self.options.time_statements else None
+            stdoutdata, stderrdata, self.run_usage = run_exe(
+                self.exe_path, self.session_args, timing_file )
+            if jobs.cancelled():
+                return
+            self.last_run = ( self.get_user_commands_string(),
+                len( stdoutdata ), len( stderrdata ) )
+            if self.options.v > 1:
+                print(rusage.format_usage( "run", self.run_usage ))
+            if timing_file is not None:
+                probes.store_timings( self,
+                    probes.read_timings( timing_file ) )
+
+            if len( stdoutdata ) > self.output_chars_printed:
+                new_output = stdoutdata[self.output_chars_printed:]
+                len_new_output = len( new_output )
+                self.new_output = new_output.decode()
+                print(self.new_output.strip('\n'))
+                self.output_chars_printed += len_new_output
+                self.user_input[ -1 ].output_chars = len_new_output
+
+            if len( stderrdata ) > self.error_chars_printed:
+                new_error = stderrdata[self.error_chars_printed:]
+                len_new_error = len( new_error )
+                self.new_error = new_error.decode()
+                print(self.new_error.strip('\n'))
+                self.error_chars_printed += len_new_error
+                self.user_input[ -1 ].error_chars = len_new_error
+
+    def repl_cycle( self ):
+        started = time.monotonic()
+        stdoutdata, stderrdata, self.compile_error = self.repl.catch_up(
+            list( self.get_user_input() ) )
+        self.compile_usage = rusage.Usage( time.monotonic() - started, None )
+        if jobs.cancelled():
+            return
+        if self.compile_error is not None:
+            if self.options.v > 2:
+                print(self.compile_error.decode().strip('\n'))
+            elif not self.repl.alive():
+                print("[clang-repl stopped - type .e to see where, .u to drop "
+                    "the line.]")
+            else:
+                print("[Compile error - type .e to see it.]")
+
+        # only this line's output comes back, but keep count as g++ would
+        if stdoutdata:
+            self.new_output = stdoutdata.decode()
+            print(self.new_output.strip('\n'))
+            self.output_chars_printed += len( stdoutdata )
+            self.user_input[ -1 ].output_chars = len( stdoutdata )
+        if stderrdata:
+            self.new_error = stderrdata.decode()
+            print(self.new_error.strip('\n'))
+            self.error_chars_printed += len( stderrdata )
+            self.user_input[ -1 ].error_chars = len( stderrdata )
+
+    def resync_cycle( self ):
+        # a paste's output is counted against its last line, so after
+        # undoing into one, rebuild quietly to see what is still printed
+        last = self.user_input[ -1 ]
+        counted = last.output_chars, last.error_chars
+        self.output_chars_printed = self.error_chars_printed = 0
+        with jobs.quiet():
+            self.run_cycle()
+        last.output_chars, last.error_chars = counted
+
     def redo( self ):
         if self.input_num < len( self.user_input ):
             self.input_num += 1
@@ -245,8 +518,11 @@ class Runner:
         if self.input_num > 0:
             self.input_num -= 1
             undone_input = self.user_input[ self.input_num ]
-            self.output_chars_printed -= undone_input.output_chars
-            self.error_chars_printed -= undone_input.error_chars
+            if undone_input.pasted:
+                self.resync = True
+            else:
+                self.output_chars_printed -= undone_input.output_chars
+                self.error_chars_printed -= undone_input.error_chars
             return undone_input.inp
         else:
             return None
@@ -286,6 +562,31 @@ def parse_args( argv ):
             "be searched for library files." )
     parser.add_argument( "-l", dest="LIB", action="append",
         help = "Search the library LIB when linking." )
+    parser.add_argument( "--time-statements", action="store_true",
+        help = "Time each statement and show the costs in .l listings." )
+    parser.add_argument( "--no-memfd", action="store_true",
+        help = "Build programs as files instead of in memory." )
+    parser.add_argument( "--no-split", action="store_true",
+        help = "Always compile .f declarations together with the rest." )
+    parser.add_argument( "--clang-repl", action="store_true",
+        help = "Run lines in a clang-repl session instead of rebuilding " +
+            "the program with g++ each time." )
+    parser.add_argument( "--checkpoint-mb", type=int, default=512,
+        help = "Memory for --clang-repl snapshots to go back to on undo " +
+            "(default 512, 0 for none)." )
+    parser.add_argument( "--linker", default="auto",
+        help = "Linker to use: auto (the fastest, found by timing them), " +
+            "default, or a name such as mold or lld." )
+    parser.add_argument( "--background-after", type=float, default=1.0,
+        help = "Seconds to wait for a compile and run before handing " +
+            "the prompt back (default 1)." )
+    parser.add_argument( "--speculate", action="store_true",
+        help = "Start compiling a line before Enter is pressed." )
+    parser.add_argument( "--resume", nargs="?", const="last", metavar="NAME",
+        help = "Carry on from a saved session (by default the last one)." )
+    parser.add_argument( "--jsonl", action="store_true",
+        help = "Read JSON requests on stdin and answer each with one " +
+            "line of JSON." )
     parser.add_argument( "-compiler_args", action="store_true",
         help = "Any compiler args can go here.")
     parser.add_argument( "--", nargs="+", dest="session_args",
@@ -302,25 +603,38 @@ def parse_args( argv ):
 
     return options, extra_compiler_args, session_args
 
+def create_runner( argv, inputfile = None ):
+    options, extra_args, session_args = parse_args( argv )
+    ws = workspace.Workspace( "igcc" )
+    exefilename = get_temporary_file_name( ws )
+    return Runner( options, extra_args, inputfile, exefilename, ws ), session_args
+
+def remove_files( runner ):
+    if runner.repl is not None:
+        runner.repl.close()
+    runner.cache.clear()
+    runner.workspace.remove()
+
 def run( outputfile = sys.stdout, inputfile = None, print_welc = True,
         argv = None ):
-    exefilename = ""
+    runner = None
 
     # Use a with statement block to redirect sys.stdout
     with redirect_stdout(outputfile):
         try:
-            options, extra_args, session_args = parse_args(argv)
-
-            exefilename = get_temporary_file_name()
+            runner, session_args = create_runner( argv, inputfile )
             ret = "normal"
-            if print_welc:
+            if print_welc and not runner.options.jsonl:
                 print_welcome()
-            Runner(options, extra_args, inputfile, exefilename).do_run(session_args)
+            if runner.options.jsonl:
+                jsonl.serve( runner, session_args )
+            else:
+                runner.do_run(session_args)
         except Exception as e:
             print(e)
             ret = "quit"
 
-    if os.path.isfile(exefilename):
-        os.remove(exefilename)
+    if runner is not None:
+        remove_files( runner )
 
     return ret
@@ -18,15 +18,15 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301, USA.
 
+import collections
+import hashlib
 import itertools
 import platform
-import os
-import os.path
 import re
 import readline
 import subprocess
 import sys
-import tempfile
+import threading
 from contextlib import redirect_stdout
 from argparse import ArgumentParser
 from colorama import init, Fore, Back
@@ -34,6 +34,16 @@ from colorama import init, Fore, Back
 from . import dot_commands_crap as dot_commands
 from . import source_code_crap as source_code
 from . import version
+from . import rusage
+from . import jobs
+from . import speculate
+from . import cache
+from . import jsonl
+from . import workspace
+from . import paste
+from . import session
+from . import units
+from . import memexec
 
 # --------------
 
@@ -41,12 +51,20 @@ from . import version
 
 prompt = "crap> "
 compiler_command = ( "tcc", "-std=c11", "-x", "c", "-o", "$outfile", "-",
-    "$include_dirs", "$lib_dirs", "$libs" )
+    "$objects", "$include_dirs", "$lib_dirs", "$libs" )
 
 include_dir_command = ( "-I$cmd", )
 lib_dir_command = ( "-L$cmd", )
 lib_command = ( "-l$cmd", )
 
+# extra source files added with .add, and how their objects are linked
+unit_commands = {
+    ".c" : ( "tcc", "-std=c11", "-c", "-MD", "-MF", "$depfile", "-o", "$outfile",
+        "$srcfile", "$include_dirs" ),
+    }
+unit_link_prefix = ( "-x", "none" )
+unit_link_command = ( "$outfile", )
+
 #---------------
 
 incl_re = re.compile( r"\s*(#\s*include)\s" )
@@ -72,12 +90,9 @@ def create_read_line_function( inputfile, prompt ):
     else:
         return lambda: read_line_from_file( inputfile, prompt )
 
-def get_temporary_file_name():
+def get_temporary_file_name( ws ):
     suff = ".exe" if platform.system() == 'Windows' else ""
-    outfile = tempfile.NamedTemporaryFile( prefix = "icrap", suffix = suff )
-    outfilename = outfile.name
-    outfile.close()
-    return outfilename
+    return ws.file( "icrap" + suff )
 
 def append_multiple( single_cmd, cmdlist, ret ):
     if cmdlist is not None:
@@ -86,7 +101,7 @@ def append_multiple( single_cmd, cmdlist, ret ):
                 ret.append(
                     cmd_part.replace( "$cmd" , cmd ) )
 
-def get_compiler_command( options, extra_options, outfilename ):
+def get_compiler_command( options, extra_options, outfilename, objects = () ):
     ret = []
 
     for part in compiler_command:
@@ -98,30 +113,88 @@ def get_compiler_command( options, extra_options, outfilename ):
             append_multiple( lib_dir_command, options.LIBDIR,ret )
         elif part == "$libs":
             append_multiple( lib_command, options.LIB, ret )
+        elif part == "$objects":
+            ret += objects
         else:
             ret.append( part.replace( "$outfile", outfilename ) )
 
     return ret
 
 def run_compile( subs_compiler_command, runner ):
-    #process crap code into valid C code thru pipes
-    crap_process = subprocess.Popen( ["crap", "-"],
-        stdin = subprocess.PIPE, stdout = subprocess.PIPE)
-    # Prepare compiler to receive C code from stdin
-    compile_process = subprocess.Popen( subs_compiler_command,
-        stdin = crap_process.stdout, stderr = subprocess.PIPE )
-    # write source code to crap_process stdin and flush stream
     source = source_code.get_full_source(runner)
     if runner.options.v > 2:
         print(source)
-    crap_process.stdin.write(source.encode("utf-8"))
-    crap_process.stdin.flush()
-    crap_process.stdin.close()
-    crap_process.wait()
-    compile_process.wait()
-
-    # read the output from compile_process stdout and stderr
-    stdoutdata, stderrdata = compile_process.communicate()
+    key = runner.cache.key( subs_compiler_command, source )
+    runner.cache.wait( key )
+    entry = runner.cache.fetch( key, runner.exefilename )
+    if entry is not None:
+        runner.cache_status = "hit"
+        runner.compile_usage = rusage.Usage( 0.0, None )
+        runner.exe_path = entry.run_path( runner.exefilename )
+        return entry.error
+    runner.cache_status = "miss"
+    memfile = memexec.MemFile( "icrap" ) if runner.use_memfd else None
+    if memfile is None:
+        cache.remove( runner.exefilename )
+    compile_error = compile_source( memexec.output_command(
+        subs_compiler_command, runner.exefilename, memfile ), runner, source )
+    if compile_error is not None and memfile is not None \
+            and memfile.path.encode() in compile_error:
+        # the compiler can't write there; use a file from now on
+        memfile.close()
+        memfile = None
+        runner.use_memfd = False
+        cache.remove( runner.exefilename )
+        compile_error = compile_source( subs_compiler_command, runner, source )
+    runner.cache.store( key, runner.exefilename, compile_error, memfile )
+    runner.exe_path = memfile.path if memfile is not None else runner.exefilename
+    return compile_error
+
+class Translations:
+    """The C that crap made of the last few programs.  Undo, redo, .L and
+    a compile after a cache eviction all ask for a translation we have
+    already seen, so crap only runs for new source."""
+
+    def __init__( self, max_entries = 32 ):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.runs = 0
+        self.lock = threading.Lock()
+
+    def translate( self, source ):
+        """Return the C for source (None if crap failed) and whatever crap
+        said about it."""
+        key = hashlib.sha256( source.encode( "utf-8" ) ).hexdigest()
+        with self.lock:
+            entry = self.entries.get( key )
+            if entry is not None:
+                self.entries.move_to_end( key )
+                return entry
+        crap_process = jobs.Popen( ["crap", "-"], stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE, stderr = subprocess.PIPE )
+        stdoutdata, stderrdata = crap_process.communicate(
+            source.encode( "utf-8" ) )
+        self.runs += 1
+        if crap_process.returncode != 0:
+            return None, stdoutdata + stderrdata
+        with self.lock:
+            self.entries[key] = stdoutdata, stderrdata
+            while len( self.entries ) > self.max_entries:
+                self.entries.popitem( last = False )
+        return stdoutdata, stderrdata
+
+def compile_source( subs_compiler_command, runner, source ):
+    #process crap code into valid C code, then hand it to the compiler;
+    #each step drains its own pipes, so neither can block the other
+    code, crap_messages = runner.translations.translate( source )
+    if code is None:
+        return crap_messages or b"crap failed without saying why."
+    compile_process = jobs.Popen( subs_compiler_command,
+        stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+        stderr = subprocess.PIPE )
+    stdoutdata, stderrdata = compile_process.communicate( code )
+    runner.compile_usage = compile_process.usage
+    stdoutdata = crap_messages + stdoutdata
 
     if compile_process.returncode == 0:
         return None
@@ -137,9 +210,10 @@ def run_compile( subs_compiler_command, runner ):
             return "Unknown compile error - compiler did not write any output."
 
 def run_exe( exefilename, extra_args ):
-    run_process = subprocess.Popen([ exefilename, *extra_args],
+    run_process = jobs.Popen([ exefilename, *extra_args],
         stdout = subprocess.PIPE, stderr = subprocess.PIPE )
-    return run_process.communicate()
+    stdoutdata, stderrdata = run_process.communicate()
+    return stdoutdata, stderrdata, run_process.usage
 
 def print_welcome():
     print(f'''icrap $version
@@ -157,6 +231,7 @@ class UserInput:
         self.typ = typ
         self.output_chars = 0
         self.error_chars = 0
+        self.pasted = False
 
     def __str__( self ):
         return "UserInput( '%s', %d, %d, %d )" % (
@@ -174,7 +249,8 @@ class UserInput:
 
 class Runner:
 
-    def __init__( self, options, extra_options, inputfile, exefilename ):
+    def __init__( self, options, extra_options, inputfile, exefilename,
+            workspace = None ):
         self.options = options
         self.extra_options = extra_options
         self.inputfile = inputfile
@@ -184,66 +260,186 @@ class Runner:
         self.compile_error = ""
         self.output_chars_printed = 0
         self.error_chars_printed = 0
+        self.compile_usage = None
+        self.run_usage = None
+        self.workspace = workspace
+        self.exe_path = exefilename
+        self.use_memfd = ( memexec.available() and options is not None
+            and not options.no_memfd )
+        self.cache = cache.ArtifactCache(
+            workspace.file( "cache" ) if workspace is not None else None )
+        self.cache_status = None
+        self.last_cache_status = None
+        self.translations = Translations()
+        self.jobs = jobs.JobControl( prompt )
+        self.units = units.Units(
+            workspace.file( "units" ) if workspace is not None else None,
+            unit_commands, unit_link_command, unit_link_prefix )
+        self.reading = False
+        self.last_run = None
+        self.run_skipped = False
+        self.new_output = ""
+        self.new_error = ""
+        self.deferred = False
+        self.resync = False
 
     def do_run( self, session_args ):
         read_line = create_read_line_function( self.inputfile, prompt )
-        subs_compiler_command = get_compiler_command(
-            self.options, self.extra_options, self.exefilename )
-
-        inp = 1
-        while inp is not None:
-            inp = self.inp = read_line()
-            if inp is not None:
-
-                col_inp, run_cmp = (
-                    dot_commands.process( inp, self ) )
-                if col_inp:
-                    if self.input_num < len( self.user_input ):
-                        self.user_input = self.user_input[ : self.input_num ]
-                    if incl_re.match( inp ) or not run_cmp:
-                        typ = UserInput.INCLUDE
-                        self.user_input.append( UserInput( self.inp, typ ) )
-                    else:
-                        typ = UserInput.COMMAND
-                        self.user_input.append( UserInput( "    " + self.inp, typ ) )
-                    self.input_num += 1
-
-                if run_cmp:
-                    # print compiler command
-                    if self.options.v > 1:
-                        print("$ " + ( " ".join( subs_compiler_command ) ))
-                    self.compile_error = run_compile( subs_compiler_command,
-                        self )
-
-                    if self.compile_error is not None:
-                        err = self.compile_error.decode().strip('\n')
-                        if self.options.v > 2:
-                            print(err)
-                        elif (err.find("empty block") < 0
-                          and err.find("end of file") < 0) or self.options.e:
-                            print("[Compile error - type .e to see it.]")
-                    else:
-                        if self.options.v > 0:
-                            print("session_args:", *session_args)
-                        stdoutdata, stderrdata = run_exe( self.exefilename,
-                            session_args )
-
-                        if len( stdoutdata ) > self.output_chars_printed:
-                            new_output = stdoutdata[self.output_chars_printed:]
-                            len_new_output = len( new_output )
-                            print(new_output.decode().strip('\n'))
-                            self.output_chars_printed += len_new_output
-                            self.user_input[ -1 ].output_chars = len_new_output
-
-                        if len( stderrdata ) > self.error_chars_printed:
-                            new_error = stderrdata[self.error_chars_printed:]
-                            len_new_error = len( new_error )
-                            print(new_error.decode().strip('\n'))
-                            self.error_chars_printed += len_new_error
-                            self.user_input[ -1 ].error_chars = len_new_error
+        self.start( session_args )
+        speculator = None
+        interactive = self.inputfile is None and sys.stdin.isatty()
+        if interactive:
+            self.jobs.foreground_wait = self.options.background_after
+            if self.options.speculate:
+                speculator = speculate.Speculator( self, source_code,
+                    compile_source, incl_re, UserInput )
+                speculator.start()
+
+        if self.options.resume:
+            self.process_line( ".load " + self.options.resume )
+
+        try:
+            inp = 1
+            while inp is not None:
+                try:
+                    self.reading = True
+                    inp = read_line()
+                except KeyboardInterrupt:
+                    # Ctrl-C kills a background job, not the session
+                    print()
+                    self.jobs.kill()
+                    continue
+                finally:
+                    self.reading = False
+                if inp is not None and interactive:
+                    lines = paste.split( inp )
+                    for i, line in enumerate( lines ):
+                        self.process_line( line, defer = i + 1 < len( lines )
+                            or paste.pending() )
+                elif inp is not None:
+                    self.process_line( inp )
+        finally:
+            if speculator is not None:
+                speculator.stop()
+            if interactive:
+                session.autosave( self )
 
         print()
 
+    def start( self, session_args ):
+        self.session_args = session_args
+        self.subs_compiler_command = get_compiler_command(
+            self.options, self.extra_options, self.exefilename,
+            self.units.link_args() )
+
+    def process_line( self, inp, defer = False ):
+        if inp not in jobs.keep_running:
+            self.jobs.cancel()
+        self.inp = inp
+        if self.cache_status is not None:
+            self.last_cache_status = self.cache_status
+        self.cache_status = None
+        self.new_output = self.new_error = ""
+        col_inp, run_cmp = (
+            dot_commands.process( inp, self ) )
+        if col_inp:
+            if self.input_num < len( self.user_input ):
+                self.user_input = self.user_input[ : self.input_num ]
+            if incl_re.match( inp ) or not run_cmp:
+                typ = UserInput.INCLUDE
+                self.user_input.append( UserInput( self.inp, typ ) )
+            else:
+                typ = UserInput.COMMAND
+                self.user_input.append( UserInput( "    " + self.inp, typ ) )
+            self.input_num += 1
+
+        if self.resync:
+            self.resync = False
+            self.jobs.run( self.resync_cycle )
+        if run_cmp and defer:
+            # more pasted lines are waiting; build once, after the last
+            self.mark_pasted()
+            self.deferred = True
+        elif run_cmp or self.deferred:
+            if self.deferred:
+                self.mark_pasted()
+            self.deferred = False
+            self.jobs.run( self.run_cycle )
+
+    def mark_pasted( self ):
+        if self.input_num > 0:
+            self.user_input[ self.input_num - 1 ].pasted = True
+
+    def run_unchanged( self ):
+        return self.last_run == ( self.get_user_commands_string(),
+            self.output_chars_printed, self.error_chars_printed )
+
+    def run_cycle( self ):
+        # files added with .add first, then the program linked with them
+        self.compile_error = self.units.build( self.options )
+        if self.compile_error is None:
+            if len( self.units ) > 0:
+                self.start( self.session_args )
+            # print compiler command
+            if self.options.v > 1:
+                print("$ " + ( " ".join( self.subs_compiler_command ) ))
+            self.compile_error = run_compile( self.subs_compiler_command,
+                self )
+        if jobs.cancelled():
+            return
+        if self.options.v > 1:
+            print(rusage.format_usage( "compile", self.compile_usage ))
+
+        if self.compile_error is not None:
+            err = self.compile_error.decode().strip('\n')
+            if self.options.v > 2:
+                print(err)
+            elif (err.find("empty block") < 0
+              and err.find("end of file") < 0) or self.options.e:
+                print("[Compile error - type .e to see it.]")
+        elif self.run_unchanged():
+            # main() is as it was when it last ran, and all that printed
+            # has been shown, so running it again would show nothing new
+            self.run_skipped = True
+        else:
+            self.run_skipped = False
+            if self.options.v > 0:
+                print("session_args:", *self.session_args)
+            stdoutdata, stderrdata, self.run_usage = run_exe(
+                self.exe_path, self.session_args )
+            if jobs.cancelled():
+                return
+            self.last_run = ( self.get_user_commands_string(),
+                len( stdoutdata ), len( stderrdata ) )
+            if self.options.v > 1:
+                print(rusage.format_usage( "run", self.run_usage ))
+
+            if len( stdoutdata ) > self.output_chars_printed:
+                new_output = stdoutdata[self.output_chars_printed:]
+                len_new_output = len( new_output )
+                self.new_output = new_output.decode()
+                print(self.new_output.strip('\n'))
+                self.output_chars_printed += len_new_output
+                self.user_input[ -1 ].output_chars = len_new_output
+
+            if len( stderrdata ) > self.error_chars_printed:
+                new_error = stderrdata[self.error_chars_printed:]
+                len_new_error = len( new_error )
+                self.new_error = new_error.decode()
+                print(self.new_error.strip('\n'))
+                self.error_chars_printed += len_new_error
+                self.user_input[ -1 ].error_chars = len_new_error
+
+    def resync_cycle( self ):
+        # a paste's output is counted against its last line, so after
+        # undoing into one, rebuild quietly to see what is still printed
+        last = self.user_input[ -1 ]
+        counted = last.output_chars, last.error_chars
+        self.output_chars_printed = self.error_chars_printed = 0
+        with jobs.quiet():
+            self.run_cycle()
+        last.output_chars, last.error_chars = counted
+
     def redo( self ):
         if self.input_num < len( self.user_input ):
             self.input_num += 1
@@ -256,8 +452,11 @@ class Runner:
         if self.input_num > 0:
             self.input_num -= 1
             undone_input = self.user_input[ self.input_num ]
-            self.output_chars_printed -= undone_input.output_chars
-            self.error_chars_printed -= undone_input.error_chars
+            if undone_input.pasted:
+                self.resync = True
+            else:
+                self.output_chars_printed -= undone_input.output_chars
+                self.error_chars_printed -= undone_input.error_chars
             return undone_input.inp
         else:
             return None
@@ -297,6 +496,18 @@ def parse_args( argv ):
             "be searched for library files." )
     parser.add_argument( "-l", dest="LIB", action="append",
         help = "Search the library LIB when linking." )
+    parser.add_argument( "--no-memfd", action="store_true",
+        help = "Build programs as files instead of in memory." )
+    parser.add_argument( "--background-after", type=float, default=1.0,
+        help = "Seconds to wait for a compile and run before handing " +
+            "the prompt back (default 1)." )
+    parser.add_argument( "--speculate", action="store_true",
+        help = "Start compiling a line before Enter is pressed." )
+    parser.add_argument( "--resume", nargs="?", const="last", metavar="NAME",
+        help = "Carry on from a saved session (by default the last one)." )
+    parser.add_argument( "--jsonl", action="store_true",
+        help = "Read JSON requests on stdin and answer each with one " +
+            "line of JSON." )
     parser.add_argument( "-compiler_args", action="store_true",
         help = "Any compiler args can go here.")
     parser.add_argument( "--", nargs="+", dest="session_args",
@@ -313,25 +524,36 @@ def parse_args( argv ):
 
     return options, extra_compiler_args, session_args
 
+def create_runner( argv, inputfile = None ):
+    options, extra_args, session_args = parse_args( argv )
+    ws = workspace.Workspace( "icrap" )
+    exefilename = get_temporary_file_name( ws )
+    return Runner( options, extra_args, inputfile, exefilename, ws ), session_args
+
+def remove_files( runner ):
+    runner.cache.clear()
+    runner.workspace.remove()
+
 def run( outputfile = sys.stdout, inputfile = None, print_welc = True,
         argv = None ):
-    exefilename = ""
+    runner = None
 
     # Use a with statement block to redirect sys.stdout
     with redirect_stdout(outputfile):
         try:
-            options, extra_args, session_args = parse_args(argv)
-
-            exefilename = get_temporary_file_name()
+            runner, session_args = create_runner( argv, inputfile )
             ret = "normal"
-            if print_welc:
+            if print_welc and not runner.options.jsonl:
                 print_welcome()
-            Runner(options, extra_args, inputfile, exefilename).do_run(session_args)
+            if runner.options.jsonl:
+                jsonl.serve( runner, session_args )
+            else:
+                runner.do_run(session_args)
         except Exception as e:
             print(e)
             ret = "quit"
 
-    if os.path.isfile(exefilename):
-        os.remove(exefilename)
+    if runner is not None:
+        remove_files( runner )
 
     return ret
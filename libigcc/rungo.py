@@ -26,7 +26,6 @@ import re
 import readline
 import subprocess
 import sys
-import tempfile
 from contextlib import redirect_stdout
 from argparse import ArgumentParser
 from colorama import init, Fore, Back
@@ -34,13 +33,30 @@ from colorama import init, Fore, Back
 from . import dot_commands_go as dot_commands
 from . import source_code_go as source_code
 from . import version
+from . import rusage
+from . import jobs
+from . import speculate
+from . import cache
+from . import jsonl
+from . import workspace
+from . import paste
+from . import session
+from . import probes
 
 # --------------
 
 # One day these will be in a config file
 
 prompt = "go> "
-compiler_command = ( "go", "build", "-o", "$lib_dirs", "$libs", "$srcfile" )
+compiler_command = ( "go", "build", "-trimpath", "$profile", "$extra",
+    "-o", "$outfile", "$lib_dirs", "$libs", "." )
+
+# --profile: smaller binaries link faster; debug builds skip the optimiser
+profile_commands = {
+    "default" : (),
+    "strip" : ( "-ldflags=-s -w", ),
+    "debug" : ( "-gcflags=all=-N -l", ),
+}
 
 include_dir_command = ( "-I$cmd", )
 lib_dir_command = ( "-L$cmd", )
@@ -71,12 +87,9 @@ def create_read_line_function( inputfile, prompt ):
     else:
         return lambda: read_line_from_file( inputfile, prompt )
 
-def get_temporary_file_name():
+def get_temporary_file_name( ws ):
     suff = ".exe" if platform.system() == 'Windows' else ""
-    outfile = tempfile.NamedTemporaryFile( prefix = 'igo', suffix = suff )
-    outfilename = outfile.name
-    outfile.close()
-    return outfilename
+    return ws.file( "igo" + suff )
 
 def append_multiple( single_cmd, cmdlist, ret ):
     if cmdlist is not None:
@@ -89,12 +102,12 @@ def get_compiler_command( options, extra_options, srcfilename, exefilename ):
     ret = []
 
     for part in compiler_command:
-        if part == "$srcfile":
-            ret.append( part.replace( "$srcfile", srcfilename ) )
-        elif part == "-o":
-            append_multiple( extra_options, extra_options, ret)
+        if part == "$profile":
+            ret.extend( profile_commands[options.profile] )
+        elif part == "$extra":
+            ret.extend( extra_options )
         elif part == "$lib_dirs":
-            append_multiple( lib_dir_command, options.LIBDIR,ret )
+            append_multiple( lib_dir_command, workspace.absolute( options.LIBDIR ), ret )
         elif part == "$libs":
             append_multiple( lib_command, options.LIB, ret )
         else:
@@ -103,18 +116,50 @@ def get_compiler_command( options, extra_options, srcfilename, exefilename ):
 
 
 def run_compile( subs_compiler_command, runner, srcfilename ):
-    compile_process = subprocess.Popen( subs_compiler_command,
-        stdin = subprocess.PIPE, stderr = subprocess.PIPE )
     source = source_code.get_full_source(runner)
     if runner.options.v > 2:
         print(source)
+    key = runner.cache.key( subs_compiler_command, source )
+    runner.cache.wait( key )
+    entry = runner.cache.fetch( key, runner.exefilename )
+    if entry is not None:
+        runner.cache_status = "hit"
+        runner.compile_usage = rusage.Usage( 0.0, None )
+        return entry.error
+    runner.cache_status = "miss"
+    cache.remove( runner.exefilename )
+    compile_error = compile_source( subs_compiler_command, runner,
+        srcfilename, source )
+    runner.cache.store( key, runner.exefilename, compile_error )
+    return compile_error
+
+def init_module( directory ):
+    """Make directory a Go module, once, so that go build sees the same
+    package every time.  Returns an error, or None."""
+    if os.path.isfile( os.path.join( directory, "go.mod" ) ):
+        return None
+    os.makedirs( directory, exist_ok = True )
+    init_process = jobs.Popen( ( "go", "mod", "init", "igo" ),
+        stdout = subprocess.PIPE, stderr = subprocess.PIPE, cwd = directory )
+    stdoutdata, stderrdata = init_process.communicate()
+    if init_process.returncode != 0:
+        return stdoutdata + stderrdata
+    return None
+
+def compile_source( subs_compiler_command, runner, srcfilename, source ):
+    # the module is built, not the file, so main.go is always main.go in
+    # the same module and go build's cache can recognise what it has seen
+    init_error = init_module( os.path.dirname( srcfilename ) )
+    if init_error is not None:
+        return init_error
     with open(srcfilename, 'w') as file:
         file.write(source)
         file.close()
-    compile_process = subprocess.Popen( subs_compiler_command,
-        stdin = subprocess.PIPE, stdout = subprocess.PIPE, 
-        stderr = subprocess.PIPE )
+    compile_process = jobs.Popen( subs_compiler_command,
+        stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+        stderr = subprocess.PIPE, cwd = os.path.dirname( srcfilename ) )
     stdoutdata, stderrdata = compile_process.communicate()
+    runner.compile_usage = compile_process.usage
 
     if compile_process.returncode == 0:
         return None
@@ -129,10 +174,15 @@ def run_compile( subs_compiler_command, runner, srcfilename ):
         else:
             return "Unknown compile error - compiler did not write any output."
 
-def run_exe( exefilename, extra_args ):
-    run_process = subprocess.Popen([ exefilename, *extra_args],
-        stdout = subprocess.PIPE, stderr = subprocess.PIPE )
-    return run_process.communicate()
+def run_exe( exefilename, extra_args, timing_file = None ):
+    env, pass_fds = None, ()
+    if timing_file is not None:
+        env, pass_fds = probes.child_env( timing_file ), ( timing_file.fileno(), )
+    run_process = jobs.Popen([ exefilename, *extra_args],
+        stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+        env = env, pass_fds = pass_fds )
+    stdoutdata, stderrdata = run_process.communicate()
+    return stdoutdata, stderrdata, run_process.usage
 
 def print_welcome():
     print(f'''igo $version
@@ -150,6 +200,8 @@ class UserInput:
         self.typ = typ
         self.output_chars = 0
         self.error_chars = 0
+        self.pasted = False
+        self.cost = None
 
     def __str__( self ):
         return "UserInput( '%s', %d, %d, %d )" % (
@@ -167,7 +219,8 @@ class UserInput:
 
 class Runner:
 
-    def __init__( self, options, extra_options, inputfile, srcfilename, exefilename ):
+    def __init__( self, options, extra_options, inputfile, srcfilename, exefilename,
+            workspace = None ):
         self.options = options
         self.extra_options = extra_options
         self.inputfile = inputfile
@@ -178,70 +231,184 @@ class Runner:
         self.compile_error = ""
         self.output_chars_printed = 0
         self.error_chars_printed = 0
+        self.compile_usage = None
+        self.run_usage = None
+        self.workspace = workspace
+        self.cache = cache.ArtifactCache(
+            workspace.file( "cache" ) if workspace is not None else None )
+        self.cache_status = None
+        self.last_cache_status = None
+        self.jobs = jobs.JobControl( prompt )
+        self.reading = False
+        self.last_run = None
+        self.run_skipped = False
+        self.new_output = ""
+        self.new_error = ""
+        self.deferred = False
+        self.resync = False
 
     def do_run( self, session_args ):
         read_line = create_read_line_function( self.inputfile, prompt )
-        subs_compiler_command = get_compiler_command(
-            self.options, self.extra_options, self.srcfilename, self.exefilename )
+        self.start( session_args )
+        speculator = None
+        interactive = self.inputfile is None and sys.stdin.isatty()
+        if interactive:
+            self.jobs.foreground_wait = self.options.background_after
+            if self.options.speculate:
+                speculator = speculate.Speculator( self, source_code,
+                    compile_source, incl_re, UserInput, style = "go" )
+                speculator.start()
+
+        if self.options.resume:
+            self.process_line( ".load " + self.options.resume )
 
-        inp = 1
-        while inp is not None:
-            inp = self.inp = read_line()
-            if inp is not None:
-
-                col_inp, run_cmp = (
-                    dot_commands.process( inp, self ) )
-                if col_inp:
-                    if self.input_num < len( self.user_input ):
-                        self.user_input = self.user_input[ : self.input_num ]
-                    if incl_re.match( inp ) or not run_cmp:
-                        typ = UserInput.INCLUDE
-                        self.user_input.append( UserInput( self.inp, typ ) )
-                    else:
-                        typ = UserInput.COMMAND
-                        self.user_input.append( UserInput( "    " + self.inp, typ ) )
-                    self.input_num += 1
-
-                if run_cmp:
-                    # print compiler command
-                    if self.options.v > 1:
-                        print("$ " + ( " ".join( subs_compiler_command ) ))
-                    os.chdir("/tmp")
-                    self.compile_error = run_compile( subs_compiler_command,
-                    self, self.srcfilename )
-
-                    if self.compile_error is not None:
-                        err = self.compile_error.decode().strip('\n')
-                        if self.options.v > 2:
-                            print(err)
-                        # ignore some compiler errors
-                        elif (err.find("not used") < 0
-                          and err.find("found 'eof'") < 0
-                          and err.find("found '}'") < 0
-                          and err.find("end of file") < 0) or self.options.e:
-                            print("[Compile error - type .e to see it.]")
-                    else:
-                        if self.options.v > 0:
-                            print("session_args:", *session_args)
-                        stdoutdata, stderrdata = run_exe( self.exefilename,
-                            session_args )
-
-                        if len( stdoutdata ) > self.output_chars_printed:
-                            new_output = stdoutdata[self.output_chars_printed:]
-                            len_new_output = len( new_output )
-                            print(new_output.decode().strip('\n'))
-                            self.output_chars_printed += len_new_output
-                            self.user_input[ -1 ].output_chars = len_new_output
-
-                        if len( stderrdata ) > self.error_chars_printed:
-                            new_error = stderrdata[self.error_chars_printed:]
-                            len_new_error = len( new_error )
-                            print(new_error.decode().strip('\n'))
-                            self.error_chars_printed += len_new_error
-                            self.user_input[ -1 ].error_chars = len_new_error
+        try:
+            inp = 1
+            while inp is not None:
+                try:
+                    self.reading = True
+                    inp = read_line()
+                except KeyboardInterrupt:
+                    # Ctrl-C kills a background job, not the session
+                    print()
+                    self.jobs.kill()
+                    continue
+                finally:
+                    self.reading = False
+                if inp is not None and interactive:
+                    lines = paste.split( inp )
+                    for i, line in enumerate( lines ):
+                        self.process_line( line, defer = i + 1 < len( lines )
+                            or paste.pending() )
+                elif inp is not None:
+                    self.process_line( inp )
+        finally:
+            if speculator is not None:
+                speculator.stop()
+            if interactive:
+                session.autosave( self )
 
         print()
 
+    def start( self, session_args ):
+        self.session_args = session_args
+        self.subs_compiler_command = get_compiler_command(
+            self.options, self.extra_options, self.srcfilename, self.exefilename )
+
+    def process_line( self, inp, defer = False ):
+        if inp not in jobs.keep_running:
+            self.jobs.cancel()
+        self.inp = inp
+        if self.cache_status is not None:
+            self.last_cache_status = self.cache_status
+        self.cache_status = None
+        self.new_output = self.new_error = ""
+        col_inp, run_cmp = (
+            dot_commands.process( inp, self ) )
+        if col_inp:
+            if self.input_num < len( self.user_input ):
+                self.user_input = self.user_input[ : self.input_num ]
+            if incl_re.match( inp ) or not run_cmp:
+                typ = UserInput.INCLUDE
+                self.user_input.append( UserInput( self.inp, typ ) )
+            else:
+                typ = UserInput.COMMAND
+                self.user_input.append( UserInput( "    " + self.inp, typ ) )
+            self.input_num += 1
+
+        if self.resync:
+            self.resync = False
+            self.jobs.run( self.resync_cycle )
+        if run_cmp and defer:
+            # more pasted lines are waiting; build once, after the last
+            self.mark_pasted()
+            self.deferred = True
+        elif run_cmp or self.deferred:
+            if self.deferred:
+                self.mark_pasted()
+            self.deferred = False
+            self.jobs.run( self.run_cycle )
+
+    def mark_pasted( self ):
+        if self.input_num > 0:
+            self.user_input[ self.input_num - 1 ].pasted = True
+
+    def run_unchanged( self ):
+        return self.last_run == ( self.get_user_commands_string(),
+            self.output_chars_printed, self.error_chars_printed )
+
+    def run_cycle( self ):
+        # print compiler command
+        if self.options.v > 1:
+            print("$ " + ( " ".join( self.subs_compiler_command ) ))
+        self.compile_error = run_compile( self.subs_compiler_command,
+        self, self.srcfilename )
+        if jobs.cancelled():
+            return
+        if self.options.v > 1:
+            print(rusage.format_usage( "compile", self.compile_usage ))
+
+        if self.compile_error is not None:
+            err = self.compile_error.decode().strip('\n')
+            if self.options.v > 2:
+                print(err)
+            # ignore some compiler errors
+            elif (err.find("not used") < 0
+              and err.find("found 'eof'") < 0
+              and err.find("found '}'") < 0
+              and err.find("end of file") < 0) or self.options.e:
+                print("[Compile error - type .e to see it.]")
+        elif self.run_unchanged():
+            # main() is as it was when it last ran, and all that printed
+            # has been shown, so running it again would show nothing new
+            self.run_skipped = True
+            if self.options.time_statements:
+                # they were the last run's, and there is no new one
+                probes.store_timings( self, {} )
+        else:
+            self.run_skipped = False
+            if self.options.v > 0:
+                print("session_args:", *self.session_args)
+            timing_file = probes.open_timing_file() \
+                if self.options.time_statements else None
+            stdoutdata, stderrdata, self.run_usage = run_exe(
+                self.exefilename, self.session_args, timing_file )
+            if jobs.cancelled():
+                return
+            self.last_run = ( self.get_user_commands_string(),
+                len( stdoutdata ), len( stderrdata ) )
+            if self.options.v > 1:
+                print(rusage.format_usage( "run", self.run_usage ))
+            if timing_file is not None:
+                probes.store_timings( self,
+                    probes.read_timings( timing_file ) )
+
+            if len( stdoutdata ) > self.output_chars_printed:
+                new_output = stdoutdata[self.output_chars_printed:]
+                len_new_output = len( new_output )
+                self.new_output = new_output.decode()
+                print(self.new_output.strip('\n'))
+                self.output_chars_printed += len_new_output
+                self.user_input[ -1 ].output_chars = len_new_output
+
+            if len( stderrdata ) > self.error_chars_printed:
+                new_error = stderrdata[self.error_chars_printed:]
+                len_new_error = len( new_error )
+                self.new_error = new_error.decode()
+                print(self.new_error.strip('\n'))
+                self.error_chars_printed += len_new_error
+                self.user_input[ -1 ].error_chars = len_new_error
+
+    def resync_cycle( self ):
+        # a paste's output is counted against its last line, so after
+        # undoing into one, rebuild quietly to see what is still printed
+        last = self.user_input[ -1 ]
+        counted = last.output_chars, last.error_chars
+        self.output_chars_printed = self.error_chars_printed = 0
+        with jobs.quiet():
+            self.run_cycle()
+        last.output_chars, last.error_chars = counted
+
     def redo( self ):
         if self.input_num < len( self.user_input ):
             self.input_num += 1
@@ -254,8 +421,11 @@ class Runner:
         if self.input_num > 0:
             self.input_num -= 1
             undone_input = self.user_input[ self.input_num ]
-            self.output_chars_printed -= undone_input.output_chars
-            self.error_chars_printed -= undone_input.error_chars
+            if undone_input.pasted:
+                self.resync = True
+            else:
+                self.output_chars_printed -= undone_input.output_chars
+                self.error_chars_printed -= undone_input.error_chars
             return undone_input.inp
         else:
             return None
@@ -295,6 +465,22 @@ def parse_args( argv ):
             "be searched for library files." )
     parser.add_argument( "-l", dest="LIB", action="append",
         help = "Search the library LIB when linking." )
+    parser.add_argument( "--profile", choices=sorted( profile_commands ),
+        default="default",
+        help = "Build with -ldflags='-s -w' (strip) or " +
+            "-gcflags='all=-N -l' (debug) to build faster." )
+    parser.add_argument( "--time-statements", action="store_true",
+        help = "Time each statement and show the costs in .l listings." )
+    parser.add_argument( "--background-after", type=float, default=1.0,
+        help = "Seconds to wait for a compile and run before handing " +
+            "the prompt back (default 1)." )
+    parser.add_argument( "--speculate", action="store_true",
+        help = "Start compiling a line before Enter is pressed." )
+    parser.add_argument( "--resume", nargs="?", const="last", metavar="NAME",
+        help = "Carry on from a saved session (by default the last one)." )
+    parser.add_argument( "--jsonl", action="store_true",
+        help = "Read JSON requests on stdin and answer each with one " +
+            "line of JSON." )
     parser.add_argument( "-compiler_args", action="store_true",
         help = "Any compiler args can go here.")
     parser.add_argument( "--", nargs="+", dest="session_args",
@@ -311,30 +497,40 @@ def parse_args( argv ):
 
     return options, extra_compiler_args, session_args
 
+def create_runner( argv, inputfile = None ):
+    options, extra_args, session_args = parse_args( argv )
+    ws = workspace.Workspace( "igo" )
+    exefilename = get_temporary_file_name( ws )
+    srcfilename = os.path.join( ws.file( "module" ), "main.go" )
+    return Runner( options, extra_args, inputfile, srcfilename,
+        exefilename, ws ), session_args
+
+def remove_files( runner ):
+    runner.cache.clear()
+    runner.workspace.remove()
+
 def run( outputfile = sys.stdout, inputfile = None, print_welc = True,
         argv = None ):
-    exefilename = ""
+    runner = None
 
     # Use a with statement block to redirect sys.stdout
     with redirect_stdout(outputfile):
         try:
-            options, extra_args, session_args = parse_args(argv)
-
-            exefilename = get_temporary_file_name()
-            srcfilename = exefilename + ".go"
+            runner, session_args = create_runner( argv, inputfile )
             ret = "normal"
-            if print_welc:
+            if print_welc and not runner.options.jsonl:
                 print_welcome()
-            Runner(options, extra_args, inputfile, srcfilename, exefilename).do_run(session_args)
+            if runner.options.jsonl:
+                jsonl.serve( runner, session_args )
+            else:
+                runner.do_run(session_args)
         except dot_commands.IGCCQuitException:
             ret = "quit"
         except Exception as e:
             print(e)
             ret = "quit"
 
-    if os.path.isfile(exefilename): # never happens
-        os.remove(exefilename)
-    if os.path.isfile(srcfilename):
-        os.remove(srcfilename)
+    if runner is not None:
+        remove_files( runner )
 
     return ret
@@ -26,7 +26,6 @@ import re
 import readline
 import subprocess
 import sys
-import tempfile
 from contextlib import redirect_stdout
 from argparse import ArgumentParser
 from colorama import init, Fore, Back
@@ -34,13 +33,21 @@ from colorama import init, Fore, Back
 from . import dot_commands_hare as dot_commands
 from . import source_code_hare as source_code
 from . import version
+from . import rusage
+from . import jobs
+from . import speculate
+from . import cache
+from . import jsonl
+from . import workspace
+from . import paste
+from . import session
 
 # --------------
 
 # One day these will be in a config file
 
 prompt = "hare> "
-compiler_command = ( "hare", "build", "-vv", "$lib_dirs", "$libs", "-o", "$outfile", "$srcfile" )
+compiler_command = ( "hare", "build", "$verbose", "$lib_dirs", "$libs", "-o", "$outfile", "$srcfile" )
 
 include_dir_command = ( "-I$cmd", )
 lib_dir_command = ( "-L$cmd", )
@@ -71,16 +78,9 @@ def create_read_line_function( inputfile, prompt ):
     else:
         return lambda: read_line_from_file( inputfile, prompt )
 
-def get_temporary_file_names():
-    # write source to input file
+def get_temporary_file_names( ws ):
     suff = ".exe" if platform.system() == 'Windows' else ""
-    infile = tempfile.NamedTemporaryFile( prefix = 'ihare', suffix = '.ha' )
-    outfile = tempfile.NamedTemporaryFile( prefix = 'ohare', suffix = suff )
-    infilename = infile.name
-    outfilename = outfile.name
-    infile.close()
-    outfile.close()
-    return infilename, outfilename
+    return ws.file( "ihare.ha" ), ws.file( "ohare" + suff )
 
 def append_multiple( single_cmd, cmdlist, ret ):
     if cmdlist is not None:
@@ -93,12 +93,16 @@ def get_compiler_command( options, extra_options, srcfilename, exefilename ):
     ret = []
 
     for part in compiler_command:
-        if part == "$srcfile":
+        if part == "$verbose":
+            # hare build's progress is only worth piping when asked for
+            if options.v > 0:
+                ret.append( "-vv" )
+        elif part == "$srcfile":
             ret.append( part.replace( "$srcfile", srcfilename ) )
         #if part == "-o":
         #    append_multiple( extra_options, ["-o"], ret)
         elif part == "$lib_dirs":
-            append_multiple( lib_dir_command, options.LIBDIR,ret )
+            append_multiple( lib_dir_command, workspace.absolute( options.LIBDIR ), ret )
         elif part == "$libs":
             append_multiple( lib_command, options.LIB, ret )
         else:
@@ -106,18 +110,65 @@ def get_compiler_command( options, extra_options, srcfilename, exefilename ):
     return ret
 
 
-def run_compile( subs_compiler_command, runner, srcfilename ):
+def hare_cache():
+    """HARECACHE for our builds: the user's own if they set one,
+    otherwise ours, so the standard library is built once per toolchain
+    rather than wherever the environment happens to point."""
+    return os.environ.get( "HARECACHE" ) or workspace.user_cache( "ihare" )
+
+def snapshot( directory ):
+    """When each module's directory in the cache was last written to.
+    hare build adds files to a module's directory when it builds the
+    module, so this is enough to see which were rebuilt, without stat'ing
+    every file in a big cache.  Directories with no files of their own
+    only hold other modules."""
+    times = {}
+    for path, dirs, names in os.walk( directory ):
+        if names:
+            try:
+                times[path] = os.stat( path ).st_mtime_ns
+            except OSError:
+                pass
+    return times
+
+def count_rebuilt( before, after ):
+    """How many modules hare build wrote between two snapshots."""
+    return len( [ path for path, written in after.items()
+        if before.get( path ) != written ] )
 
+def run_compile( subs_compiler_command, runner, srcfilename ):
     source = source_code.get_full_source(runner)
     if runner.options.v > 2:
         print(source)
+    key = runner.cache.key( subs_compiler_command, source )
+    runner.cache.wait( key )
+    entry = runner.cache.fetch( key, runner.exefilename )
+    if entry is not None:
+        runner.cache_status = "hit"
+        runner.compile_usage = rusage.Usage( 0.0, None )
+        runner.compiler_cache = None
+        return entry.error
+    runner.cache_status = "miss"
+    cache.remove( runner.exefilename )
+    compile_error = compile_source( subs_compiler_command, runner,
+        srcfilename, source )
+    runner.cache.store( key, runner.exefilename, compile_error )
+    return compile_error
+
+def compile_source( subs_compiler_command, runner, srcfilename, source ):
     with open(srcfilename, 'w') as file:
         file.write(source)
         file.close()
-    compile_process = subprocess.Popen( subs_compiler_command,
-        stdin = subprocess.PIPE, stdout = subprocess.PIPE, 
-        stderr = subprocess.PIPE )
+    directory = hare_cache()
+    before = snapshot( directory )
+    compile_process = jobs.Popen( subs_compiler_command,
+        stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+        stderr = subprocess.PIPE, cwd = os.path.dirname( srcfilename ),
+        env = dict( os.environ, HARECACHE = directory ) )
     stdoutdata, stderrdata = compile_process.communicate()
+    runner.compile_usage = compile_process.usage
+    runner.compiler_cache = "%d modules rebuilt in %s" % (
+        count_rebuilt( before, snapshot( directory ) ), directory )
 
     if compile_process.returncode == 0:
         return None
@@ -133,9 +184,10 @@ def run_compile( subs_compiler_command, runner, srcfilename ):
             return "Unknown compile error - compiler did not write any output."
 
 def run_exe( exefilename, extra_args ):
-    run_process = subprocess.Popen([ exefilename, *extra_args],
+    run_process = jobs.Popen([ exefilename, *extra_args],
         stdout = subprocess.PIPE, stderr = subprocess.PIPE )
-    return run_process.communicate()
+    stdoutdata, stderrdata = run_process.communicate()
+    return stdoutdata, stderrdata, run_process.usage
 
 def print_welcome():
     print(f'''ihare $version
@@ -153,6 +205,7 @@ class UserInput:
         self.typ = typ
         self.output_chars = 0
         self.error_chars = 0
+        self.pasted = False
 
     def __str__( self ):
         return "UserInput( '%s', %d, %d, %d )" % (
@@ -170,7 +223,8 @@ class UserInput:
 
 class Runner:
 
-    def __init__( self, options, extra_options, inputfile, srcfilename, exefilename ):
+    def __init__( self, options, extra_options, inputfile, srcfilename, exefilename,
+            workspace = None ):
         self.options = options
         self.extra_options = extra_options
         self.inputfile = inputfile
@@ -181,67 +235,175 @@ class Runner:
         self.compile_error = ""
         self.output_chars_printed = 0
         self.error_chars_printed = 0
+        self.compile_usage = None
+        self.run_usage = None
+        self.workspace = workspace
+        self.cache = cache.ArtifactCache(
+            workspace.file( "cache" ) if workspace is not None else None )
+        self.cache_status = None
+        self.last_cache_status = None
+        self.compiler_cache = None
+        self.jobs = jobs.JobControl( prompt )
+        self.reading = False
+        self.last_run = None
+        self.run_skipped = False
+        self.new_output = ""
+        self.new_error = ""
+        self.deferred = False
+        self.resync = False
 
     def do_run( self, session_args ):
         read_line = create_read_line_function( self.inputfile, prompt )
-        subs_compiler_command = get_compiler_command(
-            self.options, self.extra_options, self.srcfilename, self.exefilename )
+        self.start( session_args )
+        speculator = None
+        interactive = self.inputfile is None and sys.stdin.isatty()
+        if interactive:
+            self.jobs.foreground_wait = self.options.background_after
+            if self.options.speculate:
+                speculator = speculate.Speculator( self, source_code,
+                    compile_source, incl_re, UserInput )
+                speculator.start()
+
+        if self.options.resume:
+            self.process_line( ".load " + self.options.resume )
 
-        inp = 1
-        while inp is not None:
-            inp = self.inp = read_line()
-            if inp is not None:
-
-                col_inp, run_cmp = (
-                    dot_commands.process( inp, self ) )
-                if col_inp:
-                    if self.input_num < len( self.user_input ):
-                        self.user_input = self.user_input[ : self.input_num ]
-                    if incl_re.match( inp ) or not run_cmp:
-                        typ = UserInput.INCLUDE
-                        self.user_input.append( UserInput( self.inp, typ ) )
-                    else:
-                        typ = UserInput.COMMAND
-                        self.user_input.append( UserInput( "    " + self.inp, typ ) )
-                    self.input_num += 1
-
-                if run_cmp:
-                    # print compiler command
-                    if self.options.v > 1:
-                        print("$ " + ( " ".join( subs_compiler_command ) ))
-                    self.compile_error = run_compile( subs_compiler_command,
-                    self, self.srcfilename )
-
-                    if self.compile_error is not None:
-                        err = self.compile_error.decode().strip('\n')
-                        if self.options.v > 2:
-                            print(err)
-                        elif (err.find("empty block") < 0
-                          and err.find("end of file") < 0
-                          and err.find("e', found '}'") < 0) or self.options.e:
-                            print("[Compile error - type .e to see it.]")
-                    else:
-                        if self.options.v > 0:
-                            print("session_args:", *session_args)
-                        stdoutdata, stderrdata = run_exe( self.exefilename,
-                            session_args )
-
-                        if len( stdoutdata ) > self.output_chars_printed:
-                            new_output = stdoutdata[self.output_chars_printed:]
-                            len_new_output = len( new_output )
-                            print(new_output.decode().strip('\n'))
-                            self.output_chars_printed += len_new_output
-                            self.user_input[ -1 ].output_chars = len_new_output
-
-                        if len( stderrdata ) > self.error_chars_printed:
-                            new_error = stderrdata[self.error_chars_printed:]
-                            len_new_error = len( new_error )
-                            print(new_error.decode().strip('\n'))
-                            self.error_chars_printed += len_new_error
-                            self.user_input[ -1 ].error_chars = len_new_error
+        try:
+            inp = 1
+            while inp is not None:
+                try:
+                    self.reading = True
+                    inp = read_line()
+                except KeyboardInterrupt:
+                    # Ctrl-C kills a background job, not the session
+                    print()
+                    self.jobs.kill()
+                    continue
+                finally:
+                    self.reading = False
+                if inp is not None and interactive:
+                    lines = paste.split( inp )
+                    for i, line in enumerate( lines ):
+                        self.process_line( line, defer = i + 1 < len( lines )
+                            or paste.pending() )
+                elif inp is not None:
+                    self.process_line( inp )
+        finally:
+            if speculator is not None:
+                speculator.stop()
+            if interactive:
+                session.autosave( self )
 
         print()
 
+    def start( self, session_args ):
+        self.session_args = session_args
+        self.subs_compiler_command = get_compiler_command(
+            self.options, self.extra_options, self.srcfilename, self.exefilename )
+
+    def process_line( self, inp, defer = False ):
+        if inp not in jobs.keep_running:
+            self.jobs.cancel()
+        self.inp = inp
+        if self.cache_status is not None:
+            self.last_cache_status = self.cache_status
+        self.cache_status = None
+        self.new_output = self.new_error = ""
+        col_inp, run_cmp = (
+            dot_commands.process( inp, self ) )
+        if col_inp:
+            if self.input_num < len( self.user_input ):
+                self.user_input = self.user_input[ : self.input_num ]
+            if incl_re.match( inp ) or not run_cmp:
+                typ = UserInput.INCLUDE
+                self.user_input.append( UserInput( self.inp, typ ) )
+            else:
+                typ = UserInput.COMMAND
+                self.user_input.append( UserInput( "    " + self.inp, typ ) )
+            self.input_num += 1
+
+        if self.resync:
+            self.resync = False
+            self.jobs.run( self.resync_cycle )
+        if run_cmp and defer:
+            # more pasted lines are waiting; build once, after the last
+            self.mark_pasted()
+            self.deferred = True
+        elif run_cmp or self.deferred:
+            if self.deferred:
+                self.mark_pasted()
+            self.deferred = False
+            self.jobs.run( self.run_cycle )
+
+    def mark_pasted( self ):
+        if self.input_num > 0:
+            self.user_input[ self.input_num - 1 ].pasted = True
+
+    def run_unchanged( self ):
+        return self.last_run == ( self.get_user_commands_string(),
+            self.output_chars_printed, self.error_chars_printed )
+
+    def run_cycle( self ):
+        # print compiler command
+        if self.options.v > 1:
+            print("$ " + ( " ".join( self.subs_compiler_command ) ))
+        self.compile_error = run_compile( self.subs_compiler_command,
+        self, self.srcfilename )
+        if jobs.cancelled():
+            return
+        if self.options.v > 1:
+            print(rusage.format_usage( "compile", self.compile_usage ))
+
+        if self.compile_error is not None:
+            err = self.compile_error.decode().strip('\n')
+            if self.options.v > 2:
+                print(err)
+            elif (err.find("empty block") < 0
+              and err.find("end of file") < 0
+              and err.find("e', found '}'") < 0) or self.options.e:
+                print("[Compile error - type .e to see it.]")
+        elif self.run_unchanged():
+            # main() is as it was when it last ran, and all that printed
+            # has been shown, so running it again would show nothing new
+            self.run_skipped = True
+        else:
+            self.run_skipped = False
+            if self.options.v > 0:
+                print("session_args:", *self.session_args)
+            stdoutdata, stderrdata, self.run_usage = run_exe(
+                self.exefilename, self.session_args )
+            if jobs.cancelled():
+                return
+            self.last_run = ( self.get_user_commands_string(),
+                len( stdoutdata ), len( stderrdata ) )
+            if self.options.v > 1:
+                print(rusage.format_usage( "run", self.run_usage ))
+
+            if len( stdoutdata ) > self.output_chars_printed:
+                new_output = stdoutdata[self.output_chars_printed:]
+                len_new_output = len( new_output )
+                self.new_output = new_output.decode()
+                print(self.new_output.strip('\n'))
+                self.output_chars_printed += len_new_output
+                self.user_input[ -1 ].output_chars = len_new_output
+
+            if len( stderrdata ) > self.error_chars_printed:
+                new_error = stderrdata[self.error_chars_printed:]
+                len_new_error = len( new_error )
+                self.new_error = new_error.decode()
+                print(self.new_error.strip('\n'))
+                self.error_chars_printed += len_new_error
+                self.user_input[ -1 ].error_chars = len_new_error
+
+    def resync_cycle( self ):
+        # a paste's output is counted against its last line, so after
+        # undoing into one, rebuild quietly to see what is still printed
+        last = self.user_input[ -1 ]
+        counted = last.output_chars, last.error_chars
+        self.output_chars_printed = self.error_chars_printed = 0
+        with jobs.quiet():
+            self.run_cycle()
+        last.output_chars, last.error_chars = counted
+
     def redo( self ):
         if self.input_num < len( self.user_input ):
             self.input_num += 1
@@ -254,8 +416,11 @@ class Runner:
         if self.input_num > 0:
             self.input_num -= 1
             undone_input = self.user_input[ self.input_num ]
-            self.output_chars_printed -= undone_input.output_chars
-            self.error_chars_printed -= undone_input.error_chars
+            if undone_input.pasted:
+                self.resync = True
+            else:
+                self.output_chars_printed -= undone_input.output_chars
+                self.error_chars_printed -= undone_input.error_chars
             return undone_input.inp
         else:
             return None
@@ -292,6 +457,16 @@ def parse_args( argv ):
             "be searched for library files." )
     parser.add_argument( "-l", dest="LIB", action="append",
         help = "Search the library LIB when linking." )
+    parser.add_argument( "--background-after", type=float, default=1.0,
+        help = "Seconds to wait for a compile and run before handing " +
+            "the prompt back (default 1)." )
+    parser.add_argument( "--speculate", action="store_true",
+        help = "Start compiling a line before Enter is pressed." )
+    parser.add_argument( "--resume", nargs="?", const="last", metavar="NAME",
+        help = "Carry on from a saved session (by default the last one)." )
+    parser.add_argument( "--jsonl", action="store_true",
+        help = "Read JSON requests on stdin and answer each with one " +
+            "line of JSON." )
     parser.add_argument( "-compiler_args", action="store_true",
         help = "Any compiler args can go here.")
     parser.add_argument( "--", nargs="+", dest="session_args",
@@ -308,27 +483,37 @@ def parse_args( argv ):
 
     return options, extra_compiler_args, session_args
 
+def create_runner( argv, inputfile = None ):
+    options, extra_args, session_args = parse_args( argv )
+    ws = workspace.Workspace( "ihare" )
+    srcfilename, exefilename = get_temporary_file_names( ws )
+    return Runner( options, extra_args, inputfile, srcfilename,
+        exefilename, ws ), session_args
+
+def remove_files( runner ):
+    runner.cache.clear()
+    runner.workspace.remove()
+
 def run( outputfile = sys.stdout, inputfile = None, print_welc = True,
         argv = None ):
-    exefilename = ""
+    runner = None
 
     # Use a with statement block to redirect sys.stdout
     with redirect_stdout(outputfile):
         try:
-            options, extra_args, session_args = parse_args(argv)
-
-            srcfilename, exefilename = get_temporary_file_names()
+            runner, session_args = create_runner( argv, inputfile )
             ret = "normal"
-            if print_welc:
+            if print_welc and not runner.options.jsonl:
                 print_welcome()
-            Runner(options, extra_args, inputfile, srcfilename, exefilename).do_run(session_args)
+            if runner.options.jsonl:
+                jsonl.serve( runner, session_args )
+            else:
+                runner.do_run(session_args)
         except Exception as e:
             print(e)
             ret = "quit"
 
-    if os.path.isfile(exefilename):
-        os.remove(exefilename)
-    if os.path.isfile(srcfilename):
-        os.remove(srcfilename)
+    if runner is not None:
+        remove_files( runner )
 
     return ret
@@ -20,13 +20,10 @@
 
 import itertools
 import platform
-import os
-import os.path
 import re
 import readline
 import subprocess
 import sys
-import tempfile
 from contextlib import redirect_stdout
 from argparse import ArgumentParser
 from colorama import init, Fore, Back
@@ -34,18 +31,44 @@ from colorama import init, Fore, Back
 from . import dot_commands_rs as dot_commands
 from . import source_code_rs as source_code
 from . import version
+from . import rusage
+from . import jobs
+from . import speculate
+from . import cache
+from . import jsonl
+from . import workspace
+from . import paste
+from . import session
+from . import units
+from . import linker
+from . import rustdeps
+from . import probes
+from . import datamap
 
 # --------------
 
 # One day these will be in a config file
 
 prompt = "rust> "
-compiler_command = ( 'rustc', "$lib_dirs", "$libs", "-o", "$outfile", "-" )
+compiler_command = ( 'rustc', "$lib_dirs", "$libs", "$objects", "$iteration",
+    "-o", "$outfile", "$srcfile" )
+
+# fast iteration: reuse the last build's work, and don't spend long
+# optimizing for parallel codegen on tiny crates
+iteration_command = ( "-C", "incremental=$incremental", "-C", "codegen-units=16" )
 
 include_dir_command = ( "-I$cmd", )
 lib_dir_command = ( "-L$cmd", )
 lib_command = ( "-l$cmd", )
 
+# extra crates added with .add, and how they are linked
+unit_commands = {
+    ".rs" : ( "rustc", "--crate-type=rlib", "--crate-name", "$name",
+        "--emit=link=$outfile,dep-info=$depfile", "$srcfile" ),
+    }
+unit_link_prefix = ()
+unit_link_command = ( "--extern", "$name=$outfile" )
+
 #---------------
 
 incl_re = re.compile( r"\s*(use|extern|#\S+)\s" )
@@ -71,12 +94,9 @@ def create_read_line_function( inputfile, prompt ):
     else:
         return lambda: read_line_from_file( inputfile, prompt )
 
-def get_temporary_file_name():
+def get_temporary_file_name( ws ):
     suff = ".exe" if platform.system() == 'Windows' else ""
-    outfile = tempfile.NamedTemporaryFile( prefix = 'irust', suffix = suff )
-    outfilename = outfile.name
-    outfile.close()
-    return outfilename
+    return ws.file( "irust" + suff )
 
 def append_multiple( single_cmd, cmdlist, ret ):
     if cmdlist is not None:
@@ -85,7 +105,8 @@ def append_multiple( single_cmd, cmdlist, ret ):
                 ret.append(
                     cmd_part.replace( "$cmd" , cmd ) )
 
-def get_compiler_command( options, extra_options, outfilename ):
+def get_compiler_command( options, extra_options, srcfilename, outfilename,
+        objects = (), incremental = None ):
     ret = []
 
     for part in compiler_command:
@@ -97,20 +118,45 @@ def get_compiler_command( options, extra_options, outfilename ):
             append_multiple( lib_dir_command, options.LIBDIR,ret )
         elif part == "$libs":
             append_multiple( lib_command, options.LIB, ret )
+        elif part == "$objects":
+            ret += objects
+        elif part == "$iteration":
+            if not options.no_incremental and incremental is not None:
+                ret += [ p.replace( "$incremental", incremental )
+                    for p in iteration_command ]
         else:
-            ret.append( part.replace( "$outfile", outfilename ) )
+            ret.append( part.replace( "$outfile", outfilename )
+                .replace( "$srcfile", srcfilename ) )
 
     return ret
 
 
-def run_compile( subs_compiler_command, runner ):
-    compile_process = subprocess.Popen( subs_compiler_command,
-        stdin = subprocess.PIPE, stderr = subprocess.PIPE )
+def run_compile( subs_compiler_command, runner, srcfilename ):
     source = source_code.get_full_source(runner)
     if runner.options.v > 2:
         print(source)
-    stdoutdata, stderrdata = compile_process.communicate(
-        source.encode('utf-8') )
+    key = runner.cache.key( subs_compiler_command, source )
+    runner.cache.wait( key )
+    entry = runner.cache.fetch( key, runner.exefilename )
+    if entry is not None:
+        runner.cache_status = "hit"
+        runner.compile_usage = rusage.Usage( 0.0, None )
+        return entry.error
+    runner.cache_status = "miss"
+    cache.remove( runner.exefilename )
+    compile_error = compile_source( subs_compiler_command, runner,
+        srcfilename, source )
+    runner.cache.store( key, runner.exefilename, compile_error )
+    return compile_error
+
+def compile_source( subs_compiler_command, runner, srcfilename, source ):
+    # always the same file, so incremental builds find their way back
+    with open( srcfilename, 'w' ) as file:
+        file.write( source )
+    compile_process = jobs.Popen( subs_compiler_command,
+        stdin = subprocess.PIPE, stderr = subprocess.PIPE )
+    stdoutdata, stderrdata = compile_process.communicate()
+    runner.compile_usage = compile_process.usage
 
     if compile_process.returncode == 0:
         return None
@@ -125,10 +171,15 @@ def run_compile( subs_compiler_command, runner ):
         else:
             return "Unknown compile error - compiler did not write any output."
 
-def run_exe( exefilename, extra_args ):
-    run_process = subprocess.Popen([ exefilename, *extra_args],
-        stdout = subprocess.PIPE, stderr = subprocess.PIPE )
-    return run_process.communicate()
+def run_exe( exefilename, extra_args, timing_file = None ):
+    env, pass_fds = None, ()
+    if timing_file is not None:
+        env, pass_fds = probes.child_env( timing_file ), ( timing_file.fileno(), )
+    run_process = jobs.Popen([ exefilename, *extra_args],
+        stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+        env = env, pass_fds = pass_fds )
+    stdoutdata, stderrdata = run_process.communicate()
+    return stdoutdata, stderrdata, run_process.usage
 
 def print_welcome():
     print(f'''irust $version
@@ -146,6 +197,8 @@ class UserInput:
         self.typ = typ
         self.output_chars = 0
         self.error_chars = 0
+        self.pasted = False
+        self.cost = None
 
     def __str__( self ):
         return "UserInput( '%s', %d, %d, %d )" % (
@@ -163,76 +216,215 @@ class UserInput:
 
 class Runner:
 
-    def __init__( self, options, extra_options, inputfile, exefilename ):
+    def __init__( self, options, extra_options, inputfile, exefilename,
+            workspace = None, srcfilename = None ):
         self.options = options
         self.extra_options = extra_options
         self.inputfile = inputfile
         self.exefilename = exefilename
+        self.srcfilename = srcfilename
         self.user_input = []
         self.input_num = 0
         self.compile_error = ""
         self.output_chars_printed = 0
         self.error_chars_printed = 0
+        self.compile_usage = None
+        self.run_usage = None
+        self.workspace = workspace
+        self.cache = cache.ArtifactCache(
+            workspace.file( "cache" ) if workspace is not None else None )
+        self.cache_status = None
+        self.last_cache_status = None
+        self.jobs = jobs.JobControl( prompt )
+        self.data_maps = datamap.DataMaps()
+        self.units = units.Units(
+            workspace.file( "units" ) if workspace is not None else None,
+            unit_commands, unit_link_command, unit_link_prefix )
+        self.deps = rustdeps.Registry()
+        # rustc locks it and rewrites it on every build, so it can't be
+        # shared with other sessions
+        self.incremental_dir = workspace.file( "incremental" ) \
+            if workspace is not None else None
+        self.reading = False
+        self.last_run = None
+        self.run_skipped = False
+        self.new_output = ""
+        self.new_error = ""
+        self.deferred = False
+        self.resync = False
 
     def do_run( self, session_args ):
         read_line = create_read_line_function( self.inputfile, prompt )
-        subs_compiler_command = get_compiler_command(
-            self.options, self.extra_options, self.exefilename )
-
-        inp = 1
-        while inp is not None:
-            inp = self.inp = read_line()
-            if inp is not None:
-
-                col_inp, run_cmp = (
-                    dot_commands.process( inp, self ) )
-                if col_inp:
-                    if self.input_num < len( self.user_input ):
-                        self.user_input = self.user_input[ : self.input_num ]
-                    if incl_re.match( inp ) or not run_cmp:
-                        typ = UserInput.INCLUDE
-                        self.user_input.append( UserInput( self.inp, typ ) )
-                    else:
-                        typ = UserInput.COMMAND
-                        self.user_input.append( UserInput( "    " + self.inp, typ ) )
-                    self.input_num += 1
-
-                if run_cmp:
-                    # print compiler command
-                    if self.options.v > 1:
-                        print("$ " + ( " ".join( subs_compiler_command ) ))
-                    self.compile_error = run_compile( subs_compiler_command,
-                        self )
-
-                    if self.compile_error is not None:
-                        err = self.compile_error.decode().strip('\n')
-                        if self.options.v > 2:
-                            print(err)
-                        elif (err.find("unclosed") < 0
-                          and err.find("end of file") < 0) or self.options.e:
-                            print("[Compile error - type .e to see it.]")
-                    else:
-                        if self.options.v > 0:
-                            print("session_args:", *session_args)
-                        stdoutdata, stderrdata = run_exe( self.exefilename,
-                            session_args )
-
-                        if len( stdoutdata ) > self.output_chars_printed:
-                            new_output = stdoutdata[self.output_chars_printed:]
-                            len_new_output = len( new_output )
-                            print(new_output.decode().strip('\n'))
-                            self.output_chars_printed += len_new_output
-                            self.user_input[ -1 ].output_chars = len_new_output
-
-                        if len( stderrdata ) > self.error_chars_printed:
-                            new_error = stderrdata[self.error_chars_printed:]
-                            len_new_error = len( new_error )
-                            print(new_error.decode().strip('\n'))
-                            self.error_chars_printed += len_new_error
-                            self.user_input[ -1 ].error_chars = len_new_error
+        self.start( session_args )
+        speculator = None
+        interactive = self.inputfile is None and sys.stdin.isatty()
+        if interactive:
+            self.jobs.foreground_wait = self.options.background_after
+            if self.options.speculate:
+                speculator = speculate.Speculator( self, source_code,
+                    compile_source, incl_re, UserInput )
+                speculator.start()
+
+        if self.options.resume:
+            self.process_line( ".load " + self.options.resume )
+
+        try:
+            inp = 1
+            while inp is not None:
+                try:
+                    self.reading = True
+                    inp = read_line()
+                except KeyboardInterrupt:
+                    # Ctrl-C kills a background job, not the session
+                    print()
+                    self.jobs.kill()
+                    continue
+                finally:
+                    self.reading = False
+                if inp is not None and interactive:
+                    lines = paste.split( inp )
+                    for i, line in enumerate( lines ):
+                        self.process_line( line, defer = i + 1 < len( lines )
+                            or paste.pending() )
+                elif inp is not None:
+                    self.process_line( inp )
+        finally:
+            if speculator is not None:
+                speculator.stop()
+            if interactive:
+                session.autosave( self )
 
         print()
 
+    def start( self, session_args ):
+        self.session_args = session_args
+        self.subs_compiler_command = get_compiler_command(
+            self.options, self.extra_options, self.srcfilename,
+            self.exefilename, self.units.link_args() + self.deps.link_args(),
+            self.incremental_dir )
+        self.link_strategy = linker.choose( "rustc", compiler_command[0],
+            self.options.linker )
+        self.subs_compiler_command += self.link_strategy.args()
+
+    def process_line( self, inp, defer = False ):
+        if inp not in jobs.keep_running:
+            self.jobs.cancel()
+        self.inp = inp
+        if self.cache_status is not None:
+            self.last_cache_status = self.cache_status
+        self.cache_status = None
+        self.new_output = self.new_error = ""
+        col_inp, run_cmp = (
+            dot_commands.process( inp, self ) )
+        if col_inp:
+            if self.input_num < len( self.user_input ):
+                self.user_input = self.user_input[ : self.input_num ]
+            if incl_re.match( inp ) or not run_cmp:
+                typ = UserInput.INCLUDE
+                self.user_input.append( UserInput( self.inp, typ ) )
+            else:
+                typ = UserInput.COMMAND
+                self.user_input.append( UserInput( "    " + self.inp, typ ) )
+            self.input_num += 1
+
+        if self.resync:
+            self.resync = False
+            self.jobs.run( self.resync_cycle )
+        if run_cmp and defer:
+            # more pasted lines are waiting; build once, after the last
+            self.mark_pasted()
+            self.deferred = True
+        elif run_cmp or self.deferred:
+            if self.deferred:
+                self.mark_pasted()
+            self.deferred = False
+            self.jobs.run( self.run_cycle )
+
+    def mark_pasted( self ):
+        if self.input_num > 0:
+            self.user_input[ self.input_num - 1 ].pasted = True
+
+    def run_unchanged( self ):
+        return self.last_run == ( self.get_user_commands_string(),
+            self.output_chars_printed, self.error_chars_printed )
+
+    def run_cycle( self ):
+        # files added with .add and crates added with .dep first, then
+        # the program linked with them
+        self.compile_error = self.units.build( self.options )
+        if self.compile_error is None:
+            self.compile_error = self.deps.build()
+        if self.compile_error is None:
+            if len( self.units ) > 0 or len( self.deps ) > 0:
+                self.start( self.session_args )
+            # print compiler command
+            if self.options.v > 1:
+                print("$ " + ( " ".join( self.subs_compiler_command ) ))
+            self.compile_error = run_compile( self.subs_compiler_command,
+                self, self.srcfilename )
+        if jobs.cancelled():
+            return
+        if self.options.v > 1:
+            print(rusage.format_usage( "compile", self.compile_usage ))
+
+        if self.compile_error is not None:
+            err = self.compile_error.decode().strip('\n')
+            if self.options.v > 2:
+                print(err)
+            elif (err.find("unclosed") < 0
+              and err.find("end of file") < 0) or self.options.e:
+                print("[Compile error - type .e to see it.]")
+        elif self.run_unchanged():
+            # main() is as it was when it last ran, and all that printed
+            # has been shown, so running it again would show nothing new
+            self.run_skipped = True
+            if self.options.time_statements:
+                # they were the last run's, and there is no new one
+                probes.store_timings( self, {} )
+        else:
+            self.run_skipped = False
+            if self.options.v > 0:
+                print("session_args:", *self.session_args)
+            timing_file = probes.open_timing_file() \
+                if self.options.time_statements else None
+            stdoutdata, stderrdata, self.run_usage = run_exe(
+                self.exefilename, self.session_args, timing_file )
+            if jobs.cancelled():
+                return
+            self.last_run = ( self.get_user_commands_string(),
+                len( stdoutdata ), len( stderrdata ) )
+            if self.options.v > 1:
+                print(rusage.format_usage( "run", self.run_usage ))
+            if timing_file is not None:
+                probes.store_timings( self,
+                    probes.read_timings( timing_file ) )
+
+            if len( stdoutdata ) > self.output_chars_printed:
+                new_output = stdoutdata[self.output_chars_printed:]
+                len_new_output = len( new_output )
+                self.new_output = new_output.decode()
+                print(self.new_output.strip('\n'))
+                self.output_chars_printed += len_new_output
+                self.user_input[ -1 ].output_chars = len_new_output
+
+            if len( stderrdata ) > self.error_chars_printed:
+                new_error = stderrdata[self.error_chars_printed:]
+                len_new_error = len( new_error )
+                self.new_error = new_error.decode()
+                print(self.new_error.strip('\n'))
+                self.error_chars_printed += len_new_error
+                self.user_input[ -1 ].error_chars = len_new_error
+
+    def resync_cycle( self ):
+        # a paste's output is counted against its last line, so after
+        # undoing into one, rebuild quietly to see what is still printed
+        last = self.user_input[ -1 ]
+        counted = last.output_chars, last.error_chars
+        self.output_chars_printed = self.error_chars_printed = 0
+        with jobs.quiet():
+            self.run_cycle()
+        last.output_chars, last.error_chars = counted
+
     def redo( self ):
         if self.input_num < len( self.user_input ):
             self.input_num += 1
@@ -245,8 +437,11 @@ class Runner:
         if self.input_num > 0:
             self.input_num -= 1
             undone_input = self.user_input[ self.input_num ]
-            self.output_chars_printed -= undone_input.output_chars
-            self.error_chars_printed -= undone_input.error_chars
+            if undone_input.pasted:
+                self.resync = True
+            else:
+                self.output_chars_printed -= undone_input.output_chars
+                self.error_chars_printed -= undone_input.error_chars
             return undone_input.inp
         else:
             return None
@@ -286,6 +481,23 @@ def parse_args( argv ):
             "be searched for library files." )
     parser.add_argument( "-l", dest="LIB", action="append",
         help = "Search the library LIB when linking." )
+    parser.add_argument( "--time-statements", action="store_true",
+        help = "Time each statement and show the costs in .l listings." )
+    parser.add_argument( "--no-incremental", action="store_true",
+        help = "Compile every line from scratch." )
+    parser.add_argument( "--linker", default="auto",
+        help = "Linker to use: auto (the fastest, found by timing them), " +
+            "default, or a name such as mold or lld." )
+    parser.add_argument( "--background-after", type=float, default=1.0,
+        help = "Seconds to wait for a compile and run before handing " +
+            "the prompt back (default 1)." )
+    parser.add_argument( "--speculate", action="store_true",
+        help = "Start compiling a line before Enter is pressed." )
+    parser.add_argument( "--resume", nargs="?", const="last", metavar="NAME",
+        help = "Carry on from a saved session (by default the last one)." )
+    parser.add_argument( "--jsonl", action="store_true",
+        help = "Read JSON requests on stdin and answer each with one " +
+            "line of JSON." )
     parser.add_argument( "-compiler_args", action="store_true",
         help = "Any compiler args can go here.")
     parser.add_argument( "--", nargs="+", dest="session_args",
@@ -302,25 +514,38 @@ def parse_args( argv ):
 
     return options, extra_compiler_args, session_args
 
+def create_runner( argv, inputfile = None ):
+    options, extra_args, session_args = parse_args( argv )
+    ws = workspace.Workspace( "irust" )
+    exefilename = get_temporary_file_name( ws )
+    srcfilename = ws.file( "irust.rs" )
+    return Runner( options, extra_args, inputfile, exefilename, ws,
+        srcfilename ), session_args
+
+def remove_files( runner ):
+    runner.cache.clear()
+    runner.workspace.remove()
+
 def run( outputfile = sys.stdout, inputfile = None, print_welc = True,
         argv = None ):
-    exefilename = ""
+    runner = None
 
     # Use a with statement block to redirect sys.stdout
     with redirect_stdout(outputfile):
         try:
-            options, extra_args, session_args = parse_args(argv)
-
-            exefilename = get_temporary_file_name()
+            runner, session_args = create_runner( argv, inputfile )
             ret = "normal"
-            if print_welc:
+            if print_welc and not runner.options.jsonl:
                 print_welcome()
-            Runner(options, extra_args, inputfile, exefilename).do_run(session_args)
+            if runner.options.jsonl:
+                jsonl.serve( runner, session_args )
+            else:
+                runner.do_run(session_args)
         except Exception as e:
             print(e)
             ret = "quit"
 
-    if os.path.isfile(exefilename):
-        os.remove(exefilename)
+    if runner is not None:
+        remove_files( runner )
 
     return ret
@@ -0,0 +1,131 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# Resource accounting for the compilers and programs we run.
+#
+# Popen.communicate() reaps its child with waitpid(), which throws the
+# child's rusage away.  Our Popen reaps with os.wait4() instead and keeps
+# it, along with the wall clock time, in process.usage.
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+class Usage:
+
+    def __init__( self, wall, ru ):
+        self.wall = wall
+        self.ru = ru
+
+    def max_rss_kb( self ):
+        # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+        if sys.platform == "darwin":
+            return self.ru.ru_maxrss // 1024
+        return self.ru.ru_maxrss
+
+    def __str__( self ):
+        if self.ru is None:
+            return "%.3f s wall" % self.wall
+        return ( "%.3f s wall, %.3f s user, %.3f s sys, max RSS %.1f MB, "
+            "faults %d major / %d minor, switches %d vol / %d invol" % (
+            self.wall, self.ru.ru_utime, self.ru.ru_stime,
+            self.max_rss_kb() / 1024.0, self.ru.ru_majflt, self.ru.ru_minflt,
+            self.ru.ru_nvcsw, self.ru.ru_nivcsw ) )
+
+class Popen( subprocess.Popen ):
+
+    def __init__( self, *args, **kwargs ):
+        self.start_time = time.monotonic()
+        self.usage = None
+        super().__init__( *args, **kwargs )
+
+    def communicate( self, input = None, timeout = None ):
+        if timeout is not None or not hasattr( os, "wait4" ):
+            ret = super().communicate( input, timeout )
+            self.usage = Usage( time.monotonic() - self.start_time, None )
+            return ret
+
+        output = {}
+        def drain( name, pipe ):
+            output[name] = pipe.read()
+            pipe.close()
+
+        threads = []
+        for name in ( "stdout", "stderr" ):
+            pipe = getattr( self, name )
+            if pipe is not None:
+                thread = threading.Thread( target = drain, args = ( name, pipe ),
+                    daemon = True )
+                thread.start()
+                threads.append( thread )
+        if self.stdin is not None:
+            try:
+                if input:
+                    self.stdin.write( input )
+                self.stdin.close()
+            except BrokenPipeError:
+                pass
+        for thread in threads:
+            thread.join()
+        self.reap()
+        return output.get( "stdout" ), output.get( "stderr" )
+
+    def wait( self, timeout = None ):
+        if self.returncode is None and timeout is None and hasattr( os, "wait4" ):
+            self.reap()
+        return super().wait( timeout )
+
+    def reap( self ):
+        try:
+            pid, status, ru = os.wait4( self.pid, 0 )
+            self.returncode = os.waitstatus_to_exitcode( status )
+        except ChildProcessError:
+            # somebody else reaped it; let subprocess sort out the status
+            ru = None
+            super().wait()
+        self.usage = Usage( time.monotonic() - self.start_time, ru )
+
+def format_usage( label, usage ):
+    if usage is None:
+        return "%s: nothing run yet" % label
+    return "%s: %s" % ( label, usage )
+
+def format_timings( runner ):
+    """What .t shows: the last compile and run, and how we link."""
+    compiled = "nothing compiled yet"
+    if runner.compile_usage is not None:
+        compiled = "%.3f s" % runner.compile_usage.wall
+        if runner.last_cache_status is not None:
+            compiled += " (cache %s)" % runner.last_cache_status
+    ran = "nothing run yet"
+    if runner.run_usage is not None:
+        ran = "%.3f s" % runner.run_usage.wall
+    if getattr( runner, "run_skipped", False ):
+        ran = "skipped - the commands were the same as last time"
+    lines = [ "compile: " + compiled, "run: " + ran ]
+    strategy = getattr( runner, "link_strategy", None )
+    if strategy is not None:
+        lines.append( "link: %s" % strategy )
+    compiler_cache = getattr( runner, "compiler_cache", None )
+    if compiler_cache is not None:
+        lines.append( "compiler cache: %s" % compiler_cache )
+    return "\n".join( lines )
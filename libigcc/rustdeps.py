@@ -0,0 +1,201 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+
+# Local crates for irust, added with .dep name=/path/to/crate.
+#
+# Each crate is built into an rlib once and kept in ~/.cache/itcc/irust/deps,
+# named after a hash of its sources, its build flags, the rlibs it was
+# built against and the rustc version, so any session on the machine can
+# reuse it and a change to any of those builds a new one.  The crates a
+# user has added are remembered in deps.json next to them, and every
+# session passes them to rustc with --extern.  Crates are built in the
+# order they were added, so add a crate's own dependencies first.  We
+# read Cargo.toml for the edition, the library's path and its default
+# features, and nothing else: there is no build.rs support.
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+from . import jobs
+from . import workspace
+
+build_command = ( "rustc", "--crate-type=rlib", "--crate-name", "$name",
+    "--edition", "$edition", "-C", "opt-level=2", "--cap-lints", "allow",
+    "-L", "dependency=$directory", "-o", "$outfile", "$srcfile" )
+
+def read_manifest( path ):
+    """edition, library source file and default features of a crate"""
+    if os.path.isfile( path ):
+        return "2021", path, []
+    manifest = {}
+    try:
+        with open( os.path.join( path, "Cargo.toml" ), "rb" ) as f:
+            text = f.read()
+        if tomllib is not None:
+            manifest = tomllib.loads( text.decode( "utf-8" ) )
+        else:
+            m = re.search( rb'^edition\s*=\s*"(\d+)"', text, re.M )
+            manifest = { "package" : { "edition" : m.group( 1 ).decode() } } \
+                if m else {}
+    except ( OSError, ValueError ):
+        pass
+    edition = manifest.get( "package", {} ).get( "edition", "2015" )
+    srcfile = os.path.join( path,
+        manifest.get( "lib", {} ).get( "path", "src/lib.rs" ) )
+    features = manifest.get( "features", {} ).get( "default", [] )
+    # "dep:x" and "x/y" turn on optional dependencies we don't have
+    features = [ f for f in features if ":" not in f and "/" not in f ]
+    return edition, srcfile, features
+
+def source_hash( path ):
+    h = hashlib.sha256()
+    if os.path.isfile( path ):
+        files = [ path ]
+    else:
+        files = []
+        for root, dirs, names in os.walk( path ):
+            dirs[:] = sorted( d for d in dirs
+                if d not in ( "target", ".git", "tests", "benches" ) )
+            files += [ os.path.join( root, n ) for n in sorted( names )
+                if n.endswith( ".rs" ) or n == "Cargo.toml" ]
+    for filename in files:
+        h.update( os.path.relpath( filename, path ).encode() + b"\0" )
+        with open( filename, "rb" ) as f:
+            h.update( f.read() )
+    return h.hexdigest()
+
+def rustc_version():
+    try:
+        return subprocess.run( [ "rustc", "-vV" ], capture_output = True,
+            text = True ).stdout
+    except OSError:
+        return ""
+
+class Registry:
+
+    def __init__( self ):
+        self.directory = workspace.user_cache( "irust", "deps" )
+        self.filename = os.path.join( workspace.user_cache( "irust" ),
+            "deps.json" )
+        try:
+            with open( self.filename ) as f:
+                self.crates = json.load( f )
+        except ( OSError, ValueError ):
+            self.crates = {}
+        # name -> rlib, for crates checked in this session
+        self.rlibs = {}
+        self.version = None
+
+    def __len__( self ):
+        return len( self.crates )
+
+    def save( self ):
+        tmpname = "%s.%d" % ( self.filename, os.getpid() )
+        with open( tmpname, "w" ) as f:
+            json.dump( self.crates, f, indent = 1 )
+        os.replace( tmpname, self.filename )
+
+    def add( self, name, path ):
+        if not re.match( r"^[A-Za-z_][A-Za-z0-9_]*$", name ):
+            raise ValueError( "crate names are letters, digits and _" )
+        path = os.path.abspath( os.path.expanduser( path ) )
+        if not os.path.exists( path ):
+            raise OSError( "no such crate" )
+        self.crates.pop( name, None )
+        self.crates[name] = path
+        # crates added after it may have been built against the old one
+        self.rlibs = {}
+        self.save()
+
+    def forget( self, name ):
+        if self.crates.pop( name, None ) is None:
+            return False
+        self.rlibs = {}
+        self.save()
+        return True
+
+    def describe( self ):
+        if not self.crates:
+            return "[No crates. Add one with .dep name=/path/to/crate.]"
+        return "\n".join( "%s = %s%s" % ( name, path,
+            "" if os.path.exists( path ) else " (missing)" )
+            for name, path in self.crates.items() )
+
+    def link_args( self ):
+        ret = []
+        for name, rlib in self.rlibs.items():
+            ret += [ "--extern", "%s=%s" % ( name, rlib ) ]
+        if ret:
+            ret += [ "-L", "dependency=" + self.directory ]
+        return ret
+
+    def build( self ):
+        """Make sure every crate has its rlib.  Returns rustc's complaints,
+        or None."""
+        for name, path in self.crates.items():
+            # a crate that has gone away is no reason to stop
+            if name not in self.rlibs and os.path.exists( path ):
+                error = self.build_crate( name, path )
+                if error is not None:
+                    return error
+        return None
+
+    def build_crate( self, name, path ):
+        if self.version is None:
+            self.version = rustc_version()
+        try:
+            edition, srcfile, features = read_manifest( path )
+            h = hashlib.sha256()
+            h.update( source_hash( path ).encode() )
+        except OSError as e:
+            return ( "crate %s: %s\n" % ( name, e ) ).encode()
+        command = [ part.replace( "$name", name )
+            .replace( "$edition", edition )
+            .replace( "$directory", self.directory )
+            .replace( "$srcfile", srcfile ) for part in build_command ]
+        for feature in features:
+            command += [ "--cfg", 'feature="%s"' % feature ]
+        # the crates added before this one may be its dependencies
+        for other, rlib in self.rlibs.items():
+            command += [ "--extern", "%s=%s" % ( other, rlib ) ]
+        h.update( "\0".join( command ).encode() )
+        h.update( self.version.encode() )
+        rlib = os.path.join( self.directory,
+            "lib%s-%s.rlib" % ( name, h.hexdigest()[:16] ) )
+        if not os.path.isfile( rlib ):
+            tmpfile = "%s.%d.tmp" % ( rlib[:-len( ".rlib" )], os.getpid() )
+            process = jobs.Popen( [ tmpfile + ".rlib" if part == "$outfile"
+                else part for part in command ],
+                stdout = subprocess.PIPE, stderr = subprocess.PIPE )
+            stdoutdata, stderrdata = process.communicate()
+            if process.returncode != 0:
+                return ( "crate %s:\n" % name ).encode() + stdoutdata + stderrdata
+            os.replace( tmpfile + ".rlib", rlib )
+        self.rlibs[name] = rlib
+        return None
@@ -0,0 +1,457 @@
+# iserver - many itcc/igcc/irust/... sessions behind one socket
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# The protocol is plain lines, so socat or nc make a usable client.
+# The server greets, the client answers "new <backend> [args]" or
+# "attach <session>", and from then on every line is REPL input.  Each
+# reply is the output followed by the backend's prompt.  Lines starting
+# with ':' talk to the server itself: :metrics, :detach and :quit.  The
+# Unix socket is only open to its owner; a TCP port is open to every
+# local user, so there the client has to start with "token <token>",
+# using the token the server wrote to --state-dir when it started.
+#
+# Sessions keep their own Runner.  Their input lines queue up and a fixed
+# pool of worker threads takes them round-robin, one line per session at
+# a time, so one busy session cannot starve the others.  Sessions left
+# idle are written to --state-dir and dropped from memory; the next line
+# or attach brings them back.
+
+import collections
+import importlib
+import io
+import json
+import os
+import secrets
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+from . import jobs
+from . import session
+from . import version
+
+backends = {
+    "itcc" : "runtcc",
+    "igcc" : "run",
+    "irust" : "runrust",
+    "igo" : "rungo",
+    "izig" : "runzig",
+    "ihare" : "runhare",
+    "icrap" : "runcrap",
+    }
+
+# these start pagers or browsers on the server's own terminal
+local_only = ( ".m ", ".v", ".g", ".h ", ".s" )
+
+class Session:
+
+    def __init__( self, sid, backend, argv ):
+        self.sid = sid
+        self.backend = backend
+        self.argv = argv
+        self.module = importlib.import_module( "libigcc." + backends[backend] )
+        self.runner, session_args = self.module.create_runner( argv )
+        self.runner.start( session_args )
+        self.pending = collections.deque()
+        self.scheduled = False
+        self.client = None
+        self.last_active = time.monotonic()
+        self.jobs_done = 0
+        self.quit = False
+
+    def send( self, text ):
+        client = self.client
+        if client is not None:
+            client.send( text )
+
+    def dump( self ):
+        data = session.dump( self.runner )
+        data["backend"] = self.backend
+        data["argv"] = self.argv
+        return data
+
+    def close( self ):
+        self.module.remove_files( self.runner )
+
+class Job:
+
+    def __init__( self, line, block = () ):
+        self.line = line
+        self.block = block
+        self.submitted = time.monotonic()
+
+class ReplServer:
+
+    def __init__( self, options ):
+        self.options = options
+        self.sessions = {}
+        self.cond = threading.Condition()
+        self.ready = collections.deque()
+        self.busy = 0
+        self.jobs_done = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.wait_total = 0.0
+        self.service_total = 0.0
+        self.evictions = 0
+        os.makedirs( options.state_dir, exist_ok = True )
+        for i in range( options.workers ):
+            threading.Thread( target = self.worker, daemon = True ).start()
+        threading.Thread( target = self.evictor, daemon = True ).start()
+
+    def state_file( self, sid ):
+        return os.path.join( self.options.state_dir, sid + ".json" )
+
+    def new_session( self, backend, argv ):
+        if backend not in backends:
+            raise ValueError( "unknown backend '%s', try one of: %s" % (
+                backend, " ".join( sorted( backends ) ) ) )
+        sid = secrets.token_hex( 4 )
+        s = Session( sid, backend, argv )
+        with self.cond:
+            self.sessions[sid] = s
+        return s
+
+    def get_session( self, sid, client = None ):
+        """The session, brought back from disk if it was evicted.  client,
+        if given, is where its replies go from now on."""
+        with self.cond:
+            s = self.sessions.get( sid )
+            if s is not None:
+                if client is not None:
+                    s.client = client
+                return s
+            filename = self.state_file( sid )
+            if not os.path.isfile( filename ):
+                raise ValueError( "no such session '%s'" % sid )
+        # restoring compiles, so don't hold up the workers meanwhile
+        data = session.read( filename )
+        loaded = Session( sid, data["backend"], data["argv"] )
+        session.restore( loaded.runner, data )
+        loaded.client = client
+        with self.cond:
+            s = self.sessions.get( sid )
+            if s is None:
+                s = self.sessions[sid] = loaded
+                if os.path.isfile( filename ):
+                    os.remove( filename )
+            elif client is not None:
+                # another line brought it back first
+                s.client = client
+        if s is not loaded:
+            loaded.close()
+        return s
+
+    def submit( self, s, job ):
+        while True:
+            with self.cond:
+                # checked and queued together, so the evictor can't take
+                # the session in between
+                current = self.sessions.get( s.sid )
+                if current is not None:
+                    return self.queue_locked( current, job )
+            # evicted while the client was quiet
+            s = self.get_session( s.sid, s.client )
+
+    def queue_locked( self, s, job ):
+        if len( s.pending ) >= self.options.max_queue:
+            return False
+        s.pending.append( job )
+        s.last_active = time.monotonic()
+        self.queued += 1
+        self.max_queued = max( self.max_queued, self.queued )
+        if not s.scheduled:
+            s.scheduled = True
+            self.ready.append( s )
+            self.cond.notify()
+        return True
+
+    def worker( self ):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                s = self.ready.popleft()
+                job = s.pending.popleft()
+                self.queued -= 1
+                self.busy += 1
+            started = time.monotonic()
+            self.execute( s, job )
+            with self.cond:
+                self.busy -= 1
+                self.jobs_done += 1
+                s.jobs_done += 1
+                self.wait_total += started - job.submitted
+                self.service_total += time.monotonic() - started
+                s.last_active = time.monotonic()
+                if s.quit:
+                    s.pending.clear()
+                    s.scheduled = False
+                    self.sessions.pop( s.sid, None )
+                elif s.pending:
+                    self.ready.append( s )
+                    self.cond.notify()
+                else:
+                    s.scheduled = False
+            if s.quit:
+                s.close()
+
+    def execute( self, s, job ):
+        output = io.StringIO()
+        sys.stdout.set( output )
+        sys.stdin.set( io.StringIO( "".join( line + "\n" for line in job.block ) ) )
+        try:
+            if job.line.startswith( local_only ):
+                print("[%s is not available over the server.]" % job.line.split()[0])
+            else:
+                s.runner.process_line( job.line )
+        except Exception as e:
+            # .q raises IGCCQuitException
+            if type( e ).__name__ == "IGCCQuitException":
+                s.quit = True
+            else:
+                print(e)
+        finally:
+            sys.stdout.set( None )
+            sys.stdin.set( None )
+        if s.quit:
+            s.send( output.getvalue() )
+            s.send( None )
+        else:
+            s.send( output.getvalue() + s.module.prompt )
+
+    def evictor( self ):
+        while True:
+            time.sleep( max( 1, min( 30, self.options.idle / 4 ) ) )
+            now = time.monotonic()
+            with self.cond:
+                idle = [ s for s in self.sessions.values()
+                    if not s.scheduled and now - s.last_active > self.options.idle ]
+                for s in idle:
+                    self.evict( s )
+
+    def evict( self, s ):
+        # called with self.cond held
+        session.write( self.state_file( s.sid ), s.dump() )
+        del self.sessions[s.sid]
+        s.close()
+        self.evictions += 1
+
+    def quit_session( self, s ):
+        with self.cond:
+            self.sessions.pop( s.sid, None )
+            s.pending.clear()
+            if os.path.isfile( self.state_file( s.sid ) ):
+                os.remove( self.state_file( s.sid ) )
+        s.close()
+
+    def metrics( self ):
+        with self.cond:
+            done = max( 1, self.jobs_done )
+            return {
+                "sessions" : len( self.sessions ),
+                "evicted" : len( [ f for f in os.listdir( self.options.state_dir )
+                    if f.endswith( ".json" ) ] ),
+                "workers" : self.options.workers,
+                "busy" : self.busy,
+                "queued" : self.queued,
+                "max_queued" : self.max_queued,
+                "jobs" : self.jobs_done,
+                "evictions" : self.evictions,
+                "avg_wait_ms" : round( 1000 * self.wait_total / done, 3 ),
+                "avg_service_ms" : round( 1000 * self.service_total / done, 3 ),
+                "per_session" : { sid : {
+                    "backend" : s.backend,
+                    "queued" : len( s.pending ),
+                    "jobs" : s.jobs_done,
+                    "idle_s" : round( time.monotonic() - s.last_active, 1 ),
+                    } for sid, s in self.sessions.items() },
+                }
+
+    def shutdown( self ):
+        with self.cond:
+            for s in list( self.sessions.values() ):
+                self.evict( s )
+
+class Client:
+
+    def __init__( self, wfile ):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send( self, text ):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                if text is None:
+                    self.closed = True
+                    self.wfile.close()
+                else:
+                    self.wfile.write( text.encode() )
+                    self.wfile.flush()
+            except ( BrokenPipeError, ConnectionResetError, ValueError ):
+                self.closed = True
+
+class Handler( socketserver.StreamRequestHandler ):
+
+    def readline( self ):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        return line.decode( errors = "replace" ).rstrip( "\r\n" )
+
+    def handle( self ):
+        repl = self.server.repl
+        client = Client( self.wfile )
+        client.send( "iserver %s\n" % version.VERSION )
+        if self.server.token is not None:
+            # any local user can connect to a TCP port
+            words = ( self.readline() or "" ).split()
+            if len( words ) != 2 or words[0] != "token" \
+                    or not secrets.compare_digest( words[1], self.server.token ):
+                client.send( "error: say 'token <token>' first\n" )
+                return
+            client.send( "ok\n" )
+        words = ( self.readline() or "" ).split()
+        try:
+            if len( words ) >= 2 and words[0] == "new":
+                s = repl.new_session( words[1], words[2:] )
+            elif len( words ) == 2 and words[0] == "attach":
+                s = repl.get_session( words[1], client )
+            else:
+                raise ValueError( "say 'new <backend> [args]' or 'attach <session>'" )
+        except Exception as e:
+            client.send( "error: %s\n" % e )
+            return
+        s.client = client
+        client.send( "session %s\n%s" % ( s.sid, s.module.prompt ) )
+
+        while not client.closed:
+            line = self.readline()
+            if line is None or line == ":detach":
+                break
+            elif line == ":quit":
+                repl.quit_session( s )
+                break
+            elif line == ":metrics":
+                client.send( json.dumps( repl.metrics() ) + "\n" + s.module.prompt )
+                continue
+            block = []
+            if line == ".f":
+                # dot_f reads the function body with input()
+                while True:
+                    more = self.readline()
+                    if not more:
+                        break
+                    block.append( more )
+            try:
+                s = repl.get_session( s.sid, client )
+                queued = repl.submit( s, Job( line, block ) )
+            except Exception as e:
+                client.send( "error: %s\n" % e )
+                break
+            if not queued:
+                client.send( "[Queue full - input dropped.]\n" + s.module.prompt )
+        if s.client is client:
+            s.client = None
+
+class UnixServer( socketserver.ThreadingMixIn, socketserver.UnixStreamServer ):
+    daemon_threads = True
+
+class TCPServer( socketserver.ThreadingMixIn, socketserver.TCPServer ):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def default_socket():
+    rundir = os.environ.get( "XDG_RUNTIME_DIR" ) or tempfile.gettempdir()
+    return os.path.join( rundir, "itcc-%d.sock" % os.getuid() )
+
+def write_token( state_dir ):
+    """A new token for TCP clients, written where only we can read it."""
+    token = secrets.token_hex( 16 )
+    filename = os.path.join( state_dir, "token" )
+    old_umask = os.umask( 0o077 )
+    try:
+        with open( filename, "w" ) as f:
+            f.write( token + "\n" )
+    finally:
+        os.umask( old_umask )
+    os.chmod( filename, 0o600 )
+    return token, filename
+
+def parse_args( argv ):
+    parser = ArgumentParser()
+    parser.description = "Serve many interactive sessions over one socket."
+    parser.add_argument( "--socket", default = None,
+        help = "Listen on this Unix socket (default %s)." % default_socket() )
+    parser.add_argument( "--port", type = int, default = None,
+        help = "Listen on this localhost TCP port instead.  Clients must "
+        "send the token written to --state-dir first." )
+    parser.add_argument( "--workers", type = int, default = os.cpu_count(),
+        help = "Compile/run jobs allowed at once (default: one per core)." )
+    parser.add_argument( "--max-queue", type = int, default = 100,
+        help = "Lines a session may have waiting before input is dropped." )
+    parser.add_argument( "--idle", type = float, default = 300,
+        help = "Seconds before an idle session is written to disk." )
+    parser.add_argument( "--state-dir", default = os.path.join(
+        os.path.expanduser( "~" ), ".cache", "itcc", "server" ),
+        help = "Where evicted sessions are kept." )
+    return parser.parse_args( argv )
+
+def run( argv = None ):
+    options = parse_args( argv )
+    sys.stdout = jobs.ThreadLocalFile( sys.stdout )
+    sys.stdin = jobs.ThreadLocalFile( sys.stdin )
+    repl = ReplServer( options )
+
+    if options.port is not None:
+        server = TCPServer( ( "127.0.0.1", options.port ), Handler )
+        where = "127.0.0.1:%d" % options.port
+        server.token, token_file = write_token( options.state_dir )
+    else:
+        where = options.socket or default_socket()
+        if os.path.exists( where ):
+            os.remove( where )
+        # made 0600 from the start, not chmod'ed after anyone could connect
+        old_umask = os.umask( 0o077 )
+        try:
+            server = UnixServer( where, Handler )
+        finally:
+            os.umask( old_umask )
+        server.token = None
+    server.repl = repl
+    print("iserver %s listening on %s with %d workers" % (
+        version.VERSION, where, options.workers ))
+    if server.token is not None:
+        print("clients must send 'token <token>' with the token in %s" % token_file)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        repl.shutdown()
+        if options.port is None and os.path.exists( where ):
+            os.remove( where )
@@ -0,0 +1,163 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# Turn a Runner's history into plain data and back again.
+#
+# .save and .load keep sessions under ~/.local/share/itcc/sessions, one
+# directory per shell.  Next to the history goes the program it last
+# built, with a cache key that doesn't depend on the session directory,
+# so a session loaded into the same compiler and options is back in its
+# cache without being compiled again.  The interactive shells also save
+# themselves as "last" on the way out, which is what --resume loads.
+
+import json
+import os
+import shutil
+import sys
+
+from . import cache
+
+# the options that change what gets compiled
+option_names = ( "INCLUDE", "LIBDIR", "LIB" )
+
+def dump( runner ):
+    return {
+        "user_input" : [ {
+            "inp" : a.inp,
+            "typ" : a.typ,
+            "output_chars" : a.output_chars,
+            "error_chars" : a.error_chars,
+            } for a in runner.user_input ],
+        "input_num" : runner.input_num,
+        "output_chars_printed" : runner.output_chars_printed,
+        "error_chars_printed" : runner.error_chars_printed,
+        }
+
+def restore( runner, data ):
+    # each backend has its own UserInput class
+    UserInput = sys.modules[type( runner ).__module__].UserInput
+    runner.user_input = []
+    for item in data["user_input"]:
+        a = UserInput( item["inp"], item["typ"] )
+        a.output_chars = item["output_chars"]
+        a.error_chars = item["error_chars"]
+        runner.user_input.append( a )
+    runner.input_num = data["input_num"]
+    runner.output_chars_printed = data["output_chars_printed"]
+    runner.error_chars_printed = data["error_chars_printed"]
+
+def write( filename, data ):
+    tmpname = filename + ".tmp"
+    with open( tmpname, "w" ) as f:
+        json.dump( data, f )
+    os.replace( tmpname, filename )
+
+def read( filename ):
+    with open( filename ) as f:
+        return json.load( f )
+
+def directory():
+    base = os.environ.get( "XDG_DATA_HOME" ) or os.path.expanduser(
+        "~/.local/share" )
+    return os.path.join( base, "itcc", "sessions" )
+
+def backend( runner ):
+    return sys.modules[type( runner ).__module__]
+
+def session_file( runner, name, suffix ):
+    if not name or "/" in name or name.startswith( "." ):
+        raise ValueError( "bad session name" )
+    d = os.path.join( directory(), backend( runner ).__name__.split( "." )[-1] )
+    os.makedirs( d, exist_ok = True )
+    return os.path.join( d, name + suffix )
+
+def dump_options( runner ):
+    return {
+        "options" : { name : getattr( runner.options, name )
+            for name in option_names if hasattr( runner.options, name ) },
+        "extra_options" : list( runner.extra_options ),
+        "session_args" : list( runner.session_args ),
+        "units" : runner.units.paths() if hasattr( runner, "units" ) else [],
+        "data" : runner.data_maps.dump() if hasattr( runner, "data_maps" )
+            else [],
+        }
+
+def restore_options( runner, data ):
+    for name, value in data["options"].items():
+        setattr( runner.options, name, value )
+    runner.extra_options = data["extra_options"]
+    for path in data.get( "units", [] ):
+        runner.units.add( path )
+    for name, path, typ in data.get( "data", [] ):
+        runner.data_maps.add( name, path, typ )
+    runner.start( data["session_args"] )
+
+def portable_key( runner, source ):
+    """The cache key with the session directory taken out, and the
+    compiler's timestamp put in so that an upgrade invalidates it."""
+    command = [ part.replace( runner.workspace.path, "$workspace" )
+        for part in runner.subs_compiler_command ]
+    compiler = shutil.which( command[0] )
+    if compiler is not None:
+        command.append( str( os.stat( compiler ).st_mtime_ns ) )
+    return runner.cache.key( command, source )
+
+def save( runner, name ):
+    data = dump( runner )
+    data.update( dump_options( runner ) )
+    data["key"] = None
+    exefile = session_file( runner, name, ".exe" )
+    source = backend( runner ).source_code.get_full_source( runner )
+    key = runner.cache.key( runner.subs_compiler_command, source )
+    # a split build is cached under its own command and source
+    split_built = getattr( runner, "built", None )
+    if split_built is not None and split_built[0] == source:
+        key = split_built[1]
+    built = runner.cache.path( key )
+    if os.path.lexists( exefile ):
+        os.remove( exefile )
+    if built is not None:
+        shutil.copyfile( built, exefile )
+        os.chmod( exefile, 0o755 )
+        data["key"] = portable_key( runner, source )
+    write( session_file( runner, name, ".json" ), data )
+
+def load( runner, name ):
+    """Load a saved session into runner.  True if its program came back
+    too; if not, the caller should rebuild to find out what it prints."""
+    data = read( session_file( runner, name, ".json" ) )
+    restore_options( runner, data )
+    restore( runner, data )
+    exefile = session_file( runner, name, ".exe" )
+    source = backend( runner ).source_code.get_full_source( runner )
+    if data["key"] is None or not os.path.isfile( exefile ) \
+            or data["key"] != portable_key( runner, source ):
+        return False
+    cache.place( exefile, runner.exefilename )
+    runner.cache.store( runner.cache.key( runner.subs_compiler_command,
+        source ), runner.exefilename, None )
+    return True
+
+def autosave( runner ):
+    if runner.input_num > 0:
+        try:
+            save( runner, "last" )
+        except OSError:
+            pass
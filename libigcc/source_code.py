@@ -18,6 +18,9 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301, USA.
 
+from . import arena
+from . import probes
+
 file_boilerplate = """#include <cstdio>
 #include <iostream>
 #include <string>
@@ -26,8 +29,59 @@ $user_includesint main(int argc, char **argv, char **env){
 $user_commands    return 0;
 }"""
 
+timing_runtime = """
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+#include <unistd.h>
+static void itcc_probe( int n ){
+    static int fd = -2;
+    static struct timespec last;
+    struct timespec now;
+    timespec_get( &now, TIME_UTC );
+    if( fd == -2 ){
+        const char *s = getenv( "ITCC_TIMING_FD" );
+        fd = s ? atoi( s ) : -1;
+    }
+    if( n >= 0 && fd >= 0 ){
+        char buf[64];
+        long long ns = ( now.tv_sec - last.tv_sec ) * 1000000000LL
+            + ( now.tv_nsec - last.tv_nsec );
+        int len = snprintf( buf, sizeof buf, "%d %lld\\n", n, ns );
+        if( write( fd, buf, len ) < 0 ) fd = -1;
+    }
+    timespec_get( &last, TIME_UTC );
+}
+"""
+
+timing_probe = "    itcc_probe( $n );"
+
+def get_user_commands_string( runner ):
+    if runner.options.time_statements:
+        return probes.get_instrumented_commands_string( runner, timing_probe )
+    return runner.get_user_commands_string()
+
+def get_prelude( runner ):
+    """session_alloc and the .data arrays, which go before the user's
+    declarations so that .f functions can use them too."""
+    return arena.get_runtime( runner ) + runner.data_maps.c_source()
+
 def get_full_source( runner ):
+    runtime = timing_runtime if runner.options.time_statements else ""
     return ( file_boilerplate
-        .replace( "$user_commands", runner.get_user_commands_string() )
-        .replace( "$user_includes", runner.get_user_includes_string() )
+        .replace( "$user_commands", get_user_commands_string( runner ) )
+        .replace( "$user_includes", get_prelude( runner )
+            + runner.get_user_includes_string() + runtime )
+    )
+
+def get_split_sources( runner, header ):
+    """The declarations section on its own, and the program with header
+    in its place (see split)."""
+    runtime = timing_runtime if runner.options.time_statements else ""
+    prelude = get_prelude( runner )
+    declarations = ( file_boilerplate.split( "$user_includes" )[0]
+        + prelude + runner.get_user_includes_string() )
+    return declarations, ( file_boilerplate
+        .replace( "$user_commands", get_user_commands_string( runner ) )
+        .replace( "$user_includes", prelude + header + runtime )
     )
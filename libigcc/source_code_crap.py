@@ -17,10 +17,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301, USA.
-import tempfile
-outfile = tempfile.NamedTemporaryFile( suffix = ".crap" )
-srcfile = outfile.name
-outfile.close()
+from . import arena
 file_boilerplate = """#include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
@@ -30,5 +27,6 @@ $user_commands    return 0"""
 def get_full_source( runner ):
     return ( file_boilerplate
         .replace( "$user_commands", runner.get_user_commands_string() )
-        .replace( "$user_includes", runner.get_user_includes_string() )
+        .replace( "$user_includes", arena.get_runtime( runner )
+            + runner.get_user_includes_string() )
     )
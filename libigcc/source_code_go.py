@@ -18,13 +18,51 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301, USA.
 
+from . import probes
+
 file_boilerplate = """package main
 import "fmt"
-$user_includesfunc main() {
+$timing_imports$user_includesfunc main() {
 $user_commands}"""
 
+timing_imports = """import (
+	itcc_os "os"
+	itcc_strconv "strconv"
+	itcc_time "time"
+)
+"""
+
+timing_runtime = """
+var itcc_last itcc_time.Time
+var itcc_timing *itcc_os.File
+
+func itcc_probe(n int) {
+	now := itcc_time.Now()
+	if itcc_timing == nil {
+		fd, err := itcc_strconv.Atoi(itcc_os.Getenv("ITCC_TIMING_FD"))
+		if err == nil {
+			itcc_timing = itcc_os.NewFile(uintptr(fd), "timing")
+		}
+	}
+	if n >= 0 && itcc_timing != nil {
+		itcc_timing.WriteString(itcc_strconv.Itoa(n) + " " +
+			itcc_strconv.FormatInt(now.Sub(itcc_last).Nanoseconds(), 10) + "\\n")
+	}
+	itcc_last = itcc_time.Now()
+}
+"""
+
+timing_probe = "    itcc_probe($n)"
+
+def get_user_commands_string( runner ):
+    if runner.options.time_statements:
+        return probes.get_instrumented_commands_string( runner, timing_probe, "go" )
+    return runner.get_user_commands_string()
+
 def get_full_source( runner ):
+    runtime = timing_runtime if runner.options.time_statements else ""
     return ( file_boilerplate
-        .replace( "$user_commands", runner.get_user_commands_string() )
-        .replace( "$user_includes", runner.get_user_includes_string() )
+        .replace( "$timing_imports", timing_imports if runner.options.time_statements else "" )
+        .replace( "$user_commands", get_user_commands_string( runner ) )
+        .replace( "$user_includes", runner.get_user_includes_string() + runtime )
     )
@@ -18,14 +18,49 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301, USA.
 
+from . import probes
+
 file_boilerplate = """
 $user_includes
 fn main() {
 $user_commands
 }"""
 
+timing_runtime = """
+#[allow(dead_code)]
+fn itcc_probe(n: i64) {
+    use std::io::Write;
+    use std::os::unix::io::FromRawFd;
+    static LAST: std::sync::Mutex<Option<std::time::Instant>> =
+        std::sync::Mutex::new(None);
+    let now = std::time::Instant::now();
+    let mut last = LAST.lock().unwrap();
+    let fd = std::env::var("ITCC_TIMING_FD").ok()
+        .and_then(|s| s.parse::<i32>().ok());
+    if let (Some(fd), Some(prev)) = (fd, *last) {
+        if n >= 0 {
+            let mut f = std::mem::ManuallyDrop::new(
+                unsafe { std::fs::File::from_raw_fd(fd) });
+            let _ = writeln!(f, "{} {}", n, (now - prev).as_nanos());
+        }
+    }
+    *last = Some(std::time::Instant::now());
+}
+"""
+
+timing_probe = "    itcc_probe($n);"
+
+def get_user_commands_string( runner ):
+    if runner.options.time_statements:
+        return probes.get_instrumented_commands_string( runner, timing_probe )
+    return runner.get_user_commands_string()
+
 def get_full_source( runner ):
+    runtime = timing_runtime if runner.options.time_statements else ""
+    data_runtime, data_lets = runner.data_maps.rust_source()
+    runtime += data_runtime
     return ( file_boilerplate
-        .replace( "$user_commands", runner.get_user_commands_string() )
-        .replace( "$user_includes", runner.get_user_includes_string() )
+        .replace( "$user_commands",
+            data_lets + get_user_commands_string( runner ) )
+        .replace( "$user_includes", runner.get_user_includes_string() + runtime )
     )
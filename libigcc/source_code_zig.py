@@ -18,12 +18,42 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301, USA.
 
+from . import probes
+
 file_boilerplate = """const std = @import("std");
 $user_includespub fn main() !void {
 $user_commands}"""
 
+timing_runtime = """
+var itcc_last: i128 = 0;
+fn itcc_probe(n: i64) void {
+    const now = std.time.nanoTimestamp();
+    if (n >= 0) {
+        if (std.os.getenv("ITCC_TIMING_FD")) |s| {
+            const fd = std.fmt.parseInt(std.os.fd_t, s, 10) catch return;
+            var buf: [64]u8 = undefined;
+            const line = std.fmt.bufPrint(&buf, "{d} {d}\\n",
+                .{ n, now - itcc_last }) catch return;
+            _ = std.os.write(fd, line) catch {};
+        }
+    }
+    itcc_last = std.time.nanoTimestamp();
+}
+"""
+
+timing_probe = "    itcc_probe($n);"
+
+def get_user_commands_string( runner ):
+    if runner.options.time_statements:
+        return probes.get_instrumented_commands_string( runner, timing_probe )
+    return runner.get_user_commands_string()
+
 def get_full_source( runner ):
+    runtime = timing_runtime if runner.options.time_statements else ""
+    data_runtime, data_assignments = runner.data_maps.zig_source()
+    runtime += data_runtime
     return ( file_boilerplate
-        .replace( "$user_commands", runner.get_user_commands_string() )
-        .replace( "$user_includes", runner.get_user_includes_string() )
+        .replace( "$user_commands",
+            data_assignments + get_user_commands_string( runner ) )
+        .replace( "$user_includes", runner.get_user_includes_string() + runtime )
     )
@@ -0,0 +1,159 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# --speculate: start compiling while the user is still typing.
+#
+# A thread watches the readline buffer.  Once it has stopped changing
+# for a moment and holds what looks like a whole statement, we build the
+# program that pressing Enter would build and put it in the artifact
+# cache under the same key.  If the user does press Enter on that text,
+# run_compile finds it there (or waits for the build in flight); if not,
+# the build just ages out of the cache.
+
+import copy
+import os
+import threading
+import time
+
+from . import cache
+from . import memexec
+from . import probes
+
+poll_interval = 0.1
+settle_time = 0.3
+
+def is_complete( line, incl_re, style = "c" ):
+    if not line.strip() or line.lstrip().startswith( "." ):
+        return False
+    depth, code = probes.scan_line( line, 0 )
+    if depth != 0:
+        return False
+    return incl_re.match( line ) is not None or probes.is_boundary(
+        code, None, style )
+
+class Speculator:
+
+    def __init__( self, runner, source_code, compile_source, incl_re,
+            UserInput, style = "c" ):
+        self.runner = runner
+        self.source_code = source_code
+        self.compile_source = compile_source
+        self.incl_re = incl_re
+        self.UserInput = UserInput
+        self.style = style
+        self.builds = 0
+        self.stopped = False
+        self.thread = threading.Thread( target = self.loop, daemon = True )
+
+    def start( self ):
+        self.thread.start()
+
+    def stop( self ):
+        self.stopped = True
+
+    def loop( self ):
+        import readline
+        last = None
+        changed = time.monotonic()
+        while not self.stopped:
+            time.sleep( poll_interval )
+            if not self.runner.reading:
+                continue
+            line = readline.get_line_buffer()
+            if line != last:
+                last = line
+                changed = time.monotonic()
+            elif time.monotonic() - changed < settle_time:
+                continue
+            elif is_complete( line, self.incl_re, self.style ):
+                self.speculate( line )
+
+    def shadow( self ):
+        """A copy of the runner we can change without disturbing it."""
+        shadow = copy.copy( self.runner )
+        shadow.user_input = list( self.runner.get_user_input() )
+        shadow.input_num = len( shadow.user_input )
+        return shadow
+
+    def speculate( self, line ):
+        # what process_line would append for this line
+        shadow = self.shadow()
+        if self.incl_re.match( line ):
+            a = self.UserInput( line, self.UserInput.INCLUDE )
+        else:
+            a = self.UserInput( "    " + line, self.UserInput.COMMAND )
+        shadow.user_input.append( a )
+        shadow.input_num += 1
+        self.build( shadow )
+
+    def build( self, shadow ):
+        runner = self.runner
+        command = runner.subs_compiler_command
+        source = self.source_code.get_full_source( shadow )
+        # build it the way run_compile will (see split)
+        plan = runner.split.prepare( shadow, self.source_code, command ) \
+            if getattr( runner, "split", None ) is not None else None
+        if plan is not None:
+            command, source = plan.command, plan.source
+        key = runner.cache.key( command, source )
+        if not runner.cache.reserve( key ):
+            return
+        try:
+            self.build_reserved( shadow, key, source, command )
+        finally:
+            runner.cache.release( key )
+
+    def build_reserved( self, shadow, key, source, command ):
+        # build next to, never over, the session's own files
+        runner = self.runner
+        directory = runner.workspace.file( "speculative" )
+        os.makedirs( directory, exist_ok = True )
+        memfile = None
+        if getattr( runner, "use_memfd", False ):
+            memfile = memexec.MemFile( "speculative" )
+            exefilename = memfile.path
+        else:
+            exefilename = os.path.join( directory,
+                os.path.basename( runner.exefilename ) )
+            cache.remove( exefilename )
+        renames = { runner.exefilename : exefilename }
+        srcfilename = getattr( runner, "srcfilename", None )
+        if srcfilename is not None:
+            renames[srcfilename] = os.path.join( directory,
+                os.path.basename( srcfilename ) )
+        incremental = getattr( runner, "incremental_dir", None )
+        if incremental is not None:
+            # nor over rustc's incremental state, which a build may be using
+            renames["incremental=" + incremental] = "incremental=" \
+                + os.path.join( directory, "incremental" )
+        command = [ renames.get( part, part ) for part in command ]
+
+        if srcfilename is not None:
+            error = self.compile_source( command, shadow,
+                renames[srcfilename], source )
+        else:
+            error = self.compile_source( command, shadow, source )
+        if error is not None and memfile is not None \
+                and memfile.path.encode() in error:
+            # run_compile will find out and fall back to files itself
+            memfile.close()
+            return
+        runner.cache.store( key, exefilename, error, memfile )
+        self.builds += 1
@@ -0,0 +1,248 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+
+# Compile the functions entered with .f once, not on every line.
+#
+# The declarations section is built into an object of its own, and the
+# program is compiled against a header made from it: prototypes for the
+# functions, extern declarations for the variables, and everything else
+# (types, macros, #includes, static functions) as it was typed.  Making
+# that header means guessing at C and C++ without parsing them, so when
+# it looks unsafe (static variables, which the two halves would each get
+# a copy of, or functions whose return type is deduced) we don't try, and
+# when a split program fails to build we build it whole as well.  If the
+# whole program builds, the split was to blame and is not tried again for
+# those declarations; once a split program has built, its errors are
+# trusted.  Like an .add unit, the object is named after the content of
+# the headers the declarations included as well as their own, so editing
+# a header builds it again.
+
+import hashlib
+import os
+import re
+import subprocess
+import threading
+
+from . import jobs
+from . import units
+
+keep_re = re.compile( r"(typedef|using|struct|class|union|enum|template|namespace"
+    r"|extern|friend|static_assert|const|constexpr|inline|#)\b" )
+function_head_re = re.compile(
+    r"\)\s*(const|noexcept|override|final|\s)*(->[^{;]*)?$" )
+name_re = re.compile( r"([\w:~]+)\s*\($" )
+
+def is_function_head( head ):
+    # not a lambda or an initializer, nor a struct or namespace
+    return function_head_re.search( head ) is not None \
+        and "=" not in head.split( "(", 1 )[0] and not keep_re.match( head )
+
+def chunks( text ):
+    """Split text into top-level declarations: (code, head, body) where
+    head is what came before the body of a function definition, if it
+    was one."""
+    ret = []
+    code = []
+    depth = 0
+    head = None
+    quote = None
+    i = 0
+    while i < len( text ):
+        c = text[i]
+        if quote is not None:
+            code.append( c )
+            if c == "\\":
+                code.append( text[i + 1:i + 2] )
+                i += 1
+            elif c == quote:
+                quote = None
+        elif text.startswith( "//", i ):
+            end = text.find( "\n", i )
+            i = len( text ) if end < 0 else end
+            continue
+        elif text.startswith( "/*", i ):
+            end = text.find( "*/", i + 2 )
+            i = len( text ) if end < 0 else end + 2
+            continue
+        elif c == "#" and depth == 0 and not "".join( code ).strip():
+            end = i
+            while True:
+                end = text.find( "\n", end )
+                if end < 0 or text[end - 1] != "\\":
+                    break
+                end += 1
+            end = len( text ) if end < 0 else end
+            ret.append( ( text[i:end].strip(), None ) )
+            i = end
+            continue
+        else:
+            code.append( c )
+            if c in "\"'":
+                quote = c
+            elif c in "({[":
+                if c == "{" and depth == 0:
+                    head = "".join( code[:-1] ).strip()
+                depth += 1
+            elif c in ")}]":
+                depth -= 1
+                if c == "}" and depth == 0 and head is not None \
+                        and is_function_head( head ):
+                    ret.append( ( "".join( code ).strip(), head ) )
+                    code, head = [], None
+            elif c == ";" and depth == 0:
+                if "".join( code ).strip() != ";":
+                    ret.append( ( "".join( code ).strip(), None ) )
+                code, head = [], None
+        i += 1
+    if "".join( code ).strip():
+        ret.append( ( "".join( code ).strip(), None ) )
+    return ret
+
+def make_header( includes ):
+    """What the program needs to see of the declarations section, or None
+    if splitting it would gain nothing or looks unsafe."""
+    lines = []
+    functions = 0
+    for inp in includes:
+        for code, head in chunks( inp ):
+            if head is not None and re.match( r"(auto|decltype)\b", head ):
+                # a prototype can't stand in for return type deduction
+                return None
+            elif head is not None and head.startswith( "static" ):
+                lines.append( code )
+            elif head is not None:
+                functions += 1
+                name = name_re.search( head[:head.rfind( ")" )].rsplit( "(", 1 )[0] + "(" )
+                if name is None or "::" not in name.group( 1 ):
+                    # member functions are declared by their class already
+                    lines.append( head + ";" )
+            elif code.startswith( "static" ):
+                if "(" not in code or "=" in code:
+                    return None
+                lines.append( code )
+            elif keep_re.match( code ) or not code.endswith( ";" ) \
+                    or ( "(" in code and "=" not in code ):
+                lines.append( code )
+            else:
+                lines.append( "extern " + re.split( r"\s*[={]", code, 1 )[0]
+                    .rstrip( ";" ).strip() + ";" )
+    if functions == 0:
+        return None
+    return "\n".join( lines ) + "\n"
+
+def depend_option( command ):
+    # tcc has no -MMD, and lists every header it read with -MD
+    if os.path.basename( command[0] ) == "tcc":
+        return "-MD"
+    return "-MMD"
+
+class Plan:
+
+    def __init__( self, command, source, objfile ):
+        self.command = command
+        self.source = source
+        self.objfile = objfile
+
+class Split:
+
+    def __init__( self, directory ):
+        self.directory = directory
+        # objfile -> True once a program built against it, False if the
+        # split was wrong
+        self.verdicts = {}
+        # what the declarations were built from -> the headers they included
+        self.deps = {}
+        self.lock = threading.Lock()
+
+    def prepare( self, runner, source_code, command ):
+        """A Plan for building runner's program in two halves, or None to
+        build it whole."""
+        if self.directory is None or runner.options.no_split:
+            return None
+        header = make_header( list( runner.get_user_includes() ) )
+        if header is None:
+            return None
+        declarations, program = source_code.get_split_sources( runner, header )
+        object_command = [ "$objfile" if part == runner.exefilename else part
+            for part in command ] + [ "-c", depend_option( command ),
+            "-MF", "$objfile.d" ]
+        h = hashlib.sha256()
+        h.update( "\0".join( object_command ).encode() + b"\0\0" )
+        h.update( declarations.encode( "utf-8" ) )
+        source = h.hexdigest()
+        with self.lock:
+            objfile = self.object_name( source )
+            if self.verdicts.get( objfile ) is False:
+                return None
+            if objfile is None or not os.path.isfile( objfile ):
+                objfile = self.build( object_command, source, declarations )
+                if objfile is None:
+                    # the whole program will show the same errors
+                    return None
+        i = command.index( "-" ) + 1
+        return Plan( command[:i] + [ "-x", "none", objfile ] + command[i:],
+            program, objfile )
+
+    def object_name( self, source ):
+        """Where the declarations built from source are, or None if we
+        don't know yet which headers they include."""
+        if source not in self.deps:
+            return None
+        h = hashlib.sha256( source.encode() )
+        for filename in self.deps[source]:
+            h.update( b"\0" + filename.encode() + b"\0" )
+            try:
+                with open( filename, "rb" ) as f:
+                    h.update( f.read() )
+            except OSError:
+                h.update( b"missing" )
+        return os.path.join( self.directory,
+            "declarations-%s.o" % h.hexdigest()[:16] )
+
+    def build( self, object_command, source, declarations ):
+        """Build the declarations, and return the object's name, or None
+        if they don't compile."""
+        os.makedirs( self.directory, exist_ok = True )
+        tmpfile = os.path.join( self.directory, "declarations-%s.%d.tmp" % (
+            source[:16], threading.get_ident() ) )
+        process = jobs.Popen( [ part.replace( "$objfile", tmpfile )
+            for part in object_command ], stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE, stderr = subprocess.PIPE )
+        process.communicate( declarations.encode( "utf-8" ) )
+        self.deps[source] = units.read_deps( tmpfile + ".d", None )
+        if os.path.exists( tmpfile + ".d" ):
+            os.remove( tmpfile + ".d" )
+        objfile = self.object_name( source )
+        if process.returncode != 0:
+            if os.path.exists( tmpfile ):
+                os.remove( tmpfile )
+            self.verdicts[objfile] = False
+            return None
+        os.replace( tmpfile, objfile )
+        return objfile
+
+    def proven( self, plan ):
+        with self.lock:
+            return self.verdicts.get( plan.objfile ) is True
+
+    def judge( self, plan, works ):
+        with self.lock:
+            self.verdicts[plan.objfile] = works
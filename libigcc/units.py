@@ -0,0 +1,167 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+
+# Extra source files added to a session with .add.
+#
+# Each one is compiled on its own into the session directory and the
+# objects are linked with every program, so a cycle only compiles what
+# the user typed.  Like make, we ask the compiler which headers a file
+# included (-MMD, or rustc's dep-info) and rebuild it only when it or
+# one of them changes; but we go by content, not timestamps.  Objects are
+# named after that content, so the link command, and with it the artifact
+# cache key, changes whenever one is rebuilt.  Several files that need
+# rebuilding are compiled at once.
+
+import concurrent.futures
+import hashlib
+import os
+import subprocess
+
+from . import jobs
+
+class Unit:
+
+    def __init__( self, path ):
+        self.path = path
+        self.name = os.path.splitext( os.path.basename( path ) )[0]
+        self.suffix = os.path.splitext( path )[1]
+        self.deps = []
+        self.key = None
+        self.object = None
+
+class Units:
+
+    def __init__( self, directory, commands, link_command, link_prefix = () ):
+        self.directory = directory
+        self.commands = commands
+        self.link_command = link_command
+        self.link_prefix = link_prefix
+        self.units = []
+
+    def __len__( self ):
+        return len( self.units )
+
+    def paths( self ):
+        return [ u.path for u in self.units ]
+
+    def add( self, path ):
+        path = os.path.abspath( path )
+        if os.path.splitext( path )[1] not in self.commands:
+            raise ValueError( "can only add %s files"
+                % ", ".join( sorted( self.commands ) ) )
+        if not os.path.isfile( path ):
+            raise OSError( "no such file" )
+        if path not in self.paths():
+            self.units.append( Unit( path ) )
+
+    def link_args( self ):
+        ret = []
+        for u in self.units:
+            if u.object is not None:
+                ret += expand( self.link_command, u.name, u.path, u.object )
+        return list( self.link_prefix ) + ret if ret else []
+
+    def command( self, unit, options, outfile ):
+        return expand( self.commands[unit.suffix], unit.name, unit.path,
+            outfile, outfile + ".d", getattr( options, "INCLUDE", None ) )
+
+    def content_key( self, unit, options ):
+        h = hashlib.sha256()
+        h.update( "\0".join( self.command( unit, options, "" ) ).encode() )
+        for filename in [ unit.path ] + unit.deps:
+            h.update( b"\0" + filename.encode() + b"\0" )
+            try:
+                with open( filename, "rb" ) as f:
+                    h.update( f.read() )
+            except OSError:
+                h.update( b"missing" )
+        return h.hexdigest()
+
+    def build( self, options ):
+        """Bring every object up to date.  Returns the compiler's
+        complaints, or None."""
+        dirty = []
+        for u in self.units:
+            key = self.content_key( u, options )
+            if key != u.key or u.object is None \
+                    or not os.path.isfile( u.object ):
+                dirty.append( ( u, key ) )
+        if not dirty:
+            return None
+        os.makedirs( self.directory, exist_ok = True )
+        job = getattr( jobs.local, "job", None )
+        workers = min( len( dirty ), os.cpu_count() or 1 )
+        with concurrent.futures.ThreadPoolExecutor( workers ) as pool:
+            results = list( pool.map( lambda d: self.compile( d[0], d[1],
+                options, job ), dirty ) )
+        errors = [ e for e in results if e is not None ]
+        return b"".join( errors ) if errors else None
+
+    def compile( self, unit, key, options, job ):
+        jobs.local.job = job
+        try:
+            outfile = os.path.join( self.directory,
+                output_name( unit, key[:16] ) )
+            process = jobs.Popen( self.command( unit, options, outfile ),
+                stdout = subprocess.PIPE, stderr = subprocess.PIPE )
+            stdoutdata, stderrdata = process.communicate()
+        finally:
+            jobs.local.job = None
+        if process.returncode != 0:
+            return stdoutdata + stderrdata
+        unit.deps = read_deps( outfile + ".d", unit.path )
+        unit.key = self.content_key( unit, options )
+        unit.object = outfile
+        return None
+
+def output_name( unit, tag ):
+    # rustc only takes crates from files called lib*.rlib
+    if unit.suffix == ".rs":
+        return "lib%s-%s.rlib" % ( unit.name, tag )
+    return "%s-%s.o" % ( unit.name, tag )
+
+def expand( template, name, srcfile, outfile, depfile = "",
+        include_dirs = None ):
+    ret = []
+    for part in template:
+        if part == "$include_dirs":
+            ret += [ "-I" + d for d in include_dirs or [] ]
+        else:
+            ret.append( part.replace( "$name", name )
+                .replace( "$srcfile", srcfile )
+                .replace( "$outfile", outfile )
+                .replace( "$depfile", depfile ) )
+    return ret
+
+def read_deps( depfile, srcfile ):
+    """The files named by the first rule of a make-style dependency
+    file, other than the source itself."""
+    try:
+        with open( depfile ) as f:
+            text = f.read()
+    except OSError:
+        return []
+    rule = text.replace( "\\\n", " " ).split( "\n" )[0]
+    if ":" not in rule:
+        return []
+    files = rule.split( ":", 1 )[1].split()
+    return [ os.path.abspath( f ) for f in files
+        if os.path.abspath( f ) != srcfile ]
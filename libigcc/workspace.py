@@ -0,0 +1,144 @@
+# itcc - a read-eval-print loop for C/C++, rust & hare programmers
+#
+# igcc Copyright (C) 2009 Andy Balaam
+# with python3, rust, hare, and other support by Henry Kroll III
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+# One directory per session for sources, executables and compiler
+# leftovers.
+#
+# Workspaces go on /dev/shm when it is there and lets us run programs,
+# so every rebuild stays in memory.  They are named itcc-<pid>-..., are
+# removed at exit or on SIGTERM/SIGHUP, and the next session to start
+# sweeps away any whose process died without cleaning up.
+
+import atexit
+import os
+import re
+import shutil
+import signal
+import tempfile
+import threading
+
+prefix = "itcc-"
+name_re = re.compile( r"^itcc-([0-9]+)-" )
+
+live = []
+lock = threading.Lock()
+installed = False
+
+def usable( directory ):
+    if not os.path.isdir( directory ) or not os.access( directory, os.W_OK ):
+        return False
+    try:
+        return not os.statvfs( directory ).f_flag & os.ST_NOEXEC
+    except ( AttributeError, OSError ):
+        return False
+
+def base_dir():
+    directory = os.environ.get( "ITCC_WORKDIR" )
+    if directory:
+        return directory
+    if usable( "/dev/shm" ):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+def pid_alive( pid ):
+    try:
+        os.kill( pid, 0 )
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def reap( directory = None ):
+    """Remove workspaces left behind by sessions that died."""
+    directory = directory or base_dir()
+    try:
+        names = os.listdir( directory )
+    except OSError:
+        return
+    for name in names:
+        m = name_re.match( name )
+        if m is None or int( m.group( 1 ) ) == os.getpid():
+            continue
+        path = os.path.join( directory, name )
+        if os.path.isdir( path ) and os.stat( path ).st_uid == os.getuid() \
+                and not pid_alive( int( m.group( 1 ) ) ):
+            shutil.rmtree( path, ignore_errors = True )
+
+def remove_all():
+    with lock:
+        workspaces = list( live )
+    for w in workspaces:
+        w.remove()
+
+def on_signal( signum, frame ):
+    remove_all()
+    signal.signal( signum, signal.SIG_DFL )
+    os.kill( os.getpid(), signum )
+
+def install_handlers():
+    global installed
+    if installed:
+        return
+    installed = True
+    atexit.register( remove_all )
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for name in ( "SIGTERM", "SIGHUP" ):
+        signum = getattr( signal, name, None )
+        # leave alone anything the embedding program set up
+        if signum is not None and signal.getsignal( signum ) == signal.SIG_DFL:
+            signal.signal( signum, on_signal )
+
+class Workspace:
+
+    def __init__( self, name ):
+        directory = base_dir()
+        if not installed:
+            reap( directory )
+            install_handlers()
+        self.path = tempfile.mkdtemp(
+            prefix = "%s%d-%s-" % ( prefix, os.getpid(), name ), dir = directory )
+        with lock:
+            live.append( self )
+
+    def file( self, name ):
+        return os.path.join( self.path, name )
+
+    def remove( self ):
+        shutil.rmtree( self.path, ignore_errors = True )
+        with lock:
+            if self in live:
+                live.remove( self )
+
+def user_cache( *names ):
+    """A directory under ~/.cache/itcc for things worth keeping between
+    sessions."""
+    base = os.environ.get( "XDG_CACHE_HOME" ) or os.path.expanduser( "~/.cache" )
+    directory = os.path.join( base, "itcc", *names )
+    os.makedirs( directory, exist_ok = True )
+    return directory
+
+def absolute( paths ):
+    """Compilers run inside the workspace, so relative -I and -L
+    directories are resolved against where the user started us."""
+    if paths is None:
+        return None
+    return [ os.path.abspath( p ) for p in paths ]